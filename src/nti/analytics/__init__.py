@@ -8,6 +8,9 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import os
+import zlib
+
 import zope.i18nmessageid
 MessageFactory = zope.i18nmessageid.MessageFactory('nti.analytics')
 
@@ -35,7 +38,7 @@ ASSESSMENTS_ANALYTICS = QUEUE_NAME + '++assessments'
 ENROLL_ANALYTICS = QUEUE_NAME + '++enroll'
 TAGS_ANALYTICS = QUEUE_NAME + '++tags'
 
-# This one perhaps needs more buckets
+# These are partitioned; see `PARTITIONED_QUEUES`.
 RESOURCE_VIEW_ANALYTICS = QUEUE_NAME + '++resource++views'
 VIDEO_VIEW_ANALYTICS = QUEUE_NAME + '++video++views'
 CATALOG_VIEW_ANALYTICS = QUEUE_NAME + '++catalog++views'
@@ -50,6 +53,63 @@ SEARCH_ANALYTICS = USERS_ANALYTICS
 
 logger = __import__('logging').getLogger(__name__)
 
+#: Our high-volume queues, which may be split into `QUEUE_PARTITIONS`
+#: partitions, keyed by the event user. Each user's events always land
+#: in the same partition, keeping them in order.
+PARTITIONED_QUEUES = (RESOURCE_VIEW_ANALYTICS, VIDEO_VIEW_ANALYTICS)
+
+#: Queues whose (low-volume) events are time-sensitive; the queue analogue
+#: of `IPriorityProcessingAnalyticsEvent`. These are favored when
+#: scheduling which queue to drain next.
+PRIORITY_QUEUES = (SESSIONS_ANALYTICS, ENROLL_ANALYTICS, DELETE_ANALYTICS)
+
+#: The number of partitions per partitioned queue. Changing this requires
+#: draining the partitioned queues first.
+QUEUE_PARTITIONS = max(int(os.getenv('NTI_ANALYTICS_QUEUE_PARTITIONS') or 1), 1)
+
+
+def get_partition_names(name, partitions=None):
+	"""
+	Return the names of the partitions for the given queue name. The first
+	partition is always the queue name itself.
+	"""
+	partitions = QUEUE_PARTITIONS if partitions is None else partitions
+	if name not in PARTITIONED_QUEUES or partitions <= 1:
+		return [name]
+	return [name] + ['%s++%s' % (name, idx) for idx in range(1, partitions)]
+
+
+def get_partition_name(name, partition_key=None, partitions=None):
+	"""
+	Return the partition of the given queue for the given key (e.g. a
+	username). We need a hash that is stable across processes.
+	"""
+	names = get_partition_names(name, partitions)
+	if len(names) == 1 or partition_key is None:
+		return names[0]
+	if not isinstance(partition_key, bytes):
+		partition_key = partition_key.encode('utf-8')
+	idx = (zlib.crc32(partition_key) & 0xffffffff) % len(names)
+	return names[idx]
+
+
+def get_base_queue_name(name):
+	"""
+	Return the name of the queue the given queue partition belongs to (or
+	the name itself, if not a partition).
+	"""
+	for base_name in PARTITIONED_QUEUES:
+		if name.startswith(base_name + '++'):
+			return base_name
+	return name
+
+
+def _expand_partitions(names):
+	result = []
+	for name in names:
+		result.extend(get_partition_names(name))
+	return result
+
 # Order is important here.  We happen to know that
 # nti.async processes these queues in order.  The boards (and blogs)
 # must come before the topics must come before the comments.
@@ -57,23 +117,25 @@ logger = __import__('logging').getLogger(__name__)
 # or when multiple processes are running.
 # -> Since we now are idempotent and can lazy create
 # 	 parent objects in most cases, this is no longer strictly necessary.
-QUEUE_NAMES = [ SESSIONS_ANALYTICS,
-				SOCIAL_ANALYTICS,
-				ASSESSMENTS_ANALYTICS,
-				BLOGS_ANALYTICS,
-				BOARDS_ANALYTICS,
-				ENROLL_ANALYTICS,
-				TAGS_ANALYTICS,
-				TOPICS_ANALYTICS,
-				COMMENTS_ANALYTICS,
-				USERS_ANALYTICS,
-				RESOURCE_VIEW_ANALYTICS,
-				VIDEO_VIEW_ANALYTICS,
-				CATALOG_VIEW_ANALYTICS,
-				TOPIC_VIEW_ANALYTICS,
-				NOTE_VIEW_ANALYTICS,
-				BLOG_VIEW_ANALYTICS,
-				DELETE_ANALYTICS ]
+# -> The standalone worker (`nti_analytics_worker`) does not drain these
+#	 in order; see `nti.analytics.scheduler`.
+QUEUE_NAMES = _expand_partitions([ SESSIONS_ANALYTICS,
+								   SOCIAL_ANALYTICS,
+								   ASSESSMENTS_ANALYTICS,
+								   BLOGS_ANALYTICS,
+								   BOARDS_ANALYTICS,
+								   ENROLL_ANALYTICS,
+								   TAGS_ANALYTICS,
+								   TOPICS_ANALYTICS,
+								   COMMENTS_ANALYTICS,
+								   USERS_ANALYTICS,
+								   RESOURCE_VIEW_ANALYTICS,
+								   VIDEO_VIEW_ANALYTICS,
+								   CATALOG_VIEW_ANALYTICS,
+								   TOPIC_VIEW_ANALYTICS,
+								   NOTE_VIEW_ANALYTICS,
+								   BLOG_VIEW_ANALYTICS,
+								   DELETE_ANALYTICS ])
 
 def has_analytics():
 	"Determines whether our current site is configured for analytics."
@@ -82,6 +144,13 @@ def has_analytics():
 def get_factory():
 	return component.getUtility(IAnalyticsQueueFactory)
 
+def get_partitioned_queue(name, partition_key=None):
+	"""
+	Return the queue partition for the given name and key.
+	"""
+	factory = get_factory()
+	return factory.get_queue(get_partition_name(name, partition_key))
+
 def get_current_username():
 	try:
 		return getInteraction().participations[0].principal.id
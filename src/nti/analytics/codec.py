@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A compact, versioned wire format for analytics events.
+
+Events are queued (pickled) in every analytics job. By default, a pickled
+`SchemaConfigured` event carries its class path and a dict of field names
+to values. Instead, we reduce an event to a tuple of
+``(version, tag, values, extras)``: `tag` is the (interned) position of the
+event class in `EVENT_TYPES`, `values` are the field values in the order
+given by `EVENT_FIELDS`, and `extras` is any unexpected instance state (or
+None).
+
+Both tables are append-only; changing an existing position requires
+bumping `CODEC_VERSION`. Payloads from before a field was appended decode
+with that field left at its default.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope.dottedname.resolve import resolve
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The current version of our wire format.
+CODEC_VERSION = 1
+
+_BASE_FIELDS = ('timestamp', 'user', 'SessionID')
+_VIEW_FIELDS = _BASE_FIELDS + ('Duration', 'context_path')
+_ROOT_CONTEXT_FIELDS = _VIEW_FIELDS + ('RootContextID',)
+_ASSESSMENT_FIELDS = _ROOT_CONTEXT_FIELDS + ('ResourceId', 'ContentId')
+_VIDEO_FIELDS = _ROOT_CONTEXT_FIELDS + ('ResourceId', 'video_start_time',
+                                        'video_end_time', 'MaxDuration',
+                                        'with_transcript', 'PlaySpeed',
+                                        'player_configuration')
+
+#: The event types we encode; the position is the wire tag (append only).
+EVENT_TYPES = (
+    ('nti.analytics.model.ResourceEvent', _ROOT_CONTEXT_FIELDS + ('ResourceId',)),
+    ('nti.analytics.model.WatchVideoEvent', _VIDEO_FIELDS),
+    ('nti.analytics.model.SkipVideoEvent', _VIDEO_FIELDS),
+    ('nti.analytics.model.SelfAssessmentViewEvent', _ASSESSMENT_FIELDS),
+    ('nti.analytics.model.AssignmentViewEvent', _ASSESSMENT_FIELDS),
+    ('nti.analytics.model.SurveyViewEvent', _ASSESSMENT_FIELDS),
+    ('nti.analytics.model.CourseCatalogViewEvent', _ROOT_CONTEXT_FIELDS),
+    ('nti.analytics.model.BlogViewEvent', _VIEW_FIELDS + ('blog_id',)),
+    ('nti.analytics.model.NoteViewEvent', _ROOT_CONTEXT_FIELDS + ('note_id',)),
+    ('nti.analytics.model.TopicViewEvent', _ROOT_CONTEXT_FIELDS + ('topic_id',)),
+    ('nti.analytics.model.VideoPlaySpeedChangeEvent', _BASE_FIELDS + ('RootContextID',
+                                                                      'ResourceId',
+                                                                      'OldPlaySpeed',
+                                                                      'NewPlaySpeed',
+                                                                      'VideoTime')),
+    ('nti.analytics.model.ProfileViewEvent', _VIEW_FIELDS + ('ProfileEntity',)),
+    ('nti.analytics.model.ProfileActivityViewEvent', _VIEW_FIELDS + ('ProfileEntity',)),
+    ('nti.analytics.model.ProfileMembershipViewEvent', _VIEW_FIELDS + ('ProfileEntity',)),
+)
+
+_TAGS_BY_NAME = {name: idx for idx, (name, _) in enumerate(EVENT_TYPES)}
+
+# Legacy state keys and their current names.
+_LEGACY_KEYS = (('time_length', 'Duration'), ('course', 'RootContextID'))
+
+_classes = {}
+
+
+def _get_class(tag):
+    try:
+        return _classes[tag]
+    except KeyError:
+        result = _classes[tag] = resolve(EVENT_TYPES[tag][0])
+        return result
+
+
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _normalized_state(event):
+    state = dict(event.__dict__)
+    for old, new in _LEGACY_KEYS:
+        if old in state:
+            value = state.pop(old)
+            if state.get(new) is None:
+                state[new] = value
+    return state
+
+
+def get_event_tag(event):
+    """
+    Return the wire tag for the given event, or None if not encodable.
+    """
+    return _TAGS_BY_NAME.get(_class_name(type(event)))
+
+
+def encode_event(event):
+    """
+    Encode the event as a ``(version, tag, values, extras)`` tuple.
+    """
+    tag = get_event_tag(event)
+    if tag is None:
+        raise TypeError('Cannot encode event type (%s)' % type(event))
+    fields = EVENT_TYPES[tag][1]
+    state = _normalized_state(event)
+    values = tuple(state.pop(name) if name in state else getattr(event, name, None)
+                   for name in fields)
+    return (CODEC_VERSION, tag, values, state or None)
+
+
+def decode_event(payload):
+    """
+    Decode an event from the tuple produced by :func:`encode_event`.
+    """
+    version, tag, values, extras = payload
+    if version > CODEC_VERSION:
+        raise ValueError('Unsupported analytics event version (%s)' % version)
+    cls = _get_class(tag)
+    result = cls.__new__(cls)
+    state = result.__dict__
+    state.update(zip(EVENT_TYPES[tag][1], values))
+    if extras:
+        state.update(extras)
+    return result
+
+
+def reduce_event(event):
+    """
+    A `__reduce__` implementation pickling events in our compact format.
+    """
+    return (decode_event, (encode_event(event),))
@@ -6,8 +6,18 @@
 
 from __future__ import print_function, unicode_literals, absolute_import, division
 
+import time
+import functools
+import threading
+
+from contextlib import contextmanager
+
 from datetime import datetime
 
+import transaction
+
+from transaction.interfaces import TransientError
+
 from pyramid.threadlocal import get_current_request
 
 from pyramid.traversal import find_interface
@@ -16,6 +26,8 @@ from six import integer_types
 
 from zope import component
 
+from zope.interface.interfaces import ComponentLookupError
+
 from zope.component.hooks import getSite
 from zope.component.hooks import site as current_site
 
@@ -28,8 +40,21 @@ from nti.asynchronous import create_job
 
 from nti.analytics.database import get_analytics_db
 
+from nti.analytics.database.profiling import profile_call
+
+from nti.analytics.resolvers import _get_last_sync_time
+
+from nti.analytics.interfaces import AnalyticsEventValidationError
 from nti.analytics.interfaces import IPriorityProcessingAnalyticsEvent
 
+from nti.analytics.metrics import IMMEDIATE_QUEUE_NAME
+
+from nti.analytics.metrics import get_metrics
+from nti.analytics.metrics import get_queue_name
+from nti.analytics.metrics import get_function_name
+
+from nti.analytics.runner import record_transient_error
+
 from nti.dataserver import liking
 from nti.dataserver import rating
 
@@ -84,9 +109,76 @@ def get_ratings( obj ):
 	is_flagged = get_flagged( obj )
 	return like_count, favorite_count, is_flagged
 
+_memo_local = threading.local()
+
+@contextmanager
+def resolution_memo():
+	"""
+	Within this context, objects resolved (by ntiid or username) are
+	memoized, so that each is resolved at most once. The context must not
+	outlive the current transaction. Nested contexts share their memo.
+	"""
+	if getattr( _memo_local, 'memo', None ) is not None:
+		yield _memo_local.memo
+		return
+	_memo_local.memo = {}
+	try:
+		yield _memo_local.memo
+	finally:
+		_memo_local.memo = None
+
+def with_resolution_memo( func ):
+	"""
+	A decorator running the function within a :func:`resolution_memo`.
+	"""
+	@functools.wraps( func )
+	def wrapper( *args, **kwargs ):
+		with resolution_memo():
+			return func( *args, **kwargs )
+	return wrapper
+
+def memoized( kind, key, factory ):
+	"""
+	Return `factory(key)`, memoized by `kind` and `key` within any
+	current :func:`resolution_memo`.
+	"""
+	memo = getattr( _memo_local, 'memo', None )
+	if memo is None:
+		return factory( key )
+	try:
+		return memo[(kind, key)]
+	except KeyError:
+		result = memo[(kind, key)] = factory( key )
+		return result
+	except TypeError:
+		# Unhashable
+		return factory( key )
+
+def get_memoized( kind, key, default=None ):
+	"""
+	Return the value memoized by `kind` and `key` within any current
+	:func:`resolution_memo`, or `default`.
+	"""
+	memo = getattr( _memo_local, 'memo', None )
+	if memo is None:
+		return default
+	return memo.get( (kind, key), default )
+
+def memoize( kind, key, value ):
+	"""
+	Memoize the (already resolved) value by `kind` and `key` within any
+	current :func:`resolution_memo`.
+	"""
+	memo = getattr( _memo_local, 'memo', None )
+	if memo is not None:
+		memo[(kind, key)] = value
+
+def _get_entity( username ):
+	return Entity.get_entity( username )
+
 def get_entity(entity):
 	if not IEntity.providedBy(entity):
-		entity = Entity.get_entity(str(entity))
+		entity = memoized( 'entity', str(entity), _get_entity )
 	return entity
 
 def get_creator(obj):
@@ -163,26 +255,143 @@ def get_root_context_name(context):
 
 def _do_execute_job(*args, **kwargs):
 	func, args = args[0], args[1:]
+	start = time.time()
+	failed = True
 	try:
-		result = func( *args, **kwargs )
+		if func is _do_execute_batch:
+			# Each of our ops (and our preparation) is profiled on its
+			# own, rather than folded into a profile of the whole batch.
+			result = func( *args, **kwargs )
+		else:
+			result = profile_call( func, *args, **kwargs )
+		failed = False
 	except ( IntIdMissingError, ObjectMissingError ) as e:
 		# Nothing we can do with these events; leave them on the floor.
 		logger.info(
 			'Object missing (deleted) before event could be processed; event dropped. (%s) (%s)',
 			e, func )
 		result = None
+		failed = False
+	finally:
+		get_metrics().record_execution( get_function_name( func ),
+										time.time() - start,
+										failed=failed )
 	# We used to manually flush here to find integrity issues, raising and
 	# retrying the transaction. That is a bad idea because it issues a DDL
 	# statement (locking appropriate records or the whole db in the sqlite
 	# case).
 	return result
 
+class _SiteCache(object):
+	"""
+	A process-level mapping of site name to the oid of the resolved site.
+	We store oids, rather than sites, since persistent objects are bound to
+	the connection that loaded them. The cache is reset whenever our host
+	sites are synchronized.
+	"""
+
+	def __init__(self):
+		self.last_sync_time = None
+		self.site_oids = {}
+
+	def reset(self, last_sync_time):
+		self.last_sync_time = last_sync_time
+		self.site_oids = {}
+
+_site_cache = _SiteCache()
+
+
+def _get_site_sync_time():
+	try:
+		return _get_last_sync_time()
+	except ComponentLookupError:
+		return None
+
+
+def _resolve_site(site_name):
+	event_site = get_site_for_site_names( (site_name,) )
+	if isinstance( event_site, TrivialSite ):
+		return None
+	return event_site
+
+
+def _get_site_for_site_name(ds_folder, site_name):
+	"""
+	Return the site for the given name, using our cache if possible. The
+	dataserver folder must be our current site.
+	"""
+	last_sync_time = _get_site_sync_time()
+	connection = getattr( ds_folder, '_p_jar', None )
+	if last_sync_time is None or connection is None:
+		# Nothing to validate our cache against
+		return _resolve_site( site_name )
+
+	if last_sync_time != _site_cache.last_sync_time:
+		_site_cache.reset( last_sync_time )
+
+	oid = _site_cache.site_oids.get( site_name )
+	if oid is not None:
+		try:
+			event_site = connection.get( oid )
+			event_site._p_activate()
+			return event_site
+		except POSError:
+			# Removed out from under us; resolve again.
+			_site_cache.site_oids.pop( site_name, None )
+
+	event_site = _resolve_site( site_name )
+	oid = getattr( event_site, '_p_oid', None )
+	if oid is not None:
+		_site_cache.site_oids[site_name] = oid
+	return event_site
+
+
+def _record_job_commit( status, queue_name, enqueue_time ):
+	get_metrics().record_commit( queue_name, enqueue_time, status )
+
+
+def _do_execute_recorded_job( queue_name, enqueue_time, *args, **kwargs ):
+	"""
+	Executes the job, recording its wait time, failure and (once our
+	transaction is committed) its enqueue-to-commit latency under the
+	given queue name.
+	"""
+	if queue_name is None:
+		# Not stamped (e.g. replayed failed jobs); nothing to record.
+		return _do_execute_job( *args, **kwargs )
+	metrics = get_metrics()
+	start = time.time()
+	try:
+		result = _do_execute_job( *args, **kwargs )
+	except Exception:
+		metrics.record_job( queue_name, enqueue_time, failed=True, now=start )
+		raise
+	metrics.record_job( queue_name, enqueue_time, now=start )
+	transaction.get().addAfterCommitHook( _record_job_commit,
+										  args=(queue_name, enqueue_time) )
+	return result
+
+
 def _execute_job(*args, **kwargs):
+	"""
+	Executes the job; transient errors (e.g. conflicts), which our queue
+	jobs trap, are recorded such that our batch runner retries.
+	"""
+	try:
+		return _execute_job_in_site(*args, **kwargs)
+	except TransientError as e:
+		record_transient_error(e)
+		raise
+
+
+def _execute_job_in_site(*args, **kwargs):
 	"""
 	Performs the actual execution of a job.  We'll attempt to do
 	so in the site the event occurred in, otherwise, we'll run in
 	whatever site we are currently in.
 	"""
+	queue_name = kwargs.pop( 'job_queue_name', None )
+	enqueue_time = kwargs.pop( 'job_enqueue_time', None )
 	event_site_name = kwargs.pop( 'site_name', None )
 	old_site = getSite()
 
@@ -196,10 +405,9 @@ def _execute_job(*args, **kwargs):
 		ds_folder = dataserver.root_folder['dataserver2']
 
 		with current_site( ds_folder ):
-			event_site = get_site_for_site_names( (event_site_name,) )
+			event_site = _get_site_for_site_name( ds_folder, event_site_name )
 
-		if 		event_site is None \
-			or 	isinstance( event_site, TrivialSite ):
+		if event_site is None:
 			# We could get a trivial site, which is unlikely to be useful.
 			raise ValueError( 'No site found for (%s)' % event_site_name )
 
@@ -211,7 +419,8 @@ def _execute_job(*args, **kwargs):
 						 event_site_name )
 			return None
 
-		return _do_execute_job(*args, **kwargs)
+		with resolution_memo():
+			return _do_execute_recorded_job( queue_name, enqueue_time, *args, **kwargs )
 
 
 def should_create_analytics(request):
@@ -226,9 +435,42 @@ def should_create_analytics(request):
 	return True
 
 
-def process_event( get_job_queue, object_op, obj=None, immediate=False, **kwargs ):
+def _get_event_site_name(request):
+	cur_site = getSite()
+	if cur_site is not None:
+		return cur_site.__name__
+	logger.warn( 'Request did not have site (%s)', request )
+	return None
+
+
+def _get_job_queue( get_job_queue, partition_key=None ):
+	if partition_key is None:
+		return get_job_queue()
+	return get_job_queue( partition_key=partition_key )
+
+
+def _put_job( queue, *args, **kwargs ):
+	"""
+	Create and queue a job, stamping it with our queue name and the
+	current time, for our metrics.
+	"""
+	queue_name = get_queue_name( queue )
+	job = create_job( _execute_job, *args,
+					  job_queue_name=queue_name,
+					  job_enqueue_time=time.time(),
+					  **kwargs )
+	queue.put( job )
+	get_metrics().record_enqueue( queue_name )
+	return job
+
+
+def process_event( get_job_queue, object_op, obj=None, immediate=False,
+				   partition_key=None, **kwargs ):
 	"""
 	Processes the event, which may not occur synchronously.
+
+	If given, the `partition_key` is passed to `get_job_queue`, to select
+	a queue partition.
 	"""
 	# We could check if we have analytics for this site before queuing the event.
 	request = get_current_request()
@@ -242,16 +484,168 @@ def process_event( get_job_queue, object_op, obj=None, immediate=False, **kwargs
 		effective_kwargs['oid'] = oid
 
 	# Now tag our event with the current site
-	cur_site = getSite()
-	if cur_site is not None:
-		effective_kwargs['site_name'] = cur_site.__name__
-	else:
-		logger.warn( 'Request did not have site (%s)', request )
+	site_name = _get_event_site_name( request )
+	if site_name is not None:
+		effective_kwargs['site_name'] = site_name
 
 	event = effective_kwargs.get('event')
 	if immediate or IPriorityProcessingAnalyticsEvent.providedBy(event):
-		_execute_job( object_op, **effective_kwargs )
+		_execute_job( object_op,
+					  job_queue_name=IMMEDIATE_QUEUE_NAME,
+					  job_enqueue_time=time.time(),
+					  **effective_kwargs )
 	else:
-		queue = get_job_queue()
-		job = create_job( _execute_job, object_op, **effective_kwargs )
-		queue.put( job )
+		queue = _get_job_queue( get_job_queue, partition_key )
+		_put_job( queue, object_op, **effective_kwargs )
+
+
+def _after_batch_commit( status, queue, job ):
+	if status:
+		queue.putFailed( job )
+		get_metrics().record_failure( get_queue_name( queue ) )
+
+
+def _put_failed_job( get_job_queue, object_op, site_name, kwargs,
+					  partition_key=None ):
+	"""
+	Place a single op from a failed batch on the failed queue (of its
+	partition), as a job that may be re-run on its own, once our batch
+	commits. A batch that does not commit is retried, or put on the
+	failed queue, as a whole.
+	"""
+	queue = _get_job_queue( get_job_queue, partition_key )
+	if getattr( queue, 'putFailed', None ) is None:
+		# Immediate runners have no failed queue; let the caller raise.
+		return False
+	job = create_job( _execute_job, object_op, site_name=site_name, **kwargs )
+	# Counted as a failure of its queue once put.
+	transaction.get().addAfterCommitHook( _after_batch_commit,
+										  args=(queue, job) )
+	return True
+
+
+def _do_execute_isolated_job( get_job_queue, site_name, object_op, kwargs,
+							  partition_key=None ):
+	try:
+		savepoint = transaction.savepoint()
+	except TypeError:
+		# Some participating data manager cannot savepoint; the
+		# whole batch succeeds or fails together.
+		return _do_execute_job( object_op, **kwargs )
+
+	try:
+		result = _do_execute_job( object_op, **kwargs )
+		# Flush within our savepoint, so that any integrity errors
+		# are attributed to this op and not the next one.
+		transaction.savepoint()
+	except TransientError:
+		# Conflicts and the like; retry the batch as a whole.
+		raise
+	except Exception:
+		logger.exception( 'Analytics job in batch failed (%s)', object_op )
+		savepoint.rollback()
+		if not _put_failed_job( get_job_queue, object_op, site_name, kwargs,
+								partition_key ):
+			raise
+		result = None
+	return result
+
+
+def _do_prepare_batch( prepare_batch, jobs ):
+	try:
+		savepoint = transaction.savepoint()
+	except TypeError:
+		savepoint = None
+
+	try:
+		profile_call( prepare_batch, [kwargs for _, kwargs in jobs] )
+		if savepoint is not None:
+			transaction.savepoint()
+	except TransientError:
+		raise
+	except Exception:
+		# Our ops can still resolve what they need themselves.
+		logger.exception( 'Could not prepare analytics batch (%s)', prepare_batch )
+		if savepoint is None:
+			raise
+		savepoint.rollback()
+
+
+def _do_execute_batch( jobs, get_job_queue=None, event_site_name=None,
+					   prepare_batch=None, partition_key=None ):
+	"""
+	Executes a batch of `(object_op, kwargs)` pairs in the current site
+	and transaction.
+
+	If given, `prepare_batch` is first called with the kwargs of all the
+	jobs (e.g. to resolve what they share in bulk). A failure to prepare
+	is logged and ignored.
+
+	When run from a queue (`get_job_queue` is given), each op runs in its
+	own savepoint; a failing op is rolled back and put on the failed queue
+	(of the given partition) as its own job, leaving the rest of the batch
+	intact. Otherwise, validation errors are captured and returned, aligned
+	with `jobs`, and anything else is raised.
+	"""
+	if prepare_batch is not None:
+		_do_prepare_batch( prepare_batch, jobs )
+	result = []
+	for object_op, kwargs in jobs:
+		error = None
+		if get_job_queue is not None:
+			_do_execute_isolated_job( get_job_queue, event_site_name,
+									  object_op, kwargs, partition_key )
+		else:
+			try:
+				_do_execute_job( object_op, **kwargs )
+			except AnalyticsEventValidationError as e:
+				error = e
+		result.append( error )
+	return result
+
+
+def process_events( get_job_queue, object_ops, immediate=False, partition_key=None,
+					prepare_batch=None ):
+	"""
+	Processes a batch of `(object_op, kwargs)` pairs bound for the same
+	queue (partition). Time-sensitive events are executed together in a
+	single site context; the remainder are queued as a single job. Each
+	is prepared with the (picklable) `prepare_batch`, if given.
+
+	Returns a list, aligned with `object_ops`, of any validation errors
+	raised while executing events immediately.
+	"""
+	result = [None] * len( object_ops )
+	request = get_current_request()
+	if not object_ops or not should_create_analytics( request ):
+		return result
+
+	site_name = _get_event_site_name( request )
+	immediate_ops = []
+	queued_ops = []
+	for idx, ( object_op, kwargs ) in enumerate( object_ops ):
+		event = kwargs.get( 'event' )
+		if immediate or IPriorityProcessingAnalyticsEvent.providedBy( event ):
+			immediate_ops.append( (idx, (object_op, kwargs)) )
+		else:
+			queued_ops.append( (object_op, kwargs) )
+
+	if immediate_ops:
+		errors = _execute_job( _do_execute_batch,
+							   [x[1] for x in immediate_ops],
+							   prepare_batch=prepare_batch,
+							   job_queue_name=IMMEDIATE_QUEUE_NAME,
+							   job_enqueue_time=time.time(),
+							   site_name=site_name )
+		for ( idx, _ ), error in zip( immediate_ops, errors or () ):
+			result[idx] = error
+
+	if queued_ops:
+		queue = _get_job_queue( get_job_queue, partition_key )
+		_put_job( queue, _do_execute_batch, queued_ops,
+				  get_job_queue=get_job_queue,
+				  event_site_name=site_name,
+				  prepare_batch=prepare_batch,
+				  partition_key=partition_key,
+				  site_name=site_name )
+	return result
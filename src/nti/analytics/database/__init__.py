@@ -8,6 +8,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from sqlalchemy import inspect
+
 from zope import component
 
 from nti.analytics_database import Base
@@ -25,12 +27,92 @@ def get_analytics_db(strict=True):
         return component.queryUtility(IAnalyticsDB)
 
 
+class RecordPage(list):
+    """
+    A page of records, along with the opaque token that continues with
+    the next page (None if there are no more).
+    """
+
+    def __init__(self, records=(), continuation=None):
+        super(RecordPage, self).__init__(records)
+        self.continuation = continuation
+
+
+class ProjectedRows(object):
+    """
+    Rows of only the requested columns (as named tuples), rather than
+    records. These are not resolved into objects.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class StreamedRows(object):
+    """
+    The rows of a streaming (`yield_per`) query, which we resolve lazily
+    with :func:`iter_objects`.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+#: The number of streamed rows we resolve before expunging them from our
+#: session.
+STREAM_CHUNK_SIZE = 1000
+
+
+def _expunge(rows):
+    for row in rows:
+        state = inspect(row, raiseerr=False)
+        # Leave any changes be.
+        if state is not None and state.persistent and not state.modified:
+            state.session.expunge(row)
+
+
+def iter_objects(to_call, rows, chunk_size=STREAM_CHUNK_SIZE, **kwargs):
+    """
+    Lazily resolve the given rows, filtering out Nones, expunging the
+    rows from their session in chunks as they are consumed, such that
+    walking a large result does not pin every row in our session.
+
+    Records returned by `to_call` itself are detached once the next
+    chunk is resolved.
+    """
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append(row)
+            result = to_call(row, **kwargs)
+            if result is not None:
+                yield result
+            if len(chunk) >= chunk_size:
+                _expunge(chunk)
+                chunk = []
+    finally:
+        _expunge(chunk)
+
+
 def resolve_objects(to_call, rows, **kwargs):
+    if isinstance(rows, ProjectedRows):
+        return rows
+    if isinstance(rows, StreamedRows):
+        return iter_objects(to_call, rows, **kwargs)
     result = ()
     if rows:
         # Resolve the objects, filtering out Nones
         result = [x for x in (to_call(row, **kwargs) for row in rows)
                   if x is not None]
+    if isinstance(rows, RecordPage):
+        # Keep our place
+        result = RecordPage(result, rows.continuation)
     return result
 
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Process-level caches for our (rarely changing) dimension records.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import inspect
+
+from sqlalchemy.orm import make_transient_to_detached
+
+import transaction
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class TransactionalLRUCache(object):
+	"""
+	A bounded, least-recently-used cache whose additions only take effect
+	once the current transaction commits; entries added in a transaction
+	that is rolled back never become visible. Invalidating a key also
+	discards any pending additions for it, in any transaction.
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._versions = {}
+
+	def __len__(self):
+		return len(self._data)
+
+	def get(self, key, default=None):
+		try:
+			value = self._data.pop(key)
+		except KeyError:
+			self.misses += 1
+			return default
+		self.hits += 1
+		self._data[key] = value
+		return value
+
+	def _put(self, key, value):
+		self._data.pop(key, None)
+		self._data[key] = value
+		while len(self._data) > self.maxsize:
+			self._data.popitem(last=False)
+
+	def _after_commit(self, status, key, version, value, factory):
+		if not status or self._versions.get(key, 0) != version:
+			return
+		if factory is not None:
+			value = factory()
+		if value is not None:
+			self._put(key, value)
+
+	def set(self, key, value=None, factory=None):
+		"""
+		Cache the value for the key once the current transaction commits.
+		Given a `factory`, it is called after commit to produce the value
+		(e.g. for a database generated key); a None value is not cached.
+		"""
+		version = self._versions.get(key, 0)
+		transaction.get().addAfterCommitHook(self._after_commit,
+											 args=(key, version, value, factory))
+
+	def _after_invalidate(self, unused_status, key):
+		self._data.pop(key, None)
+
+	def invalidate(self, key):
+		"""
+		Invalidate the key, now and again once the current transaction
+		ends (any concurrent reader may have re-added it).
+		"""
+		self._data.pop(key, None)
+		self._versions[key] = self._versions.get(key, 0) + 1
+		transaction.get().addAfterCommitHook(self._after_invalidate, args=(key,))
+
+	def clear(self):
+		self._data.clear()
+		self._versions.clear()
+
+
+class DatabaseCaches(object):
+	"""
+	A :class:`TransactionalLRUCache` per analytics db (our sites may have
+	their own databases).
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self._caches = WeakKeyDictionary()
+
+	def __call__(self, db):
+		try:
+			return self._caches[db]
+		except KeyError:
+			result = self._caches[db] = TransactionalLRUCache(self.maxsize)
+			return result
+
+	def clear(self):
+		self._caches.clear()
+
+
+def get_record_id(record):
+	"""
+	Return the primary key of the record, if assigned. This is safe to
+	call after commit, when the record is expired and detached.
+	"""
+	identity = inspect(record).identity
+	return identity[0] if identity else None
+
+
+def merge_cached_record(db, factory, state):
+	"""
+	Return a persistent record, attached to our session, from the cached
+	state, without querying. Columns not cached are loaded on access.
+	"""
+	record = factory(**state)
+	make_transient_to_detached(record)
+	return db.session.merge(record, load=False)
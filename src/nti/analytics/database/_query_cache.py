@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+A result cache for our (repeated, read-only) report queries, e.g. the
+counts by user of our instructor dashboards.
+
+Results are keyed by query name, SQL and bound parameters (i.e. the
+normalized arguments, after root context resolution) and site, and are
+valid for a *watermark* of the tables they read, rather than for a
+time. The watermark combines:
+
+* the max primary key of each table, which moves with every insert, by
+  any process;
+* the sum of each of the `UPDATED_COLUMNS` of a table, which moves when
+  another process updates a row in place (e.g. a heartbeat extending
+  the `time_length` of a view); and
+* a per-table version, bumped once a transaction that wrote (or bulk
+  updated or deleted) rows of the table in this process commits.
+
+Other updates and deletes made by other processes are only seen once
+the table's watermark otherwise moves; our ingestion path is
+insert-mostly, apart from those `UPDATED_COLUMNS`.
+
+Sessions with (uncommitted) writes to a table bypass the cache for
+queries of that table.
+
+Reads from a replica also bypass the cache for `REPLICA_LAG` seconds
+after this process commits writes to a table they read: the replica
+may not have applied the commit yet, and its (stale) result would
+otherwise be cached under our new version of the table.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from collections import OrderedDict
+
+from weakref import WeakKeyDictionary
+
+import six
+
+from sqlalchemy import func
+from sqlalchemy import select
+
+from sqlalchemy.orm import Query
+
+from zope.component.hooks import getSite
+
+from nti.analytics.database import get_analytics_db
+
+from nti.analytics.database._writes import get_table_version
+from nti.analytics.database._writes import get_written_tables
+from nti.analytics.database._writes import get_table_commit_time
+
+from nti.analytics.database.replica import REPLICA_LAG
+from nti.analytics.database.replica import get_analytics_read_db
+
+from nti.analytics.metrics import get_metrics
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The maximum number of results cached, per analytics db.
+QUERY_CACHE_SIZE = 500
+
+#: Results with more rows than this are not cached.
+QUERY_CACHE_MAX_ROWS = 5000
+
+#: The columns our (heartbeat) events update in place, rather than
+#: inserting new rows.
+UPDATED_COLUMNS = ('time_length', 'video_start_time', 'video_end_time')
+
+
+class QueryResultCache(object):
+	"""
+	A bounded, least-recently-used cache of query results, each stored
+	with the watermark it is valid for.
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self._data = OrderedDict()
+
+	def __len__(self):
+		return len(self._data)
+
+	def get(self, key, watermark):
+		try:
+			entry_watermark, result = self._data.pop(key)
+		except KeyError:
+			return None
+		if entry_watermark != watermark:
+			return None
+		self._data[key] = (entry_watermark, result)
+		return result
+
+	def set(self, key, watermark, result):
+		"""
+		Cache the result, returning the number of results evicted.
+		"""
+		self._data.pop(key, None)
+		self._data[key] = (watermark, result)
+		evicted = 0
+		while len(self._data) > self.maxsize:
+			self._data.popitem(last=False)
+			evicted += 1
+		return evicted
+
+	def clear(self):
+		self._data.clear()
+
+
+class _QueryResultCaches(object):
+	"""
+	A :class:`QueryResultCache` per analytics db.
+	"""
+
+	def __init__(self):
+		self._caches = WeakKeyDictionary()
+
+	def __call__(self, db):
+		try:
+			return self._caches[db]
+		except KeyError:
+			result = self._caches[db] = QueryResultCache(QUERY_CACHE_SIZE)
+			return result
+
+	def clear(self):
+		self._caches.clear()
+
+_query_caches = _QueryResultCaches()
+
+
+def _get_statement_key(statement):
+	compiled = statement.compile()
+	return (six.text_type(compiled), tuple(sorted(compiled.params.items())))
+
+
+def _get_watermark_columns(table):
+	"""
+	The aggregates of the table that move as its rows are inserted or
+	updated in place.
+	"""
+	result = [func.max(list(table.primary_key.columns)[0])]
+	result.extend(func.sum(table.c[x]) for x in UPDATED_COLUMNS if x in table.c)
+	return result
+
+
+def _get_watermark(db, tables):
+	"""
+	The max primary key, the sums of the updated columns and our version
+	of each table, in a single query.
+	"""
+	aggregates = [select([x]).as_scalar()
+				  for table in tables for x in _get_watermark_columns(table)]
+	row = db.session.execute(select(aggregates)).first()
+	return tuple(row) + tuple(get_table_version(x.name) for x in tables)
+
+
+def _is_replica_lagging(db, tables):
+	"""
+	Whether the db is a replica that may not have applied our recent
+	commits to the tables.
+	"""
+	if db is get_analytics_db(strict=False):
+		return False
+	cutoff = time.time() - REPLICA_LAG
+	for table in tables:
+		commit_time = get_table_commit_time(table.name)
+		if commit_time is not None and commit_time > cutoff:
+			return True
+	return False
+
+
+def _execute(db, query):
+	if isinstance(query, Query):
+		return query.all()
+	return [tuple(x) for x in db.session.execute(query)]
+
+
+def cached_query_rows(name, query, tables):
+	"""
+	Return the rows (as a list) of the given `Query` or select statement,
+	which reads the given tables, from our cache if still valid.
+	"""
+	db = get_analytics_read_db()
+	tables = [getattr(x, '__table__', x) for x in tables]
+	metrics = get_metrics()
+	written_tables = get_written_tables(db.session)
+	if 		not QUERY_CACHE_SIZE \
+		or	written_tables.intersection(x.name for x in tables) \
+		or	_is_replica_lagging(db, tables):
+		metrics.record_query_cache(name, 'bypassed')
+		return _execute(db, query)
+
+	statement = query.statement if isinstance(query, Query) else query
+	site_name = getattr(getSite(), '__name__', None)
+	key = (name, site_name, _get_statement_key(statement))
+	try:
+		hash(key)
+	except TypeError:
+		metrics.record_query_cache(name, 'bypassed')
+		return _execute(db, query)
+
+	cache = _query_caches(db)
+	watermark = _get_watermark(db, tables)
+	result = cache.get(key, watermark)
+	if result is not None:
+		metrics.record_query_cache(name, 'hits')
+		return list(result)
+
+	metrics.record_query_cache(name, 'misses')
+	result = _execute(db, query)
+	if len(result) > QUERY_CACHE_MAX_ROWS:
+		metrics.record_query_cache(name, 'uncached')
+	else:
+		evicted = cache.set(key, watermark, tuple(result))
+		if evicted:
+			metrics.record_query_cache(name, 'evicted', evicted)
+	return result
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Race-free get-or-create of our dimension records (users, resources,
+etc.), which concurrent workers may well create at the same time.
+
+Rather than SELECT-then-INSERT (where the loser of a race fails its whole
+job with an `IntegrityError`), we insert with a dialect-aware upsert that
+leaves rows whose unique key already exists alone, then re-read the
+records.
+
+Under MySQL's REPEATABLE READ, a plain SELECT reads our transaction's
+snapshot, which may predate the row a concurrent worker committed (and
+that our insert left alone). A single record is re-read with a locking
+read (`FOR UPDATE`, as our callers may go on to update it); records
+missing from a bulk re-read are left to our per-record path.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The maximum number of keys in a single `IN` clause.
+BULK_QUERY_SIZE = 500
+
+#: The maximum number of rows in a single insert.
+BULK_INSERT_SIZE = 100
+
+
+def _chunks(values, size):
+	values = list(values)
+	for idx in range(0, len(values), size):
+		yield values[idx:idx + size]
+
+
+def get_records(db, factory, key, values, lock=False):
+	"""
+	Return a dict of value to the existing records whose `key` column has
+	one of the given values, optionally locking them for update, which
+	also reads the latest committed rows.
+	"""
+	result = {}
+	for chunk in _chunks(values, BULK_QUERY_SIZE):
+		query = db.session.query(factory).filter(key.in_(chunk))
+		if lock:
+			query = query.with_for_update()
+		for record in query:
+			result[getattr(record, key.key)] = record
+	return result
+
+
+def _get_primary_key(table):
+	return list(table.primary_key.columns)[0]
+
+
+def _insert_statement(db, table, rows):
+	dialect = db.engine.name
+	if dialect == 'mysql':
+		stmt = mysql_insert(table).values(rows)
+		# A no-op update of the existing row; other errors still raise.
+		pk = _get_primary_key(table)
+		return stmt.on_duplicate_key_update({pk.name: pk})
+	if dialect == 'sqlite':
+		return table.insert().prefix_with('OR IGNORE').values(rows)
+	# Nothing better; duplicates raise, as they always have.
+	return table.insert().values(rows)
+
+
+def _inserted(db, result, record):
+	"""
+	Whether our (single row) insert `result` inserted the record.
+	"""
+	if result.rowcount == 0:
+		return False
+	if db.engine.name == 'mysql':
+		# Our no-op update of an existing row counts as found, but
+		# does not generate its id.
+		pk = _get_primary_key(record.__table__)
+		return bool(result.lastrowid) \
+			and result.lastrowid == getattr(record, pk.key)
+	return True
+
+
+def upsert_records(db, factory, key, rows):
+	"""
+	Insert the given rows (dicts of column values) into the table of
+	`factory`, leaving those whose unique `key` column value already
+	exists, and return a dict of key value to (re-read) record.
+	"""
+	rows = [x for x in rows if x.get(key.key) is not None]
+	table = factory.__table__
+	for chunk in _chunks(rows, BULK_INSERT_SIZE):
+		db.session.execute(_insert_statement(db, table, chunk))
+	keys = [x[key.key] for x in rows]
+	result = get_records(db, factory, key, keys)
+	missing = set(keys).difference(result)
+	if missing:
+		logger.debug('Upserted records not in our snapshot (%s) (count=%s)',
+					 table.name, len(missing))
+	return result
+
+
+def upsert_record(db, factory, key, values, created=None):
+	"""
+	Insert a row with the given values, unless one exists with the same
+	(unique) `key` column value, returning the record, locked for update.
+	If given, the record is appended to `created` if we inserted it.
+	"""
+	key_value = values.get(key.key)
+	if key_value is None:
+		# Cannot be unique, or re-read.
+		result = factory(**values)
+		db.session.add(result)
+		if created is not None:
+			created.append(result)
+		return result
+	insert_result = db.session.execute(_insert_statement(db, factory.__table__,
+														 [values]))
+	result = get_records(db, factory, key, [key_value], lock=True).get(key_value)
+	if result is None:
+		raise ValueError('Upserted record not found (%s) (%s=%s)' %
+						 (factory.__table__.name, key.key, key_value))
+	if created is not None and _inserted(db, insert_result, result):
+		created.append(result)
+	return result
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Tracking of the tables our sessions write, such that readers can tell
+whether their session has (uncommitted) writes to a table, or whether a
+table changed (in this process) since they last read it, and when.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from collections import defaultdict
+
+from itertools import chain
+
+from sqlalchemy import event
+
+from sqlalchemy.orm import Session
+
+logger = __import__('logging').getLogger(__name__)
+
+_WRITTEN_TABLES_KEY = 'nti.analytics.written_tables'
+
+#: Table name to the number of (committed) transactions that wrote it.
+_table_versions = defaultdict(int)
+
+#: Table name to the time a transaction that wrote it last committed.
+_table_commit_times = {}
+
+
+def _flushed_tables(session):
+	return session.info.setdefault(_WRITTEN_TABLES_KEY, set())
+
+
+def _pending_tables(session):
+	result = set()
+	for obj in chain(session.new, session.dirty, session.deleted):
+		tablename = getattr(obj, '__tablename__', None)
+		if tablename:
+			result.add(tablename)
+	return result
+
+
+def get_written_tables(session):
+	"""
+	The names of the tables the session has written (or will write, on
+	flush) in its current transaction.
+	"""
+	return _flushed_tables(session) | _pending_tables(session)
+
+
+def get_table_version(tablename):
+	"""
+	The number of transactions in this process that committed writes to
+	the table.
+	"""
+	return _table_versions[tablename]
+
+
+def get_table_commit_time(tablename):
+	"""
+	The time a transaction in this process that wrote the table last
+	committed, if any.
+	"""
+	return _table_commit_times.get(tablename)
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, unused_flush_context):
+	_flushed_tables(session).update(_pending_tables(session))
+
+
+def _after_bulk(context):
+	table = getattr(context, 'primary_table', None)
+	if table is None:
+		table = context.mapper.local_table
+	_flushed_tables(context.session).add(table.name)
+
+event.listen(Session, 'after_bulk_update', _after_bulk)
+event.listen(Session, 'after_bulk_delete', _after_bulk)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+	tables = session.info.pop(_WRITTEN_TABLES_KEY, ())
+	now = time.time()
+	for tablename in tables:
+		_table_versions[tablename] += 1
+		_table_commit_times[tablename] = now
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+	# Nothing was written.
+	session.info.pop(_WRITTEN_TABLES_KEY, None)
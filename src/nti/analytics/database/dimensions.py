@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Bulk resolution of the dimension records (users, resources and root
+contexts) a batch of events refers to.
+
+Each dimension table is queried once (in chunks of keys) and
+missing rows are upserted together. The records are memoized within the
+current :func:`nti.analytics.common.resolution_memo`, where our
+(per-event) get-or-create functions find them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.analytics_database.resources import Resources
+
+from nti.analytics_database.root_context import Books
+from nti.analytics_database.root_context import Courses
+
+from nti.analytics_database.users import Users
+
+from nti.analytics.common import memoize
+
+from nti.analytics.database._upsert import get_records
+from nti.analytics.database._upsert import upsert_records
+
+from nti.analytics.database.resources import _get_sync_time
+from nti.analytics.database.resources import _cache_resource
+from nti.analytics.database.resources import _get_resource_values
+
+from nti.analytics.database.root_context import _create_course
+from nti.analytics.database.root_context import _create_content_package
+
+from nti.analytics.database.users import _cache_user
+from nti.analytics.database.users import _get_user_values
+
+from nti.analytics.identifier import get_ds_id
+from nti.analytics.identifier import get_root_context_id as get_root_context_ds_id
+
+from nti.contenttypes.courses.interfaces import ICourseInstance
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _value_key(value):
+	return value or None
+
+
+def _by_key(objects, get_key):
+	result = {}
+	for obj in objects:
+		key = get_key(obj)
+		if key is not None:
+			result.setdefault(key, obj)
+	return result
+
+
+def _resolve(db, factory, key, objects, get_values, created):
+	"""
+	Resolve the records for the dict of key value to object, upserting
+	the rows (from `get_values(obj)`) of those missing, which are added
+	to `created`. Returns a dict of key value to record.
+	"""
+	result = get_records(db, factory, key, objects) if objects else {}
+	rows = [get_values(obj) for value, obj in objects.items() if value not in result]
+	if rows:
+		new_records = upsert_records(db, factory, key, rows)
+		created.extend(new_records.values())
+		result.update(new_records)
+	return result
+
+
+def _create_records(db, factory, objects, create, created):
+	"""
+	As :func:`_resolve`, for tables we cannot upsert; `create(obj, key)`
+	adds the missing records to our session.
+	"""
+	result = get_records(db, factory, factory.context_ds_id, objects) if objects else {}
+	for value, obj in objects.items():
+		if value not in result:
+			record = result[value] = create(obj, value)
+			created.append(record)
+	return result
+
+
+def resolve_dimensions(db, users=(), resources=(), root_contexts=()):
+	"""
+	Resolve, creating as needed, the records for the given users,
+	resource ntiids and root context objects (courses and books),
+	memoizing them by kind and key within the current resolution memo.
+
+	Returns the number of records created.
+	"""
+	new_users = []
+	user_records = _resolve(db, Users, Users.user_ds_id,
+							_by_key(users, get_ds_id),
+							_get_user_values,
+							new_users)
+
+	new_resources = []
+	resource_records = _resolve(db, Resources, Resources.resource_ds_id,
+								_by_key(resources, _value_key),
+								lambda x: _get_resource_values(x, None),
+								new_resources)
+
+	# Our root contexts draw their ids from a shared pseudo-sequence, so
+	# these are created through our session.
+	courses = [x for x in root_contexts if ICourseInstance.providedBy(x)]
+	books = [x for x in root_contexts if not ICourseInstance.providedBy(x)]
+	new_contexts = []
+	context_records = _create_records(db, Courses,
+									  _by_key(courses, get_root_context_ds_id),
+									  lambda course, key: _create_course(db, course, key),
+									  new_contexts)
+	context_records.update(
+				_create_records(db, Books,
+								_by_key(books, get_root_context_ds_id),
+								lambda book, key: _create_content_package(db, book, key),
+								new_contexts))
+	if new_contexts:
+		# A single flush, such that they have their ids before our events
+		# need them.
+		db.session.flush()
+
+	# Cache our new records, as our get-or-create functions would.
+	for record in new_users:
+		_cache_user(db, record)
+	sync_time = _get_sync_time()
+	for record in new_resources:
+		_cache_resource(db, record, sync_time)
+
+	for kind, records in (('user_record', user_records),
+						  ('resource_record', resource_records),
+						  ('root_context_record', context_records)):
+		for key, record in records.items():
+			memoize(kind, key, record)
+
+	result = len(new_users) + len(new_resources) + len(new_contexts)
+	if result:
+		logger.debug('Created dimension records in bulk (count=%s)', result)
+	return result
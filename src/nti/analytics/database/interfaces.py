@@ -8,6 +8,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from zope import interface
+
 import zope.deferredimport
 zope.deferredimport.initialize()
 
@@ -17,3 +19,10 @@ zope.deferredimport.deprecatedFrom(
     "IAnalyticsDB",
     "IAnalyticsDatabase",
 )
+
+
+class IAnalyticsReplicaDB(interface.Interface):
+    """
+    An analytics db (e.g. an `AnalyticsDB`) of a read-only replica of the
+    site's :class:`IAnalyticsDB`, which our (heavy) reads may use.
+    """
@@ -24,6 +24,8 @@ from nti.dataserver.interfaces import IEnumerableEntityContainer
 
 from nti.analytics.database import get_analytics_db
 
+from nti.analytics.database.profiling import profiled
+
 from nti.analytics.database.users import get_user_db_id
 
 ALL_USERS = 'ALL_USERS'
@@ -110,6 +112,7 @@ def _get_location_data(locations, location_counts):
 	return db_data
 
 
+@profiled
 def get_location_list(course, enrollment_scope=None):
 
 	db = get_analytics_db()
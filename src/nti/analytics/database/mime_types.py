@@ -14,6 +14,8 @@ from nti.analytics_database.mime_types import FileMimeTypes
 
 from nti.analytics.database import get_analytics_db
 
+from nti.analytics.database._upsert import upsert_record
+
 from nti.dataserver.interfaces import ICanvasURLShape
 
 from nti.dataserver.interfaces import ICanvas
@@ -66,6 +68,11 @@ def build_mime_type_records( db, obj, factory ):
 	return result
 
 
+def _create_mime_type(db, mime_type):
+	return upsert_record(db, FileMimeTypes, FileMimeTypes.mime_type,
+						 {'mime_type': mime_type})
+
+
 def get_mime_type_record(db, mime_type, create=True):
 	"""
 	Get the mime type database id, optionally creating it.
@@ -73,8 +80,7 @@ def get_mime_type_record(db, mime_type, create=True):
 	result = db.session.query(FileMimeTypes).filter(
 							  FileMimeTypes.mime_type == mime_type).first()
 	if result is None and create:
-		result = FileMimeTypes( mime_type=mime_type )
-		db.session.add(result)
+		result = _create_mime_type(db, mime_type)
 	return result
 
 
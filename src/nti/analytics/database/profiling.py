@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Opt-in profiling of the SQL our (top-level) analytics calls issue: the
+number of statements, rows and time, per call, flagging statements
+repeated within a call (the per-row lookups of an N+1 pattern).
+
+Profiling is enabled with the `NTI_ANALYTICS_SQL_PROFILING` environment
+variable or :func:`enable_sql_profiling`, after which our jobs (e.g.
+`create_video_event`) and :func:`profiled` functions (e.g.
+`get_location_list`) are profiled, into our metrics. :func:`sql_profile`
+always profiles its block (e.g. for tests).
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import functools
+
+from collections import Counter
+
+from contextlib import contextmanager
+
+from threading import local
+
+from sqlalchemy import event
+
+from sqlalchemy.engine import Engine
+
+from nti.analytics.metrics import get_metrics
+from nti.analytics.metrics import get_function_name
+
+logger = __import__('logging').getLogger(__name__)
+
+SQL_PROFILING = bool(os.getenv('NTI_ANALYTICS_SQL_PROFILING'))
+
+#: Statements issued at least this many times in a single call are flagged.
+REPEATED_STATEMENT_THRESHOLD = 5
+
+_START_TIMES_KEY = 'nti.analytics.sql_profile_start'
+
+_state = local()
+
+_installed = False
+
+
+class SQLProfile(object):
+	"""
+	The SQL issued during a call.
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.statements = 0
+		# As reported by the driver (e.g. not for sqlite selects)
+		self.rows = 0
+		self.elapsed = 0.0
+		self.wall_time = 0.0
+		self.shapes = Counter()
+
+	def record(self, statement, rows, elapsed):
+		self.statements += 1
+		self.rows += max(rows, 0)
+		self.elapsed += elapsed
+		self.shapes[statement] += 1
+
+	def repeated(self, threshold=REPEATED_STATEMENT_THRESHOLD):
+		"""
+		A dict of the statements issued at least `threshold` times to
+		their count.
+		"""
+		return {k: v for k, v in self.shapes.items() if v >= threshold}
+
+
+def _current_profile():
+	return getattr(_state, 'profile', None)
+
+
+def _before_cursor_execute(conn, unused_cursor, unused_statement,
+						   unused_parameters, unused_context, unused_executemany):
+	if _current_profile() is not None:
+		conn.info.setdefault(_START_TIMES_KEY, []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement,
+						  unused_parameters, unused_context, unused_executemany):
+	profile = _current_profile()
+	start_times = conn.info.get(_START_TIMES_KEY)
+	if profile is None or not start_times:
+		return
+	elapsed = time.time() - start_times.pop()
+	profile.record(statement, cursor.rowcount, elapsed)
+
+
+def _install():
+	global _installed
+	if not _installed:
+		event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+		event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+		_installed = True
+
+
+def enable_sql_profiling(enabled=True):
+	global SQL_PROFILING
+	SQL_PROFILING = enabled
+	if enabled:
+		_install()
+
+
+def _report(profile):
+	get_metrics().record_sql_profile(profile)
+	for statement, count in profile.repeated().items():
+		logger.warn('Statement repeated in call, possible N+1 (%s) (count=%s) (%s)',
+					profile.name, count, statement)
+
+
+@contextmanager
+def sql_profile(name):
+	"""
+	Profile the SQL issued within this block, yielding the
+	:class:`SQLProfile`. A nested profile is part of the outermost.
+	"""
+	current = _current_profile()
+	if current is not None:
+		yield current
+		return
+	_install()
+	profile = _state.profile = SQLProfile(name)
+	start = time.time()
+	try:
+		yield profile
+	finally:
+		_state.profile = None
+		profile.wall_time = time.time() - start
+		_report(profile)
+
+
+def profile_call(func, *args, **kwargs):
+	"""
+	Call the function, profiling its SQL if profiling is enabled.
+	"""
+	if not SQL_PROFILING:
+		return func(*args, **kwargs)
+	with sql_profile(get_function_name(func)):
+		return func(*args, **kwargs)
+
+
+def profiled(func):
+	"""
+	A decorator profiling the SQL of the function, if profiling is
+	enabled.
+	"""
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		return profile_call(func, *args, **kwargs)
+	return wrapper
+
+if SQL_PROFILING:
+	_install()
@@ -8,18 +8,40 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import json
+import base64
+import binascii
+
+from datetime import datetime
+
 import six
 
-from nti.analytics.database import get_analytics_db
+from nti.analytics_database.users import Users
 
-from nti.analytics.database.root_context import get_root_context_id
+from nti.analytics.database import RecordPage
+from nti.analytics.database import StreamedRows
+from nti.analytics.database import ProjectedRows
+from nti.analytics.database import STREAM_CHUNK_SIZE
 
-from nti.analytics.database.users import get_user_db_id
+from nti.analytics.database._query_cache import cached_query_rows
+
+from nti.analytics.database.replica import get_analytics_read_db
 
-from nti.contenttypes.courses.interfaces import ICourseSubInstance
+from nti.analytics.database.root_context import get_root_context_ids
 
+from nti.analytics.database.users import get_user_db_id
+
+from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy import cast
 from sqlalchemy import func
 from sqlalchemy import text
+from sqlalchemy import select
+from sqlalchemy import inspect
+from sqlalchemy import Integer
+from sqlalchemy import union_all
+
+from sqlalchemy.orm import Query
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -30,6 +52,68 @@ def _query_factory(session, table):
 	return session.query(table)
 
 
+_CONTINUATION_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _get_page_key(table):
+	"""
+	Return the (mapped) primary key attribute we page on, after timestamp.
+	"""
+	mapper = inspect(table)
+	column = mapper.primary_key[0]
+	return getattr(table, mapper.get_property_by_column(column).key)
+
+
+def _encode_continuation(table, record):
+	key = _get_page_key(table)
+	value = (table.__tablename__,
+			 record.timestamp.strftime(_CONTINUATION_TIME_FORMAT),
+			 getattr(record, key.key))
+	return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+def _decode_continuation(table, continuation):
+	"""
+	Return the (timestamp, primary key) of the last record of the previous
+	page, raising a ValueError for tokens not issued for this table.
+	"""
+	try:
+		value = base64.urlsafe_b64decode(str(continuation))
+		tablename, timestamp, key = json.loads(value.decode('utf-8'))
+		timestamp = datetime.strptime(timestamp, _CONTINUATION_TIME_FORMAT)
+	except (TypeError, ValueError, binascii.Error, UnicodeError):
+		raise ValueError('Invalid continuation (%s)' % continuation)
+	if tablename != table.__tablename__:
+		raise ValueError('Invalid continuation for table (%s) (%s)' %
+						 (table.__tablename__, continuation))
+	return timestamp, key
+
+
+def _get_record_page(table, query, page_size, continuation=None):
+	"""
+	Return a :class:`RecordPage` of (at most) `page_size` records, newest
+	first, following the page ending with the given `continuation`.
+
+	We page on an index (timestamp, primary key) rather than by offset,
+	so that deep pages are as cheap as the first.
+	"""
+	key = _get_page_key(table)
+	query = query.filter(table.timestamp != None)
+	if continuation is not None:
+		timestamp, last_key = _decode_continuation(table, continuation)
+		query = query.filter(or_(table.timestamp < timestamp,
+								 and_(table.timestamp == timestamp,
+									  key < last_key)))
+	query = query.order_by(table.timestamp.desc(), key.desc())
+	# One extra, to know if there are more.
+	records = query.limit(page_size + 1).all()
+	continuation = None
+	if len(records) > page_size:
+		records = records[:page_size]
+		continuation = _encode_continuation(table, records[-1])
+	return RecordPage(records, continuation)
+
+
 def _do_context_and_timestamp_filtering(table,
 									    timestamp=None,
                                         max_timestamp=None,
@@ -40,7 +124,11 @@ def _do_context_and_timestamp_filtering(table,
 									    yield_per=_yield_all_marker,
 									    limit=None,
 									    order_by=None,
-									    query_factory=_query_factory):
+									    query_factory=_query_factory,
+									    page_size=None,
+									    continuation=None,
+									    columns=None,
+									    stream=False):
 	"""
 	A helper func that will build a query (and possibly executing), filtering o
 	n various params.
@@ -53,9 +141,20 @@ def _do_context_and_timestamp_filtering(table,
 	:param course: The course_id to filter on
 	:param root_context: The root_context to filter on. May be a book or course.
 	:param filters: Existing sqlalchemy filters to apply.
+	:param page_size: If given, return a :class:`RecordPage` of at most this
+		many records (newest first), rather than all records; `limit`,
+		`order_by` and `yield_per` do not apply.
+	:param continuation: The `continuation` of the previous page, if any.
+	:param columns: If given, the names of the only columns to fetch, as
+		:class:`ProjectedRows` of named tuples, rather than loading (and
+		resolving) full records; e.g. for callers that only count.
+	:param stream: If True, return :class:`StreamedRows` of a `yield_per`
+		query, which `resolve_objects` resolves lazily, expunging the rows
+		as they are consumed (for callers walking many records).
 	"""
-	db = get_analytics_db()
-	result = []
+	# Our reads may be of the site's replica.
+	db = get_analytics_read_db()
+	result = RecordPage() if page_size else []
 
 	if filters is None:
 		filters = []
@@ -63,16 +162,11 @@ def _do_context_and_timestamp_filtering(table,
 	if course is not None or root_context is not None:
 		if root_context is None:
 			root_context = course
-		context_id = get_root_context_id(db, root_context)
-		context_ids = [context_id]
-
 		# XXX: For courses with super-instances (e.g. History) we want to
 		# aggregate any data that may have been pinned on the super instance
 		# as well. I think we would want this for any scenario.
-		if ICourseSubInstance.providedBy(root_context):
-			parent = root_context.__parent__.__parent__
-			parent_id = get_root_context_id(db, parent)
-			context_ids.append(parent_id)
+		# These lookups are served from our root context record cache.
+		context_ids = get_root_context_ids(db, root_context)
 
 		if context_ids:
 			# TODO: Make this explicit; queries for courses query for
@@ -92,7 +186,18 @@ def _do_context_and_timestamp_filtering(table,
 	if max_timestamp is not None:
 		filters.append(table.timestamp <= max_timestamp)
 
-	query = query_factory(db.session, table).filter(*filters)
+	if columns:
+		if page_size:
+			raise ValueError('Cannot page projected columns')
+		query = db.session.query(*[getattr(table, x) for x in columns])
+	else:
+		query = query_factory(db.session, table)
+	query = query.filter(*filters)
+
+	if page_size:
+		if query_builder:
+			query = query_builder(query)
+		return _get_record_page(table, query, page_size, continuation)
 
 	if order_by is not None:
 		if isinstance(order_by, six.string_types):
@@ -108,12 +213,20 @@ def _do_context_and_timestamp_filtering(table,
 	if query_builder:
 		query = query_builder(query)
 
+	if stream and not columns:
+		if yield_per is _yield_all_marker or not yield_per:
+			yield_per = STREAM_CHUNK_SIZE
+		result = query.yield_per(yield_per).enable_eagerloads(False)
+		return StreamedRows(result)
+
 	if yield_per is _yield_all_marker:
 		result = query.all()
 	elif yield_per > 0:
 		result = query.yield_per(yield_per).enable_eagerloads(False)
 	else:
 		result = query
+	if columns:
+		result = ProjectedRows(result)
 	return result
 
 
@@ -121,7 +234,7 @@ def get_filtered_records(user, table, replies_only=False, filters=None, **kwargs
 	"""
 	Get the filtered records for the given user, table, timestamp (and course).
 	"""
-	result = []
+	result = RecordPage() if kwargs.get('page_size') else []
 	filters = list(filters) if filters else []
 
 	if user is not None:
@@ -225,4 +338,113 @@ def get_record_count_by_user(table, root_context=None, filters=None, **kwargs):
 				  query_factory=(count_by(table.user_id)),
 				  order_by=text('count DESC'))
 
-	return get_filtered_records(None, table, **kwargs)
+	result = get_filtered_records(None, table, **kwargs)
+	if isinstance(result, Query):
+		result = cached_query_rows('%s_by_user' % table.__tablename__,
+								   result, (table,))
+	return result
+
+
+#: The dialects we can bucket timestamps on.
+_TIMESTAMP_BUCKET_DIALECTS = ('mysql', 'sqlite')
+
+
+def _get_timestamp_bucket(dialect, column, bucket):
+	"""
+	Return the expression bucketing the timestamp column by `weekday`
+	(0 is Monday, as in python), `hour` or `date`.
+	"""
+	if dialect == 'mysql':
+		if bucket == 'weekday':
+			return func.weekday(column)
+		if bucket == 'hour':
+			return func.hour(column)
+		if bucket == 'date':
+			return func.date(column)
+	elif dialect == 'sqlite':
+		if bucket == 'weekday':
+			# Sunday is 0 here
+			return (cast(func.strftime('%w', column), Integer) + 6) % 7
+		if bucket == 'hour':
+			return cast(func.strftime('%H', column), Integer)
+		if bucket == 'date':
+			return func.date(column)
+	raise ValueError('Unsupported timestamp bucket (%s) (%s)' % (dialect, bucket))
+
+
+def _get_bucket_value(bucket, value):
+	if bucket == 'date' and isinstance(value, six.string_types):
+		# sqlite dates are strings
+		value = datetime.strptime(value, '%Y-%m-%d').date()
+	return value
+
+
+def _get_query_table(query):
+	return query.column_descriptions[0]['entity']
+
+
+def _union_column(queries, label):
+	"""
+	Return the UNION ALL of the given single column queries, as a
+	subquery whose column is named `label`.
+	"""
+	statements = []
+	for query in queries:
+		column = query.column_descriptions[0]['expr']
+		statements.append(query.with_entities(column.label(label)).statement)
+	return union_all(*statements).alias('events')
+
+
+def get_timestamp_bucket_counts(queries, buckets):
+	"""
+	Given queries of a single timestamp column (e.g. those of
+	`get_filtered_records` with `columns` and no `yield_per`), count
+	their rows, together, by the given timestamp `buckets` (see
+	:func:`_get_timestamp_bucket`) on the database.
+
+	Returns a dict of bucket value tuples to count, or None if our database
+	cannot bucket timestamps.
+	"""
+	db = get_analytics_read_db()
+	dialect = db.engine.name
+	if dialect not in _TIMESTAMP_BUCKET_DIALECTS:
+		return None
+	if not queries:
+		return {}
+
+	events = _union_column(queries, 'timestamp')
+
+	columns = [_get_timestamp_bucket(dialect, events.c.timestamp, x).label(x)
+			   for x in buckets]
+	statement = select(columns + [func.count().label('count')]).group_by(*columns)
+
+	tables = [_get_query_table(x) for x in queries]
+	result = {}
+	for row in cached_query_rows('timestamp_bucket_counts', statement, tables):
+		key = tuple(_get_bucket_value(bucket, value)
+					for bucket, value in zip(buckets, row))
+		result[key] = row[-1]
+	return result
+
+
+def get_user_counts(queries, limit=None):
+	"""
+	Given queries of a single `user_id` column, count their rows, together,
+	by user on the database, most active first.
+
+	Returns a list of (at most `limit`) (user_ds_id, count) tuples, of the
+	users that still exist.
+	"""
+	if not queries:
+		return []
+	events = _union_column(queries, 'user_id')
+	count = func.count().label('count')
+	statement = select([Users.user_ds_id, count])
+	statement = statement.select_from(events.join(Users, Users.user_id == events.c.user_id))
+	statement = statement.where(Users.user_ds_id != None)
+	statement = statement.group_by(Users.user_id, Users.user_ds_id)
+	statement = statement.order_by(count.desc())
+	if limit:
+		statement = statement.limit(limit)
+	tables = [_get_query_table(x) for x in queries] + [Users]
+	return cached_query_rows('user_counts', statement, tables)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Routing of our reads to a site's read-only replica, if any, such that
+heavy reports do not contend with our ingestion on the primary.
+
+We read from the primary instead if:
+
+* there is no replica registered alongside the site's primary (in the
+  same registry), or it cannot be reached;
+* the current transaction has written to the primary; or
+* within :func:`read_your_writes`, for callers that must see writes
+  (committed on the primary) that the replica may not have yet.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from contextlib import contextmanager
+
+from threading import local
+
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import text
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from zope import component
+
+from zope.cachedescriptors.property import Lazy
+
+from nti.analytics_database import Base
+
+from nti.analytics_database.database import AnalyticsDB
+
+from nti.analytics_database.interfaces import IAnalyticsDB
+
+from nti.analytics.database import get_analytics_db
+
+from nti.analytics.database._writes import get_written_tables
+
+from nti.analytics.database.interfaces import IAnalyticsReplicaDB
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The seconds for which we trust our last check that a replica can be
+#: reached.
+REPLICA_CHECK_INTERVAL = 30
+
+#: The seconds within which we expect a replica to have applied the
+#: commits made on its primary.
+REPLICA_LAG = 10
+
+_state = local()
+
+#: Replica db to the (time, result) of our last check.
+_replica_checks = WeakKeyDictionary()
+
+
+@contextmanager
+def read_your_writes():
+	"""
+	Within this context, all our reads are of the primary.
+	"""
+	_state.depth = getattr(_state, 'depth', 0) + 1
+	try:
+		yield
+	finally:
+		_state.depth -= 1
+
+
+def _requires_primary():
+	return getattr(_state, 'depth', 0) > 0
+
+
+def _ping(db):
+	connection = db.engine.connect()
+	try:
+		connection.execute(text('SELECT 1'))
+	finally:
+		connection.close()
+
+
+def _is_available(db):
+	"""
+	Whether the replica can be reached, as of our check within the last
+	`REPLICA_CHECK_INTERVAL` seconds.
+	"""
+	now = time.time()
+	checked = _replica_checks.get(db)
+	if checked is not None and now - checked[0] < REPLICA_CHECK_INTERVAL:
+		return checked[1]
+	try:
+		_ping(db)
+		available = True
+	except SQLAlchemyError:
+		logger.exception('Analytics replica unavailable, reading from primary (%s)',
+						 getattr(db, 'dburi', db))
+		available = False
+	_replica_checks[db] = (now, available)
+	return available
+
+
+class _ReplicaMetadata(object):
+	"""
+	The metadata of a replica's tables, which (unlike our primary's) we
+	never create.
+	"""
+
+	def __init__(self):
+		self.metadata = getattr(Base, 'metadata')
+
+
+class AnalyticsReplicaDB(AnalyticsDB):
+	"""
+	A read-only replica of an analytics db, against which we never run
+	DDL.
+	"""
+
+	def __init__(self, dburi, **kwargs):
+		kwargs['autocommit'] = False
+		super(AnalyticsReplicaDB, self).__init__(dburi=dburi, **kwargs)
+
+	@Lazy
+	def metadata(self):
+		return _ReplicaMetadata()
+
+
+def get_analytics_replica_db():
+	"""
+	The replica of the site's primary analytics db: the replica
+	registered in the same registry as the primary, such that a site's
+	primary is never read through another site's (or a global) replica.
+	"""
+	for registry in component.getSiteManager().utilities.ro:
+		if registry.registered((), IAnalyticsDB) is not None:
+			return registry.registered((), IAnalyticsReplicaDB)
+	return None
+
+
+def get_analytics_read_db(strict=True):
+	"""
+	Return the analytics db our reads should use: the site's replica,
+	unless we must (or can only) read from the primary.
+	"""
+	primary = get_analytics_db(strict=strict)
+	if _requires_primary():
+		return primary
+	replica = get_analytics_replica_db()
+	if replica is None or replica is primary or not _is_available(replica):
+		return primary
+	if primary is not None and get_written_tables(primary.session):
+		return primary
+	return replica
@@ -23,6 +23,8 @@ from nti.analytics.database import resolve_objects
 from nti.analytics.database import get_analytics_db
 from nti.analytics.database import should_update_event
 
+from nti.analytics.database._query_cache import cached_query_rows
+
 from nti.analytics.database._utils import get_context_path
 from nti.analytics.database._utils import get_root_context_records
 
@@ -337,7 +339,7 @@ def get_watched_segments_for_ntiid( resource_ntiid, user=None, course=None, **kw
 									 yield_per=None, #give us the query so we can group_by
 									 **kwargs )
 		query = query.group_by('start', 'end')
-		results = query.all()
+		results = cached_query_rows('watched_segments', query, (VideoEvents,))
 		
 	return results
 
@@ -10,48 +10,119 @@ from __future__ import absolute_import
 
 from nti.analytics_database.resources import Resources
 
+from nti.analytics.common import memoized
+from nti.analytics.common import get_memoized
+from nti.analytics.common import _get_site_sync_time
+
 from nti.analytics.database import get_analytics_db
 
+from nti.analytics.database._cache import DatabaseCaches
+from nti.analytics.database._cache import get_record_id
+from nti.analytics.database._cache import merge_cached_record
+
+from nti.analytics.database._upsert import upsert_record
+
 from nti.ntiids import ntiids
 
 logger = __import__('logging').getLogger(__name__)
 
+#: The maximum number of resources cached (per analytics db).
+RESOURCE_CACHE_SIZE = 50000
+
+_CACHED_COLUMNS = ('resource_ds_id', 'resource_display_name', 'max_time_length')
+
+#: A cache of `resource_ds_id` to our cached `Resources` columns, along
+#: with the content sync time we last checked the display name
+#: (`display_name_checked`).
+_resource_caches = DatabaseCaches(RESOURCE_CACHE_SIZE)
+
+#: Display names of cached records not (yet) checked.
+_NOT_CHECKED = -1
+
+
+def _get_sync_time():
+	return _get_site_sync_time() or 0
+
+
+def _get_cached_resource(db, state):
+	state = dict(state)
+	state.pop('display_name_checked')
+	return merge_cached_record(db, Resources, state)
+
+
+def _cache_resource(db, record, display_name_checked):
+	state = {name: getattr(record, name) for name in _CACHED_COLUMNS}
+	state['display_name_checked'] = display_name_checked
+
+	def _factory():
+		resource_id = get_record_id(record)
+		if resource_id is not None:
+			return dict(state, resource_id=resource_id)
+		return None
+	_resource_caches(db).set(record.resource_ds_id, factory=_factory)
+
 
 def _get_resource_display_name(resource_val):
-	content_unit = ntiids.find_object_with_ntiid(resource_val)
+	content_unit = memoized('ntiid', resource_val, ntiids.find_object_with_ntiid)
 	display_name = getattr(content_unit, 'label', None)
 	if display_name:
 		display_name = display_name[:256]
 	return display_name
 
 
+def _get_resource_values(resource_val, max_time_length):
+	return {'resource_ds_id': resource_val,
+			'resource_display_name': _get_resource_display_name(resource_val),
+			'max_time_length': max_time_length}
+
+
 def _create_resource(db, resource_val, max_time_length):
-	display_name = _get_resource_display_name(resource_val)
-	new_resource = Resources(resource_ds_id=resource_val,
-							 resource_display_name=display_name,
-							 max_time_length=max_time_length)
+	# Concurrent workers may create the same resource; our upsert
+	# returns whichever row won.
+	values = _get_resource_values(resource_val, max_time_length)
+	return upsert_record(db, Resources, Resources.resource_ds_id, values)
+
+
+def _should_update_max_time_length(old_max_time_length, max_time_length):
+	# To reduce churn, only update this if it changes considerably.
+	return 	max_time_length \
+		and (	old_max_time_length is None \
+			 or abs(old_max_time_length - max_time_length) > 4)
+
 
-	db.session.add(new_resource)
-	return new_resource
+def _find_resource(db, resource_val):
+	result = get_memoized('resource_record', resource_val)
+	if result is None:
+		result = db.session.query(Resources).filter(
+								  Resources.resource_ds_id == resource_val).first()
+	return result
 
 
 def _get_or_create_resource(db, resource_val, max_time_length):
-	found_resource = db.session.query(Resources).filter(
-									Resources.resource_ds_id == resource_val).first()
+	sync_time = _get_sync_time()
+	state = _resource_caches(db).get(resource_val)
+	if 		state is not None \
+		and state['display_name_checked'] >= sync_time \
+		and not _should_update_max_time_length(state['max_time_length'], max_time_length):
+		# Nothing to update.
+		return _get_cached_resource(db, state)
+
+	found_resource = _find_resource(db, resource_val)
 	if found_resource is not None:
-		# Always update fields (to fix possible issues)
-		display_name = _get_resource_display_name(resource_val)
-		if 		display_name \
-			and found_resource.resource_display_name != display_name:
-			found_resource.resource_display_name = display_name
-		if 		max_time_length \
-			and (	found_resource.max_time_length is None \
-				 or abs(found_resource.max_time_length - max_time_length) > 4):
-			# To reduce churn, only update this if it changes considerably.
+		# Update fields (to fix possible issues); display names only
+		# change with content, so check them once per sync.
+		if state is None or state['display_name_checked'] < sync_time:
+			display_name = _get_resource_display_name(resource_val)
+			if 		display_name \
+				and found_resource.resource_display_name != display_name:
+				found_resource.resource_display_name = display_name
+		if _should_update_max_time_length(found_resource.max_time_length, max_time_length):
 			logger.debug('Updating resource max_time_length (%s) (old=%s) (new=%s)',
 						resource_val, found_resource.max_time_length, max_time_length)
 			found_resource.max_time_length = max_time_length
-	return found_resource or _create_resource(db, resource_val, max_time_length)
+	result = found_resource or _create_resource(db, resource_val, max_time_length)
+	_cache_resource(db, result, sync_time)
+	return result
 
 
 def get_resource_record(db, resource_val, create=False, max_time_length=None):
@@ -61,8 +132,12 @@ def get_resource_record(db, resource_val, create=False, max_time_length=None):
 	if create:
 		resource = _get_or_create_resource(db, resource_val, max_time_length)
 	else:
-		resource = db.session.query(Resources).filter(
-									Resources.resource_ds_id == resource_val).first()
+		state = _resource_caches(db).get(resource_val)
+		if state is not None:
+			return _get_cached_resource(db, state)
+		resource = _find_resource(db, resource_val)
+		if resource is not None:
+			_cache_resource(db, resource, _NOT_CHECKED)
 	return resource
 
 
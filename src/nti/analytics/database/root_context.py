@@ -15,8 +15,14 @@ from nti.analytics_database.root_context import Books
 from nti.analytics_database.root_context import Courses
 from nti.analytics_database.root_context import _RootContextId
 
+from nti.analytics.common import get_memoized
+from nti.analytics.common import _get_site_sync_time
 from nti.analytics.common import get_root_context_name
 
+from nti.analytics.database._cache import DatabaseCaches
+from nti.analytics.database._cache import get_record_id
+from nti.analytics.database._cache import merge_cached_record
+
 from nti.analytics.identifier import get_root_context_object
 from nti.analytics.identifier import get_root_context_id as get_root_context_ds_id
 
@@ -24,6 +30,46 @@ from nti.app.products.courseware_ims import get_course_sourcedid
 
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
 from nti.contenttypes.courses.interfaces import ICourseInstance
+from nti.contenttypes.courses.interfaces import ICourseSubInstance
+
+#: The maximum number of root context records cached (per analytics db).
+ROOT_CONTEXT_CACHE_SIZE = 5000
+
+_CACHED_COLUMNS = ('context_ds_id', 'context_name', 'context_long_name')
+
+#: Caches of `context_ds_id` to our cached `Courses` (and `Books`) columns,
+#: along with the content sync time we last updated the record
+#: (`updated`); fully populated records need no further updates.
+_course_caches = DatabaseCaches(ROOT_CONTEXT_CACHE_SIZE)
+_book_caches = DatabaseCaches(ROOT_CONTEXT_CACHE_SIZE)
+
+#: Cached records that need no (further) updates.
+_POPULATED = float('inf')
+
+#: Cached records not (yet) updated.
+_NOT_UPDATED = -1
+
+
+def _get_sync_time():
+	return _get_site_sync_time() or 0
+
+
+def _get_cached_record(db, factory, state):
+	state = dict(state)
+	state.pop('updated')
+	return merge_cached_record(db, factory, state)
+
+
+def _cache_record(db, caches, record, updated):
+	state = {name: getattr(record, name) for name in _CACHED_COLUMNS}
+	state['updated'] = updated
+
+	def _factory():
+		context_id = get_record_id(record)
+		if context_id is not None:
+			return dict(state, context_id=context_id)
+		return None
+	caches(db).set(record.context_ds_id, factory=_factory)
 
 
 def _get_next_id_record(db):
@@ -102,6 +148,15 @@ def _create_content_package( db, content_package, context_ds_id ):
 	return book
 
 
+def _is_course_populated( course_record ):
+	return	course_record.context_long_name is not None \
+		and (  course_record.start_date is not None \
+			or course_record.end_date is not None \
+			or course_record.duration is not None ) \
+		and (  course_record.term is not None \
+			or course_record.crn is not None )
+
+
 def _update_course( course_record, course ):
 	# Lazy populate new fields
 	if course_record.context_long_name is None:
@@ -124,20 +179,54 @@ def _update_course( course_record, course ):
 		course_record.crn = getattr( course_sid, 'CRN', None )
 
 
+def _find_record( db, factory, context_ds_id ):
+	result = get_memoized( 'root_context_record', context_ds_id )
+	if not isinstance( result, factory ):
+		result = db.session.query(factory).filter(
+								  factory.context_ds_id == context_ds_id ).first()
+	return result
+
+
 def _get_or_create_course( db, course, context_ds_id ):
-	found_course = db.session.query(Courses).filter(
-								Courses.context_ds_id == context_ds_id ).first()
+	# Lazily populated fields may come with new content, so records not
+	# fully populated are updated at most once per sync.
+	sync_time = _get_sync_time()
+	state = _course_caches(db).get(context_ds_id)
+	if state is not None and state['updated'] >= sync_time:
+		return _get_cached_record( db, Courses, state )
+
+	found_course = _find_record( db, Courses, context_ds_id )
 	if found_course is not None:
 		_update_course( found_course, course )
 
-	return found_course or _create_course( db, course, context_ds_id )
+	result = found_course or _create_course( db, course, context_ds_id )
+	updated = _POPULATED if _is_course_populated( result ) else sync_time
+	_cache_record( db, _course_caches, result, updated )
+	return result
 
 
 def _get_or_create_content_package( db, context_object, context_ds_id ):
-	found_content_package = db.session.query(Books).filter(
-										Books.context_ds_id == context_ds_id ).first()
-	return found_content_package \
+	state = _book_caches(db).get(context_ds_id)
+	if state is not None:
+		return _get_cached_record( db, Books, state )
+
+	found_content_package = _find_record( db, Books, context_ds_id )
+	result = found_content_package \
 		or _create_content_package( db, context_object, context_ds_id )
+	_cache_record( db, _book_caches, result, _POPULATED )
+	return result
+
+
+def _get_root_context_record( db, factory, caches, context_ds_id ):
+	state = caches(db).get(context_ds_id)
+	if state is not None:
+		return _get_cached_record( db, factory, state )
+
+	result = _find_record( db, factory, context_ds_id )
+	if result is not None:
+		# Our first create call will update this.
+		_cache_record( db, caches, result, _NOT_UPDATED )
+	return result
 
 
 def get_root_context_record(db, context_object, create=False):
@@ -157,11 +246,11 @@ def get_root_context_record(db, context_object, create=False):
 			root_context_object = _get_or_create_content_package(db, context_object, context_ds_id)
 	else:
 		if ICourseInstance.providedBy(context_object):
-			root_context_object = db.session.query(Courses).filter(
-												Courses.context_ds_id == context_ds_id).first()
+			root_context_object = _get_root_context_record(db, Courses,
+														   _course_caches, context_ds_id)
 		else:
-			root_context_object = db.session.query(Books).filter(
-												Books.context_ds_id == context_ds_id).first()
+			root_context_object = _get_root_context_record(db, Books,
+														   _book_caches, context_ds_id)
 	return root_context_object
 
 
@@ -175,12 +264,26 @@ def get_root_context_id(db, context_object, create=False):
 		return result.context_id
 
 
+def get_root_context_ids(db, context_object):
+	"""
+	Retrieves the db ids for the given root context object, along with
+	that of its parent course for course sub-instances (which may have
+	data pinned on it).
+	"""
+	result = [get_root_context_id(db, context_object)]
+	if ICourseSubInstance.providedBy(context_object):
+		parent = context_object.__parent__.__parent__
+		result.append(get_root_context_id(db, parent))
+	return result
+
+
 def delete_course( context_ds_id ):
 	db = get_analytics_db()
 	found_course = db.session.query(Courses).filter(
 								Courses.context_ds_id == context_ds_id ).first()
 	if found_course is not None:
 		found_course.context_ds_id = None
+	_course_caches(db).invalidate(context_ds_id)
 
 
 def get_root_context(context_id):
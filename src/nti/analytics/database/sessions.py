@@ -22,6 +22,8 @@ from nti.analytics.common import timestamp_type
 from nti.analytics.database import get_analytics_db
 from nti.analytics.database import resolve_objects
 
+from nti.analytics.database._upsert import upsert_record
+
 from nti.analytics.database.locations import check_ip_location
 
 from nti.analytics.database.query_utils import get_filtered_records
@@ -35,9 +37,8 @@ logger = __import__('logging').getLogger(__name__)
 
 
 def _create_user_agent(db, user_agent):
-	new_agent = UserAgents(user_agent=user_agent)
-	db.session.add(new_agent)
-	return new_agent
+	return upsert_record(db, UserAgents, UserAgents.user_agent,
+						 {'user_agent': user_agent})
 
 
 def _get_user_agent(db, user_agent):
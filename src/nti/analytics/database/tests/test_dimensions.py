@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import not_none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+from nti.analytics_database.resources import Resources
+
+from nti.analytics_database.sessions import UserAgents
+
+from nti.analytics.common import get_memoized
+from nti.analytics.common import resolution_memo
+
+from nti.analytics.database._upsert import upsert_record
+
+from nti.analytics.database.dimensions import resolve_dimensions
+
+from nti.analytics.database.resources import get_resource_record
+
+from nti.analytics.database.sessions import _get_user_agent
+
+from nti.analytics.database.users import create_user
+from nti.analytics.database.users import get_user_record
+
+from nti.analytics.tests import test_user_ds_id
+from nti.analytics.tests import AnalyticsTestBase
+
+
+class TestDimensions(AnalyticsTestBase):
+
+	def _resolve(self):
+		return resolve_dimensions(self.db,
+								  users=(test_user_ds_id, 2001, 2001),
+								  resources=('ntiid:one', 'ntiid:two', None))
+
+	def test_resolve_dimensions(self):
+		with resolution_memo():
+			# Our existing user is not created again
+			assert_that( self._resolve(), is_( 3 ) )
+			assert_that( self._resolve(), is_( 0 ) )
+
+			user = get_memoized( 'user_record', 2001 )
+			assert_that( user.user_id, not_none() )
+			assert_that( get_user_record( 2001 ), same_instance( user ) )
+			assert_that( get_memoized( 'user_record', test_user_ds_id ).user_id,
+						 is_( self.db_user.user_id ) )
+
+			resource = get_memoized( 'resource_record', 'ntiid:one' )
+			assert_that( resource.resource_id, not_none() )
+			assert_that( get_resource_record( self.db, 'ntiid:one' ),
+						 same_instance( resource ) )
+			assert_that( self.session.query( Resources ).all(), has_length( 2 ) )
+
+		# Nothing is memoized outside of our memo
+		assert_that( get_memoized( 'user_record', 2001 ), none() )
+
+	def test_upsert(self):
+		agent = _get_user_agent( self.db, 'webapp-1.9' )
+		created = []
+		result = upsert_record( self.db, UserAgents, UserAgents.user_agent,
+								{'user_agent': 'webapp-1.9'}, created )
+		assert_that( result.user_agent_id, is_( agent.user_agent_id ) )
+		assert_that( self.session.query( UserAgents ).all(), has_length( 1 ) )
+		assert_that( created, has_length( 0 ) )
+
+		result = upsert_record( self.db, UserAgents, UserAgents.user_agent,
+								{'user_agent': 'new-agent'}, created )
+		assert_that( created, has_length( 1 ) )
+		assert_that( created[0], same_instance( result ) )
+
+		# As if created by a concurrent worker
+		user = create_user( test_user_ds_id )
+		assert_that( user.user_id, is_( self.db_user.user_id ) )
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_entries
+from hamcrest import same_instance
+
+from nti.analytics_database.users import Users
+
+from nti.analytics.common import _do_execute_job
+from nti.analytics.common import _do_execute_batch
+
+from nti.analytics.database import profiling
+
+from nti.analytics.database.profiling import profiled
+from nti.analytics.database.profiling import sql_profile
+
+from nti.analytics.database.users import get_user
+
+from nti.analytics.metrics import get_metrics
+
+from nti.analytics.tests import AnalyticsTestBase
+from nti.analytics.tests import assert_max_statements
+
+
+def _get_users(count):
+	for _ in range(count):
+		get_user(1)
+
+
+@profiled
+def _profiled_get_users(count):
+	_get_users(count)
+
+
+class TestProfiling(AnalyticsTestBase):
+
+	def setUp(self):
+		super(TestProfiling, self).setUp()
+		# Nothing pending to flush within our profiles
+		self.session.flush()
+
+	def test_profile(self):
+		with sql_profile('outer') as profile:
+			self.session.query(Users).all()
+			with sql_profile('inner') as inner:
+				_get_users(5)
+			assert_that(inner, same_instance(profile))
+		assert_that(profile.statements, is_(6))
+		assert_that(profile.wall_time >= profile.elapsed, is_(True))
+		# Our N+1
+		repeated = profile.repeated()
+		assert_that(repeated, has_length(1))
+		assert_that(list(repeated.values()), is_([5]))
+
+	def test_profiled(self):
+		get_metrics().reset()
+		_profiled_get_users(1)
+		assert_that(get_metrics().sql, has_length(0))
+
+		profiling.enable_sql_profiling()
+		try:
+			_profiled_get_users(5)
+		finally:
+			profiling.enable_sql_profiling(False)
+		snapshot = get_metrics().snapshot()['sql']
+		assert_that(snapshot, has_length(1))
+		assert_that(list(snapshot.values())[0],
+					has_entries('repeated', 1,
+								'statements', has_entries('total', 5)))
+
+	def test_batch(self):
+		get_metrics().reset()
+		jobs = [(_get_users, {'count': 1}) for _ in range(5)]
+		profiling.enable_sql_profiling()
+		try:
+			_do_execute_job(_do_execute_batch, jobs)
+		finally:
+			profiling.enable_sql_profiling(False)
+		# Each op is profiled on its own; the batch is not an N+1
+		snapshot = get_metrics().snapshot()['sql']
+		assert_that(snapshot, has_length(1))
+		assert_that(list(snapshot.values())[0],
+					has_entries('repeated', 0,
+								'statements', has_entries('count', 5,
+														  'total', 5)))
+
+	def test_max_statements(self):
+		with assert_max_statements(2):
+			_get_users(2)
+
+		def _too_many():
+			with assert_max_statements(2):
+				_get_users(3)
+		assert_that(calling(_too_many), raises(AssertionError))
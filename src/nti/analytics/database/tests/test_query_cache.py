@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+from datetime import datetime
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
+from hamcrest import has_length
+from hamcrest import has_entries
+from hamcrest import assert_that
+
+from nti.analytics_database.resource_views import ResourceViews
+
+from nti.analytics.database import resource_views as db_views
+
+from nti.analytics.database._query_cache import _query_caches
+from nti.analytics.database._query_cache import QueryResultCache
+
+from nti.analytics.metrics import get_metrics
+
+from nti.analytics.tests import test_session_id
+from nti.analytics.tests import AnalyticsTestBase
+
+
+class TestQueryResultCache(unittest.TestCase):
+
+	def test_cache(self):
+		cache = QueryResultCache(2)
+		assert_that(cache.set('a', (1,), ('a',)), is_(0))
+		assert_that(cache.set('b', (1,), ('b',)), is_(0))
+		assert_that(cache.get('a', (1,)), is_(('a',)))
+		# Least recently used
+		assert_that(cache.set('c', (1,), ('c',)), is_(1))
+		assert_that(cache.get('b', (1,)), none())
+		assert_that(len(cache), is_(2))
+		# Past its watermark
+		assert_that(cache.get('a', (2,)), none())
+		assert_that(len(cache), is_(1))
+
+
+class TestQueryCache(AnalyticsTestBase):
+
+	def setUp(self):
+		super(TestQueryCache, self).setUp()
+		_query_caches.clear()
+		get_metrics().reset()
+		self.timestamp = datetime(2010, 1, 1)
+		self._view(self.db_user, 'ntiid:one')
+		self._view(self.db_user, 'ntiid:two')
+		self.session.flush()
+
+	def _view(self, user, ntiid):
+		db_views.create_course_resource_view(user, test_session_id,
+											 self.timestamp, self.course_record,
+											 ['dashboard'], ntiid, 30)
+
+	def _counts(self):
+		return dict(db_views.get_resource_views_by_user())
+
+	def _metrics(self, **kwargs):
+		metrics = get_metrics().snapshot()['query_cache']['resource_views_by_user']
+		assert_that(metrics, has_entries(**kwargs))
+
+	def test_by_user(self):
+		user_id = self.db_user.user_id
+		assert_that(self._counts(), is_({user_id: 2}))
+		assert_that(self._counts(), is_({user_id: 2}))
+		self._metrics(misses=1, hits=1)
+
+		# New rows move our watermark
+		self._view(2001, 'ntiid:one')
+		self.session.flush()
+		counts = self._counts()
+		assert_that(counts, has_length(2))
+		assert_that(counts, has_entries(user_id, 2))
+		self._metrics(misses=2, hits=1)
+
+		# As do (heartbeat) updates by other processes
+		table = ResourceViews.__table__
+		self.session.connection().execute(
+				table.update().where(table.c.user_id == user_id).values(time_length=45))
+		assert_that(self._counts(), has_length(2))
+		self._metrics(misses=3, hits=1)
+		assert_that(self._counts(), has_length(2))
+		self._metrics(misses=3, hits=2)
+
+		# Our own pending changes are never cached
+		record = self.session.query(ResourceViews).first()
+		record.time_length = 60
+		assert_that(self._counts(), has_length(2))
+		self._metrics(misses=3, hits=2, bypassed=1)
+
+		# Nor do we serve results from before our (bulk) deletes
+		self.session.query(ResourceViews).filter(
+							ResourceViews.user_id == user_id).delete()
+		counts = self._counts()
+		assert_that(counts, has_length(1))
+		assert_that(counts, is_not(has_key(user_id)))
+		self._metrics(hits=2)
@@ -10,11 +10,17 @@ from __future__ import absolute_import
 
 from zope import component
 
+from hamcrest import is_
 from hamcrest import assert_that
 from hamcrest import has_entries
 
 from sqlalchemy.orm.query import Query
 
+from nti.analytics.database import StreamedRows
+from nti.analytics.database import ProjectedRows
+from nti.analytics.database import iter_objects
+from nti.analytics.database import resolve_objects
+
 from nti.analytics.database.database import AnalyticsDB
 
 from nti.analytics.database.interfaces import IAnalyticsDB
@@ -22,7 +28,9 @@ from nti.analytics.database.interfaces import IAnalyticsDB
 from nti.analytics.database.query_utils import _do_context_and_timestamp_filtering
 
 from nti.analytics.database.sessions import Sessions
+from nti.analytics.database.sessions import create_session
 
+from nti.analytics.tests import test_user_ds_id
 from nti.analytics.tests import AnalyticsTestBase
 
 
@@ -55,3 +63,35 @@ class TestQueryUtils(AnalyticsTestBase):
                         has_entries('stream_results', True,
                                     'max_row_buffer', 10))
 
+
+    def test_query_utils_projected_columns(self):
+        results = _do_context_and_timestamp_filtering(Sessions,
+                                                      columns=('session_id',))
+        assert_that(isinstance(results, ProjectedRows), True)
+        assert_that(resolve_objects(None, results), is_(results))
+
+    def test_query_utils_streamed(self):
+        for idx in range(5):
+            create_session(test_user_ds_id, 'webapp-1.9', 1000 + idx, '156.110.241.13')
+        self.session.flush()
+        session_ids = [x.session_id for x in self.session.query(Sessions)]
+
+        results = _do_context_and_timestamp_filtering(Sessions, stream=True)
+        assert_that(isinstance(results, StreamedRows), True)
+        results = resolve_objects(lambda x: x.session_id, results)
+        assert_that(isinstance(results, list), False)
+        assert_that(sorted(results), is_(sorted(session_ids)))
+
+        # Our rows are expunged as they are consumed
+        def _in_session():
+            return [x for x in self.session.identity_map.values()
+                    if isinstance(x, Sessions)]
+        results = _do_context_and_timestamp_filtering(Sessions, stream=True)
+        results = iter_objects(lambda x: x, results, chunk_size=2)
+        first = next(results)
+        assert_that(first in self.session, True)
+        next(results)
+        next(results)
+        assert_that(first in self.session, False)
+        list(results)
+        assert_that(_in_session(), is_([]))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import shutil
+import tempfile
+
+import fudge
+
+from datetime import datetime
+
+from hamcrest import is_
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+from sqlalchemy.exc import OperationalError
+
+from zope import component
+
+from zope.component.hooks import site
+
+from zope.interface.registry import Components
+
+from nti.analytics_database.database import AnalyticsDB
+
+from nti.analytics_database.interfaces import IAnalyticsDB
+
+from nti.analytics_database.resource_views import ResourceViews
+
+from nti.analytics.database import resource_views as db_views
+
+from nti.analytics.database._query_cache import _query_caches
+
+from nti.analytics.database._writes import _table_commit_times
+
+from nti.analytics.database.interfaces import IAnalyticsReplicaDB
+
+from nti.analytics.database.replica import _replica_checks
+from nti.analytics.database.replica import read_your_writes
+from nti.analytics.database.replica import get_analytics_read_db
+
+from nti.analytics.database.root_context import _create_course
+
+from nti.analytics.metrics import get_metrics
+
+from nti.analytics.tests import test_session_id
+from nti.analytics.tests import AnalyticsTestBase
+
+
+class _Site(object):
+
+	def __init__(self, registry):
+		self.registry = registry
+
+	def getSiteManager(self):
+		return self.registry
+
+
+class TestReplica(AnalyticsTestBase):
+	"""
+	Two sqlite files stand in for our primary and (never replicated)
+	replica.
+	"""
+
+	def setUp(self):
+		super(TestReplica, self).setUp()
+		self.tmpdir = tempfile.mkdtemp()
+		gsm = component.getGlobalSiteManager()
+		self.primary = AnalyticsDB(dburi='sqlite:///%s' % os.path.join(self.tmpdir, 'primary.db'),
+								   autocommit=True)
+		gsm.registerUtility(self.primary, IAnalyticsDB)
+		self.replica = AnalyticsDB(dburi='sqlite:///%s' % os.path.join(self.tmpdir, 'replica.db'),
+								   autocommit=True)
+		gsm.registerUtility(self.replica, IAnalyticsReplicaDB)
+
+		course_record = _create_course(self.primary, object(), self.course_id)
+		db_views.create_course_resource_view(self.db_user.user_ds_id,
+											 test_session_id,
+											 datetime(2010, 1, 1),
+											 course_record,
+											 ['dashboard'],
+											 'ntiid:resource',
+											 30)
+
+	def tearDown(self):
+		gsm = component.getGlobalSiteManager()
+		gsm.unregisterUtility(self.replica, IAnalyticsReplicaDB)
+		gsm.unregisterUtility(self.primary, IAnalyticsDB)
+		gsm.registerUtility(self.db, IAnalyticsDB)
+		self.primary.session.close()
+		self.replica.session.close()
+		_replica_checks.clear()
+		_query_caches.clear()
+		shutil.rmtree(self.tmpdir)
+		super(TestReplica, self).tearDown()
+
+	def _views(self):
+		return db_views.get_resource_views_by_user()
+
+	def test_routing(self):
+		# Our pending view is read from the primary
+		assert_that(get_analytics_read_db(), same_instance(self.primary))
+		assert_that(self._views(), is_([(1, 1)]))
+		assert_that(self.primary.session.query(ResourceViews).count(), is_(1))
+
+		# Once committed, we read from our replica
+		assert_that(get_analytics_read_db(), same_instance(self.replica))
+		assert_that(self._views(), is_([]))
+
+		# Unless we must read our writes
+		with read_your_writes():
+			assert_that(get_analytics_read_db(), same_instance(self.primary))
+			assert_that(self._views(), is_([(1, 1)]))
+		assert_that(get_analytics_read_db(), same_instance(self.replica))
+
+	def test_site_primary(self):
+		self.primary.session.flush()
+		assert_that(get_analytics_read_db(), same_instance(self.replica))
+
+		# A site with its own primary never reads through our replica
+		registry = Components(bases=(component.getGlobalSiteManager(),))
+		registry.registerUtility(self.db, IAnalyticsDB)
+		with site(_Site(registry)):
+			assert_that(get_analytics_read_db(), same_instance(self.db))
+
+			# Only its own
+			registry.registerUtility(self.replica, IAnalyticsReplicaDB)
+			assert_that(get_analytics_read_db(), same_instance(self.replica))
+
+	@fudge.patch('nti.analytics.database.replica._ping')
+	def test_unavailable(self, mock_ping):
+		self.primary.session.flush()
+		mock_ping.expects_call().raises(OperationalError('SELECT 1', {}, None))
+		assert_that(get_analytics_read_db(), same_instance(self.primary))
+		assert_that(self._views(), is_([(1, 1)]))
+		# We do not check again, for now
+		assert_that(get_analytics_read_db(), same_instance(self.primary))
+
+	def test_lagging_replica_not_cached(self):
+		self.primary.session.flush()
+		_query_caches.clear()
+		get_metrics().reset()
+		tablename = ResourceViews.__tablename__
+		# Our replica has not applied our commit yet; its result is not
+		# cached (under our new version of the table)
+		assert_that(self._views(), is_([]))
+		assert_that(len(_query_caches(self.replica)), is_(0))
+		metrics = get_metrics().snapshot()['query_cache']['%s_by_user' % tablename]
+		assert_that(metrics['bypassed'], is_(1))
+
+		# Once it has, presumably, we cache again
+		_table_commit_times[tablename] = 0
+		assert_that(self._views(), is_([]))
+		assert_that(self._views(), is_([]))
+		assert_that(len(_query_caches(self.replica)), is_(1))
@@ -10,6 +10,11 @@ __docformat__ = "restructuredtext en"
 import time
 
 from datetime import datetime
+from datetime import timedelta
+
+import fudge
+
+import transaction
 
 from hamcrest import is_
 from hamcrest import none
@@ -17,14 +22,20 @@ from hamcrest import contains
 from hamcrest import not_none
 from hamcrest import has_length
 from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import raises
 
 from nti.analytics.database.tests import test_user_ds_id
 from nti.analytics.database.tests import test_session_id
 from nti.analytics.database.tests import AnalyticsTestBase
 
+from nti.analytics.database import resources as db_resources
 from nti.analytics.database import resource_views as db_views
 
 from nti.analytics.database.resources import Resources
+from nti.analytics.database.resources import get_resource_record
+
+from nti.analytics.database.query_utils import get_filtered_records
 
 from nti.analytics.database.resource_views import ResourceViews
 from nti.analytics.database.resource_views import VideoEvents
@@ -89,6 +100,55 @@ class TestCourseResources(AnalyticsTestBase):
 		assert_that( resource_view.resource_id, is_( self.resource_id ) )
 		assert_that( resource_view.time_length, is_( new_time_length ) )
 
+	def test_resource_view_pages(self):
+		event_time = datetime(2016, 1, 1)
+		# Two views share a timestamp
+		times = [event_time + timedelta(seconds=x) for x in (0, 1, 1, 2, 3)]
+		for idx, timestamp in enumerate( times ):
+			db_views.create_course_resource_view(self.db_user,
+												test_session_id, timestamp,
+												self.course_record, self.context_path,
+												'ntiid:course_resource%s' % idx, 30 )
+
+		seen = []
+		continuation = None
+		for expected in (2, 2, 1):
+			page = get_filtered_records( test_user_ds_id, ResourceViews,
+										 page_size=2, continuation=continuation )
+			assert_that( page, has_length( expected ) )
+			seen.extend( page )
+			continuation = page.continuation
+		assert_that( continuation, none() )
+		assert_that( [x.timestamp for x in seen], is_( sorted( times, reverse=True ) ) )
+		assert_that( set( x.resource_id for x in seen ), has_length( 5 ) )
+
+		# Our resolved views keep their place
+		page = db_views.get_user_resource_views( test_user_ds_id, self.course_record,
+												 page_size=3 )
+		assert_that( page, has_length( 3 ) )
+		page = db_views.get_user_resource_views( test_user_ds_id, self.course_record,
+												 page_size=3, continuation=page.continuation )
+		assert_that( page, has_length( 2 ) )
+		assert_that( page.continuation, none() )
+
+		assert_that( calling( get_filtered_records ).with_args( test_user_ds_id, VideoEvents,
+																page_size=2,
+																continuation='bad' ),
+					 raises( ValueError ) )
+
+	def test_resource_view_columns(self):
+		event_time = datetime(2016, 1, 1)
+		db_views.create_course_resource_view(self.db_user,
+											test_session_id, event_time,
+											self.course_record, self.context_path,
+											'ntiid:course_resource', 30 )
+		# Projected rows are not resolved
+		rows = db_views.get_user_resource_views( test_user_ds_id, self.course_record,
+												 columns=('timestamp', 'time_length') )
+		rows = [x for x in rows]
+		assert_that( rows, contains( (event_time, 30) ) )
+		assert_that( rows[0].timestamp, is_( event_time ) )
+
 	def test_resources(self):
 		results = self.session.query( Resources ).all()
 		assert_that( results, has_length( 0 ) )
@@ -124,6 +184,38 @@ class TestCourseResources(AnalyticsTestBase):
 		results = self.session.query( Resources ).all()
 		assert_that( results, has_length( 2 ) )
 
+	@fudge.patch('nti.analytics.database.resources._get_resource_display_name',
+				 'nti.analytics.database.resources._get_sync_time')
+	def test_resource_cache(self, mock_display_name, mock_sync_time):
+		calls = []
+		def _display_name(resource_val):
+			calls.append(resource_val)
+			return 'label'
+		mock_display_name.is_callable().calls(_display_name)
+		sync_times = [0]
+		mock_sync_time.is_callable().calls(lambda: sync_times[-1])
+
+		try:
+			resource_val = 'ntiid:cached_resource'
+			record = get_resource_record(self.db, resource_val, create=True)
+			self.session.flush()
+			transaction.commit()
+			assert_that( calls, has_length( 1 ) )
+			assert_that( db_resources._resource_caches( self.db ), has_length( 1 ) )
+
+			# Cache hits do not re-check the display name
+			cached = get_resource_record(self.db, resource_val, create=True)
+			assert_that( cached.resource_id, is_( record.resource_id ) )
+			assert_that( cached.resource_display_name, is_( 'label' ) )
+			assert_that( calls, has_length( 1 ) )
+
+			# Until our content is synced
+			sync_times.append( time.time() )
+			get_resource_record(self.db, resource_val, create=True)
+			assert_that( calls, has_length( 2 ) )
+		finally:
+			transaction.abort()
+
 	def test_video_view(self):
 		results = db_views.get_user_video_views( test_user_ds_id, self.course_record )
 		results = [x for x in results]
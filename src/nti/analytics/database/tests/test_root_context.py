@@ -7,13 +7,16 @@ __docformat__ = "restructuredtext en"
 # disable: accessing protected members, too many methods
 # pylint: disable=W0212,R0904
 
+import time
 import fudge
 import unittest
+import transaction
 
 from datetime import timedelta
 
 from zope import component
 
+from hamcrest import is_
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import greater_than
@@ -24,9 +27,13 @@ from nti.contenttypes.courses.courses import CourseInstance
 from nti.analytics.database.interfaces import IAnalyticsDB
 from nti.analytics.database.database import AnalyticsDB
 
+from nti.analytics.database import root_context as db_root_context
+
 from nti.analytics.database.root_context import Courses
 from nti.analytics.database.root_context import _create_course
+from nti.analytics.database.root_context import _get_or_create_course
 from nti.analytics.database.root_context import _get_next_id_record
+from nti.analytics.database.root_context import _update_course as update_course
 
 class MockCatalog(object):
 
@@ -62,6 +69,38 @@ class TestRootContext(unittest.TestCase):
 		assert_that( results[0].context_id, not_none() )
 		assert_that( results[0].duration, not_none() )
 
+	@fudge.patch('nti.analytics.database.root_context._course_catalog',
+				 'nti.analytics.database.root_context._update_course',
+				 'nti.analytics.database.root_context._get_sync_time')
+	def test_course_cache(self, mock_course_catalog, mock_update_course, mock_sync_time):
+		mock_course_catalog.is_callable().returns( MockCatalog( timedelta( weeks=16 )) )
+		updates = []
+		def _update_course( course_record, course ):
+			updates.append( course_record )
+			update_course( course_record, course )
+		mock_update_course.is_callable().calls( _update_course )
+		sync_times = [0]
+		mock_sync_time.is_callable().calls( lambda: sync_times[-1] )
+		try:
+			my_course = CourseInstance()
+			record = _get_or_create_course( self.db, my_course, 1856 )
+			self.session.flush()
+			context_id = record.context_id
+			transaction.commit()
+			assert_that( db_root_context._course_caches( self.db ), has_length( 1 ) )
+
+			# Cache hits are not updated
+			cached = _get_or_create_course( self.db, my_course, 1856 )
+			assert_that( cached.context_id, is_( context_id ) )
+			assert_that( updates, has_length( 0 ) )
+
+			# Until our content is synced (our record is not fully populated)
+			sync_times.append( time.time() )
+			_get_or_create_course( self.db, my_course, 1856 )
+			assert_that( updates, has_length( 1 ) )
+		finally:
+			transaction.abort()
+
 	def test_next_id(self):
 		id1 = _get_next_id_record( self.db )
 		self.session.flush()
@@ -7,6 +7,12 @@ __docformat__ = "restructuredtext en"
 # disable: accessing protected members, too many methods
 # pylint: disable=W0212,R0904
 
+import time
+
+from datetime import datetime
+
+import transaction
+
 from zope import component
 
 from hamcrest import is_
@@ -21,6 +27,8 @@ from nti.analytics.database.interfaces import IAnalyticsDB
 from nti.analytics.database import users as db_users
 
 from nti.analytics.database.users import Users
+from nti.analytics.database.users import get_user_db_id
+from nti.analytics.database.users import get_user_record
 from nti.analytics.database.users import get_or_create_user
 from nti.analytics.database.users import update_user_research
 
@@ -92,3 +100,32 @@ class TestUsers(AnalyticsTestBase):
 		self.session.add( new_user )
 		self.session.flush()
 
+	def test_user_cache(self):
+		cache = db_users._user_caches( self.db )
+		fooser = 2001
+		self.session.add( Users( user_ds_id=fooser, username='fooser',
+								 username2='fooser2',
+								 create_date=datetime.utcfromtimestamp( time.time() ) ) )
+		self.session.flush()
+		transaction.commit()
+
+		# Not cached until committed; rolled back entries never are.
+		get_user_record( fooser )
+		assert_that( cache, has_length( 0 ) )
+		transaction.abort()
+		assert_that( cache, has_length( 0 ) )
+
+		get_user_record( fooser )
+		self.session.flush()
+		transaction.commit()
+		assert_that( cache, has_length( 1 ) )
+
+		hits = cache.hits
+		record = get_or_create_user( fooser )
+		assert_that( cache.hits, is_( hits + 1 ) )
+		assert_that( record.username, is_( 'fooser' ) )
+		assert_that( get_user_db_id( fooser ), is_( record.user_id ) )
+
+		update_user_research( fooser, True )
+		assert_that( cache, has_length( 0 ) )
+		transaction.abort()
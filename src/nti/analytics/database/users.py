@@ -12,10 +12,17 @@ from zope import component
 
 from nti.analytics_database.users import Users
 
+from nti.analytics.common import get_memoized
 from nti.analytics.common import get_created_timestamp
 
 from nti.analytics.database import get_analytics_db
 
+from nti.analytics.database._cache import DatabaseCaches
+from nti.analytics.database._cache import get_record_id
+from nti.analytics.database._cache import merge_cached_record
+
+from nti.analytics.database._upsert import upsert_record
+
 from nti.analytics.identifier import get_ds_id
 from nti.analytics.identifier import get_ds_object
 
@@ -25,6 +32,56 @@ from nti.dataserver.interfaces import IUsernameSubstitutionPolicy
 
 logger = __import__('logging').getLogger(__name__)
 
+#: The maximum number of users cached (per analytics db).
+USER_CACHE_SIZE = 20000
+
+#: The `Users` columns we cache. Others (e.g. `allow_research`) are
+#: loaded on access.
+_CACHED_COLUMNS = ('user_id', 'user_ds_id', 'username', 'username2', 'create_date')
+
+#: A cache of `user_ds_id` to our cached `Users` columns.
+_user_caches = DatabaseCaches(USER_CACHE_SIZE)
+
+
+def _get_cached_state(db, uid):
+	return _user_caches(db).get(uid) if uid is not None else None
+
+
+def _get_cached_user(db, uid):
+	"""
+	Return a `Users` record for the given ds id from our cache, without
+	querying, if possible.
+	"""
+	state = _get_cached_state(db, uid)
+	if state is None:
+		return None
+	return merge_cached_record(db, Users, state)
+
+
+def _cache_user(db, record):
+	"""
+	Cache the given record, once our transaction commits. New records
+	do not have their id until then.
+	"""
+	uid = record.user_ds_id
+	if 		uid is None \
+		or	record.username2 is None \
+		or 	record.create_date is None:
+		# Lazily built fields; we want to go through the db for these.
+		return
+	state = {name: getattr(record, name) for name in _CACHED_COLUMNS if name != 'user_id'}
+
+	def _factory():
+		user_id = get_record_id(record)
+		if user_id is not None:
+			return dict(state, user_id=user_id)
+		return None
+	_user_caches(db).set(uid, factory=_factory)
+
+
+def _invalidate_user(db, uid):
+	_user_caches(db).invalidate(uid)
+
 
 def _get_username2(user):
 	"""
@@ -38,8 +95,10 @@ def _get_username2(user):
 	return result
 
 
-def create_user(user):
-	db = get_analytics_db()
+def _get_user_values(user):
+	"""
+	Return the `Users` column values for the given user.
+	"""
 	# We may have non-IUsers here, but let's keep them since we may need
 	# them (e.g. community owned forums).
 	username = getattr(user, 'username', None)
@@ -53,29 +112,39 @@ def create_user(user):
 	username2 = _get_username2(user) or username
 	create_date = get_created_timestamp(user)
 
-	user = Users(user_ds_id=uid,
-				 allow_research=allow_research,
-				 username=username,
-				 username2=username2,
-				 create_date=create_date)
-
-	# For race conditions, let's just throw since we cannot really handle retrying
-	# gracefully at this level. A job-level retry should work though.
-	db.session.add(user)
-	logger.info('Created user (user=%s) (user_id=%s) (user_ds_id=%s)',
-				username, user.user_id, uid)
+	return {'user_ds_id': uid,
+			'allow_research': allow_research,
+			'username': username,
+			'username2': username2,
+			'create_date': create_date}
+
+
+def create_user(user):
+	db = get_analytics_db()
+	values = _get_user_values(user)
+	# Concurrent workers may create the same user; our upsert returns
+	# whichever row won.
+	created = []
+	user = upsert_record(db, Users, Users.user_ds_id, values, created)
+	if created:
+		logger.info('Created user (user=%s) (user_id=%s) (user_ds_id=%s)',
+					user.username, user.user_id, user.user_ds_id)
+	_cache_user(db, user)
 	return user
 
 
 def get_user_record(user):
-	# Look into using sqlalchemy baked queries for this
-	# and other high volume calls that return a single row.
-	# This is still considered experimental for 1.0.0.
+	# This is called for nearly every event; committed users are cached
+	# by ds id.
 	if isinstance(user, Users):
 		return user
 	db = get_analytics_db()
 	uid = get_ds_id(user)
-	found_user = db.session.query(Users).filter(Users.user_ds_id == uid).first()
+	found_user = _get_cached_user(db, uid) or get_memoized('user_record', uid)
+	if found_user is None:
+		found_user = db.session.query(Users).filter(Users.user_ds_id == uid).first()
+		if found_user is not None:
+			_cache_user(db, found_user)
 	return found_user
 
 
@@ -93,6 +162,10 @@ def get_or_create_user(user):
 
 
 def get_user_db_id(user):
+	if not isinstance(user, Users):
+		state = _get_cached_state(get_analytics_db(), get_ds_id(user))
+		if state is not None:
+			return state['user_id']
 	found_user = get_user_record(user)
 	return found_user and found_user.user_id
 
@@ -117,6 +190,7 @@ def delete_entity(entity_ds_id):
 								  Users.user_ds_id == entity_ds_id).first()
 	if found_user is not None:
 		found_user.user_ds_id = None
+	_invalidate_user(db, entity_ds_id)
 
 
 def update_user_research(user_ds_id, allow_research):
@@ -125,4 +199,5 @@ def update_user_research(user_ds_id, allow_research):
 								  Users.user_ds_id == user_ds_id).first()
 	if found_user is not None:
 		found_user.allow_research = allow_research
+	_invalidate_user(db, user_ds_id)
 
@@ -8,7 +8,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import functools
+
 from zope import component
+from zope import interface
+
+from zope.component.zcml import utility
+
+from zope.schema import TextLine
 
 from nti.dataserver.interfaces import IDataserverClosedEvent
 
@@ -16,6 +23,10 @@ from nti.analytics_database.database import AnalyticsDB
 
 from nti.analytics_database.interfaces import IAnalyticsDB
 
+from nti.analytics.database.interfaces import IAnalyticsReplicaDB
+
+from nti.analytics.database.replica import AnalyticsReplicaDB
+
 logger = __import__('logging').getLogger(__name__)
 
 import zope.deferredimport
@@ -35,3 +46,22 @@ def _closed_dataserver(unused_event):
     logger.info('Resetting AnalyticsDB')
     db = AnalyticsDB(dburi='sqlite://', testmode=True, defaultSQLite=True)
     component.getSiteManager().registerUtility(db, IAnalyticsDB)
+
+
+class IRegisterAnalyticsReplicaDB(interface.Interface):
+    """
+    The arguments needed for registering a read-only analytics replica.
+    """
+    dburi = TextLine(title=u"The db uri of the replica",
+                     required=True)
+
+
+def registerAnalyticsReplicaDB(_context, dburi):
+    """
+    Register the replica in the registry of our configuration (e.g. a
+    site's), alongside the primary db registered there by
+    `registerAnalyticsDB`.
+    """
+    logger.info("Registering analytics replica db")
+    factory = functools.partial(AnalyticsReplicaDB, dburi=dburi)
+    utility(_context, provides=IAnalyticsReplicaDB, factory=factory)
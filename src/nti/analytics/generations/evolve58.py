@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+generation 58.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+generation = 58
+
+from zope import component
+
+from zope.component.hooks import site
+from zope.component.hooks import setHooks
+
+from zope.intid.interfaces import IIntIds
+
+from nti.analytics import QUEUE_NAMES
+from nti.analytics import PARTITIONED_QUEUES
+
+from nti.asynchronous import queue
+from nti.asynchronous.interfaces import IQueue
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def install_queue_partitions(ds_folder):
+	"""
+	Register any missing partitions of our partitioned `IQueue` queues.
+	Redis queues need no installation. Returns the number of queues added.
+	"""
+	result = 0
+	with site(ds_folder):
+		lsm = ds_folder.getSiteManager()
+		intids = lsm.getUtility(IIntIds)
+		for name in QUEUE_NAMES:
+			if name in PARTITIONED_QUEUES:
+				continue
+			base_names = [x for x in PARTITIONED_QUEUES
+						  if name.startswith(x + '++')]
+			if not base_names:
+				continue
+			if component.queryUtility(IQueue, name=base_names[0]) is None:
+				# Not using persistent queues
+				continue
+			if component.queryUtility(IQueue, name=name) is not None:
+				continue
+			new_queue = queue.Queue()
+			new_queue.__parent__ = ds_folder
+			new_queue.__name__ = name
+			intids.register(new_queue)
+			lsm.registerUtility(new_queue, provided=IQueue, name=name)
+			result += 1
+	return result
+
+
+def do_evolve(context):
+	setHooks()
+	conn = context.connection
+	root = conn.root()
+	ds_folder = root['nti.dataserver']
+	count = install_queue_partitions(ds_folder)
+	logger.info('Finished analytics evolve (%s) (partitions=%s)',
+				generation, count)
+
+
+def evolve(context):
+	"""
+	Evolve to generation 58 by installing our queue partitions.
+	"""
+	do_evolve(context)
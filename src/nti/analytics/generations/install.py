@@ -9,7 +9,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-generation = 57
+generation = 58
 
 from zope.generations.generations import SchemaManager
 
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+A lightweight, in-process registry of analytics job metrics.
+
+Queued jobs are stamped with their queue name and enqueue time. We track,
+per queue: jobs enqueued, sampled depth, wait time (enqueue to execution),
+commit latency (enqueue to commit) and failures. Per job function, we
+track execution time and failures. Per cached report query, we track
+result cache hits, misses and evictions. Per profiled call, we track
+the statements, rows and time of its SQL.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from collections import defaultdict
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The queue name used for events processed immediately (not queued).
+IMMEDIATE_QUEUE_NAME = 'immediate'
+
+
+class TimerStats(object):
+	"""
+	Count, total, and max of a series of durations (in seconds), or of
+	other values.
+	"""
+
+	__slots__ = ('count', 'total', 'max')
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+	def to_dict(self):
+		return {'count': self.count,
+				'total': self.total,
+				'mean': self.mean,
+				'max': self.max}
+
+
+class QueueMetrics(object):
+
+	def __init__(self):
+		self.enqueued = 0
+		self.executed = 0
+		self.failed = 0
+		self.depth = None
+		self.depth_sampled = None
+		self.wait = TimerStats()
+		self.commit_latency = TimerStats()
+
+	def to_dict(self):
+		return {'enqueued': self.enqueued,
+				'executed': self.executed,
+				'failed': self.failed,
+				'depth': self.depth,
+				'depth_sampled': self.depth_sampled,
+				'wait': self.wait.to_dict(),
+				'commit_latency': self.commit_latency.to_dict()}
+
+
+class FunctionMetrics(object):
+
+	def __init__(self):
+		self.failed = 0
+		self.execution = TimerStats()
+
+	def to_dict(self):
+		return {'failed': self.failed,
+				'execution': self.execution.to_dict()}
+
+
+class QueryCacheMetrics(object):
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.bypassed = 0
+		self.uncached = 0
+		self.evicted = 0
+
+	def to_dict(self):
+		return {'hits': self.hits,
+				'misses': self.misses,
+				'bypassed': self.bypassed,
+				'uncached': self.uncached,
+				'evicted': self.evicted}
+
+
+class SQLMetrics(object):
+	"""
+	Per profiled call, its SQL statements, rows and time (in seconds), and
+	the number of calls repeating a statement.
+	"""
+
+	def __init__(self):
+		self.statements = TimerStats()
+		self.rows = TimerStats()
+		self.elapsed = TimerStats()
+		self.repeated = 0
+
+	def to_dict(self):
+		return {'statements': self.statements.to_dict(),
+				'rows': self.rows.to_dict(),
+				'elapsed': self.elapsed.to_dict(),
+				'repeated': self.repeated}
+
+
+class AnalyticsMetrics(object):
+	"""
+	Our registry of queue, job function, query cache and SQL metrics.
+	"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.started = time.time()
+		self.queues = defaultdict(QueueMetrics)
+		self.functions = defaultdict(FunctionMetrics)
+		self.query_cache = defaultdict(QueryCacheMetrics)
+		self.sql = defaultdict(SQLMetrics)
+
+	def record_enqueue(self, queue_name):
+		self.queues[queue_name or IMMEDIATE_QUEUE_NAME].enqueued += 1
+
+	def record_depth(self, queue_name, depth):
+		metrics = self.queues[queue_name]
+		metrics.depth = depth
+		metrics.depth_sampled = time.time()
+
+	def record_job(self, queue_name, enqueue_time, failed=False, now=None):
+		now = time.time() if now is None else now
+		metrics = self.queues[queue_name or IMMEDIATE_QUEUE_NAME]
+		metrics.executed += 1
+		if failed:
+			metrics.failed += 1
+		if enqueue_time is not None:
+			metrics.wait.add(max(now - enqueue_time, 0))
+
+	def record_failure(self, queue_name):
+		"""
+		Record the failure of an op within a (committed) batch job.
+		"""
+		self.queues[queue_name or IMMEDIATE_QUEUE_NAME].failed += 1
+
+	def record_commit(self, queue_name, enqueue_time, success, now=None):
+		now = time.time() if now is None else now
+		metrics = self.queues[queue_name or IMMEDIATE_QUEUE_NAME]
+		if not success:
+			metrics.failed += 1
+		elif enqueue_time is not None:
+			metrics.commit_latency.add(max(now - enqueue_time, 0))
+
+	def record_execution(self, func_name, elapsed, failed=False):
+		metrics = self.functions[func_name]
+		metrics.execution.add(elapsed)
+		if failed:
+			metrics.failed += 1
+
+	def record_query_cache(self, name, outcome, count=1):
+		"""
+		Record a query cache `outcome` (`hits`, `misses`, `bypassed`,
+		`uncached` or `evicted`) for the named query.
+		"""
+		metrics = self.query_cache[name]
+		setattr(metrics, outcome, getattr(metrics, outcome) + count)
+
+	def record_sql_profile(self, profile):
+		metrics = self.sql[profile.name]
+		metrics.statements.add(profile.statements)
+		metrics.rows.add(profile.rows)
+		metrics.elapsed.add(profile.elapsed)
+		if profile.repeated():
+			metrics.repeated += 1
+
+	def snapshot(self):
+		"""
+		Return a (json-able) dict of our current metrics.
+		"""
+		return {'started': self.started,
+				'queues': {k: v.to_dict() for k, v in self.queues.items()},
+				'functions': {k: v.to_dict() for k, v in self.functions.items()},
+				'query_cache': {k: v.to_dict() for k, v in self.query_cache.items()},
+				'sql': {k: v.to_dict() for k, v in self.sql.items()}}
+
+_metrics = AnalyticsMetrics()
+
+
+def get_metrics():
+	return _metrics
+
+
+def get_function_name(func):
+	func = getattr(func, 'im_func', func)
+	module = getattr(func, '__module__', None)
+	name = getattr(func, '__name__', None) or repr(func)
+	return '%s.%s' % (module, name) if module else name
+
+
+def get_queue_name(queue):
+	for attr in ('__name__', '_name', 'name'):
+		result = getattr(queue, attr, None)
+		if result:
+			return result
+	return None
+
+
+def sample_queue_depths(factory=None):
+	"""
+	Record the current depth of each of our queues, returning a dict of
+	queue name to depth.
+	"""
+	# Avoid import cycle
+	from nti.analytics import QUEUE_NAMES
+	from nti.analytics import get_factory
+	factory = get_factory() if factory is None else factory
+	result = {}
+	for name in QUEUE_NAMES:
+		try:
+			queue = factory.get_queue(name)
+			depth = len(queue)
+		except (ValueError, TypeError):
+			# Missing or unsized (immediate) queues
+			continue
+		_metrics.record_depth(name, depth)
+		result[name] = depth
+	return result
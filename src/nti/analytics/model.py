@@ -15,6 +15,9 @@ from zope.annotation.factory import factory as an_factory
 
 from zope.interface.interfaces import ObjectEvent
 
+from nti.analytics.codec import reduce_event
+from nti.analytics.codec import get_event_tag
+
 from nti.analytics.interfaces import VIDEO_SKIP
 from nti.analytics.interfaces import VIDEO_WATCH
 
@@ -62,8 +65,20 @@ def _replace_state(obj, old, new):
             obj.__dict__[new] = value
 
 
+class _CompactPickleMixin(object):
+    """
+    Pickle (e.g. when queued in a job) in our compact wire format. Types
+    unknown to the codec pickle as usual.
+    """
+
+    def __reduce_ex__(self, protocol):
+        if get_event_tag(self) is None:
+            return super(_CompactPickleMixin, self).__reduce_ex__(protocol)
+        return reduce_event(self)
+
+
 @WithRepr
-class ViewEvent(SchemaConfigured):
+class ViewEvent(_CompactPickleMixin, SchemaConfigured):
 
     __external_can_create__ = True
     time_length = alias('Duration')
@@ -188,7 +203,7 @@ class TopicViewEvent(RootContextEvent):
 
 
 @interface.implementer(IVideoPlaySpeedChangeEvent)
-class VideoPlaySpeedChangeEvent(SchemaConfigured):
+class VideoPlaySpeedChangeEvent(_CompactPickleMixin, SchemaConfigured):
     createDirectFieldProperties(IVideoPlaySpeedChangeEvent)
 
     __external_can_create__ = True
@@ -8,6 +8,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from collections import OrderedDict
+
 from zope import component
 
 from zope.event import notify
@@ -21,6 +23,7 @@ from nti.analytics import CATALOG_VIEW_ANALYTICS
 from nti.analytics import RESOURCE_VIEW_ANALYTICS
 
 from nti.analytics import get_factory
+from nti.analytics import get_partitioned_queue
 from nti.analytics import get_current_username
 
 from nti.analytics.interfaces import IVideoEvent
@@ -38,11 +41,16 @@ from nti.analytics.interfaces import IProfileActivityViewEvent
 from nti.analytics.interfaces import IProfileMembershipViewEvent
 from nti.analytics.interfaces import AnalyticsEventValidationError
 
+from nti.analytics.common import memoized
 from nti.analytics.common import get_entity
 from nti.analytics.common import process_event
+from nti.analytics.common import process_events
+from nti.analytics.common import with_resolution_memo
 
 from nti.analytics.sessions import get_nti_session_id
 
+from nti.analytics.database import get_analytics_db
+
 from nti.analytics.database import blogs as db_blogs
 from nti.analytics.database import boards as db_boards
 from nti.analytics.database import enrollments as db_enrollments
@@ -52,6 +60,8 @@ from nti.analytics.database import assessments as db_assess_views
 from nti.analytics.database import profile_views as db_profile_views
 from nti.analytics.database import surveys as db_survey_views
 
+from nti.analytics.database.dimensions import resolve_dimensions
+
 from nti.analytics.database.users import get_user
 
 from nti.analytics.recorded import VideoSkipRecordedEvent
@@ -108,21 +118,30 @@ def get_active_users_with_video_views(**kwargs):
 			yield user, count
 
 
-def _get_course( event ):
-	__traceback_info__ = event.RootContextID
-	result = find_object_with_ntiid( event.RootContextID )
+def _find_object( ntiid ):
+	return memoized( 'ntiid', ntiid, find_object_with_ntiid )
+
+
+def _find_course( ntiid ):
+	result = _find_object( ntiid )
 	# Global course info objects have an HTML ntiid
 	if result is None:
 		catalog = component.queryUtility(ICourseCatalog)
 		if catalog is not None:
-			result = catalog.getCatalogEntry(event.RootContextID)
+			result = catalog.getCatalogEntry(ntiid)
 	# Course catalog views may resolve to catalog entries
 	# If not a course, return what we have (e.g. ContentPackage)
 	return ICourseInstance( result, result )
 
 
+def _get_course( event ):
+	__traceback_info__ = event.RootContextID
+	# Resolved during validation and again by our handlers.
+	return memoized( 'course', event.RootContextID, _find_course )
+
+
 def _get_root_context( event ):
-	result = find_object_with_ntiid( event.RootContextID )
+	result = _find_object( event.RootContextID )
 	if not IEntity.providedBy( result ):
 		result = _get_course( event )
 	return result
@@ -137,7 +156,7 @@ def _validate_analytics_event( event, object_id=None ):
 		# Ideally, we need to capture all id related data
 		# before the event is queued, but that is no guarantee
 		# that the event gets to us in time.
-		obj = find_object_with_ntiid( object_id )
+		obj = _find_object( object_id )
 		if obj is None:
 			raise UnrecoverableAnalyticsError(
 						'Event received for deleted object (id=%s) (event=%s)' %
@@ -270,7 +289,7 @@ def _add_note_event( event, nti_session=None ):
 
 	user = get_entity( event.user )
 	root_context = _get_root_context( event )
-	note = find_object_with_ntiid( event.note_id )
+	note = _find_object( event.note_id )
 	db_resource_tags.create_note_view(
 								user,
 								nti_session,
@@ -298,7 +317,7 @@ def _add_topic_event( event, nti_session=None ):
 
 	user = get_entity( event.user )
 	root_context = _get_root_context( event )
-	topic = find_object_with_ntiid( event.topic_id )
+	topic = _find_object( event.topic_id )
 
 	db_boards.create_topic_view(user,
 								nti_session,
@@ -327,7 +346,7 @@ def _add_blog_event( event, nti_session=None ):
 		return
 
 	user = get_entity( event.user )
-	blog = find_object_with_ntiid( event.blog_id )
+	blog = _find_object( event.blog_id )
 
 	db_blogs.create_blog_view(	user,
 								nti_session,
@@ -562,93 +581,285 @@ def _add_profile_membership_event( event, nti_session=None ):
 						   ProfileMembershipViewedRecordedEvent )
 
 
-def _get_profile_queue():
+def _get_profile_queue(partition_key=None):
 	factory = get_factory()
 	return factory.get_queue( SOCIAL_ANALYTICS )
 
 
-def _get_resource_queue():
-	factory = get_factory()
-	return factory.get_queue( RESOURCE_VIEW_ANALYTICS )
+def _get_resource_queue(partition_key=None):
+	return get_partitioned_queue( RESOURCE_VIEW_ANALYTICS, partition_key )
 
 
-def _get_video_queue():
-	factory = get_factory()
-	return factory.get_queue( VIDEO_VIEW_ANALYTICS )
+def _get_video_queue(partition_key=None):
+	return get_partitioned_queue( VIDEO_VIEW_ANALYTICS, partition_key )
 
 
-def _get_catalog_queue():
+def _get_catalog_queue(partition_key=None):
 	factory = get_factory()
 	return factory.get_queue( CATALOG_VIEW_ANALYTICS )
 
 
-def _get_topic_queue():
+def _get_topic_queue(partition_key=None):
 	factory = get_factory()
 	return factory.get_queue( TOPIC_VIEW_ANALYTICS )
 
 
-def _get_blog_queue():
+def _get_blog_queue(partition_key=None):
 	factory = get_factory()
 	return factory.get_queue( BLOG_VIEW_ANALYTICS )
 
 
-def _get_note_queue():
+def _get_note_queue(partition_key=None):
 	factory = get_factory()
 	return factory.get_queue( NOTE_VIEW_ANALYTICS )
 
 
-def handle_events(batch_events, return_invalid=True, handled=None):
+def _get_event_processor(event):
+	"""
+	Return the (queue getter, handler) pair for the given event, or None
+	if we do not handle such events.
+	"""
+	if INoteViewEvent.providedBy( event ):
+		return _get_note_queue, _add_note_event
+	elif IBlogViewEvent.providedBy( event ):
+		return _get_blog_queue, _add_blog_event
+	elif ITopicViewEvent.providedBy( event ):
+		return _get_topic_queue, _add_topic_event
+	elif IVideoEvent.providedBy( event ):
+		return _get_video_queue, _add_video_event
+	elif ISelfAssessmentViewEvent.providedBy( event ):
+		return _get_resource_queue, _add_self_assessment_event
+	elif IAssignmentViewEvent.providedBy( event ):
+		return _get_resource_queue, _add_assignment_event
+	elif ISurveyViewEvent.providedBy( event ):
+		return _get_resource_queue, _add_survey_event
+	elif IResourceEvent.providedBy( event ):
+		return _get_resource_queue, _add_resource_event
+	elif ICourseCatalogViewEvent.providedBy( event ):
+		return _get_catalog_queue, _add_catalog_event
+	elif IVideoPlaySpeedChangeEvent.providedBy( event ):
+		return _get_video_queue, _add_play_speed_event
+	elif IProfileActivityViewEvent.providedBy( event ):
+		return _get_profile_queue, _add_profile_activity_event
+	elif IProfileMembershipViewEvent.providedBy( event ):
+		return _get_profile_queue, _add_profile_membership_event
+	elif IProfileViewEvent.providedBy( event ):
+		return _get_profile_queue, _add_profile_event
+	return None
+
+
+def _get_event_resource_id(event):
+	"""
+	Return the ntiid of the resource record the given event refers to,
+	if any.
+	"""
+	if 		ISelfAssessmentViewEvent.providedBy( event ) \
+		or	IAssignmentViewEvent.providedBy( event ) \
+		or	ISurveyViewEvent.providedBy( event ):
+		return getattr( event, 'content_id', None )
+	elif	IResourceEvent.providedBy( event ) \
+		or	IVideoEvent.providedBy( event ) \
+		or	IVideoPlaySpeedChangeEvent.providedBy( event ):
+		return getattr( event, 'resource_id', None )
+	return None
+
+
+def resolve_event_dimensions(events):
+	"""
+	Resolve (creating as needed) the user, root context and resource
+	records of the given events in bulk, rather than per event. Our
+	handlers find them as long as they run within the same resolution memo
+	(and transaction).
+	"""
+	db = get_analytics_db( strict=False )
+	if db is None:
+		return 0
+	users = []
+	resources = []
+	root_contexts = []
+	for event in events:
+		user = get_entity( event.user ) if event.user else None
+		if user is None:
+			# Invalid; leave it to our handlers.
+			continue
+		users.append( user )
+		if getattr( event, 'RootContextID', None ):
+			root_context = _get_root_context( event )
+			if _valid_course_type( root_context ):
+				root_contexts.append( root_context )
+		resource_id = _get_event_resource_id( event )
+		if resource_id and is_valid_ntiid_string( resource_id ):
+			resources.append( resource_id )
+	return resolve_dimensions( db,
+							   users=users,
+							   resources=resources,
+							   root_contexts=root_contexts )
+
+
+def _resolve_dimensions(event_kwargs):
+	"""
+	Prepares a batch of our jobs, see :func:`resolve_event_dimensions`.
+	"""
+	events = [x['event'] for x in event_kwargs if x.get( 'event' ) is not None]
+	resolve_event_dimensions( events )
+
+
+def _get_heartbeat_key(event):
+	"""
+	Heartbeats of the same view (user, object, start timestamp and, for
+	videos, event type) share a key. Other events return None.
+	"""
+	timestamp = getattr( event, 'timestamp', None )
+	if timestamp is None or not event.user:
+		return None
+	if IVideoEvent.providedBy( event ):
+		return ( IVideoEvent, event.user, event.ResourceId, timestamp, event.event_type )
+	elif IResourceEvent.providedBy( event ):
+		return ( IResourceEvent, event.user, event.ResourceId, timestamp )
+	elif ITopicViewEvent.providedBy( event ):
+		return ( ITopicViewEvent, event.user, event.topic_id, timestamp )
+	elif INoteViewEvent.providedBy( event ):
+		return ( INoteViewEvent, event.user, event.note_id, timestamp )
+	elif IBlogViewEvent.providedBy( event ):
+		return ( IBlogViewEvent, event.user, event.blog_id, timestamp )
+	return None
+
+
+def _get_heartbeat_duration(event):
+	"""
+	The duration of the event, as we would record it; video events may
+	only carry their start and end times.
+	"""
+	duration = getattr( event, 'Duration', None )
+	if duration is None:
+		start = getattr( event, 'video_start_time', None )
+		end = getattr( event, 'video_end_time', None )
+		if start is not None and end is not None and start < end:
+			duration = end - start
+	return duration
+
+
+def _coalesce_heartbeats(batch_events):
+	"""
+	Clients heartbeat view events with a growing duration; each heartbeat
+	would otherwise be a read and an update of the same row. Of the events
+	sharing a heartbeat key, we keep only the one with the largest
+	(effective) duration (the latest, on ties), in the position of the
+	first.
+
+	Returns a tuple of the events to process and those coalesced away.
+	"""
+	result = []
+	coalesced = []
+	by_key = {}
+	for event in batch_events:
+		key = _get_heartbeat_key( event )
+		if key is None:
+			result.append( event )
+			continue
+		idx = by_key.get( key )
+		if idx is None:
+			by_key[key] = len( result )
+			result.append( event )
+			continue
+		existing = result[idx]
+		existing_duration = _get_heartbeat_duration( existing )
+		duration = _get_heartbeat_duration( event )
+		if duration is not None and ( existing_duration is None or duration >= existing_duration ):
+			result[idx] = event
+			coalesced.append( existing )
+		else:
+			coalesced.append( event )
+	return result, coalesced
+
+
+def _handle_validation_error(e, validation_errors, return_invalid):
+	"""
+	Called while handling the validation error `e`.
+	"""
+	if return_invalid:
+		# If returning, we want to capture all errors and process the rest.
+		validation_errors.append(e)
+	else:
+		raise
+
+
+def _handle_batched_events(event_kwargs, validation_errors, return_invalid, handled):
+	"""
+	Process our events grouped by target queue, such that each queue
+	receives (at most) a single job for the entire batch.
+	"""
+	by_queue = OrderedDict()
+	for event, processor, kwargs in event_kwargs:
+		if processor is None:
+			handled.append(event)
+			continue
+		get_queue, to_call = processor
+		# Partitioned queues are keyed by user, keeping their events in order.
+		key = (get_queue, event.user)
+		by_queue.setdefault(key, []).append((event, to_call, kwargs))
+
+	for (get_queue, username), queue_events in by_queue.items():
+		object_ops = [(to_call, kwargs) for _, to_call, kwargs in queue_events]
+		errors = process_events(get_queue, object_ops, partition_key=username,
+								prepare_batch=_resolve_dimensions)
+		for (event, _, _), error in zip(queue_events, errors):
+			if error is None:
+				handled.append(event)
+			elif return_invalid:
+				validation_errors.append(error)
+			else:
+				# Captured while executing our batch, not being handled.
+				raise error
+
+
+# Each object (and user) is resolved at most once for the whole batch.
+@with_resolution_memo
+def handle_events(batch_events, return_invalid=True, handled=None, batch=True):
 	"""
-	Handle resource view events, optionally returning or raising on invalid events
+	Handle resource view events, optionally returning or raising on invalid events.
+
+	If `batch`, the events are grouped by target queue and each group is
+	processed as a single job, within a single site context and transaction.
+	Heartbeats of the same view are coalesced into a single event first.
 	"""
 	validation_errors = []
 	handled = [] if handled is None else handled
+	event_kwargs = []
 	for event in batch_events:
+		if not event.user:
+			event.user = get_current_username()
+
+	events, coalesced = _coalesce_heartbeats( batch_events )
+	for event in events:
 		# Try to grab a session, careful not to raise so we don't lose our
 		# otherwise valid events. Since the batch send time on the client side
 		# is currently 10s, we can reasonably expect a valid session to exist.
-		if not event.user:
-			event.user = get_current_username()
 		nti_session = get_nti_session_id(event=event)
 
 		kwargs = {'event': event,
 				  'nti_session': nti_session}
+		processor = _get_event_processor( event )
+
+		if batch:
+			event_kwargs.append((event, processor, kwargs))
+			continue
 
 		try:
-			if INoteViewEvent.providedBy( event ):
-				process_event( _get_note_queue, _add_note_event, **kwargs )
-			elif IBlogViewEvent.providedBy( event ):
-				process_event( _get_blog_queue, _add_blog_event, **kwargs )
-			elif ITopicViewEvent.providedBy( event ):
-				process_event( _get_topic_queue, _add_topic_event, **kwargs )
-			elif IVideoEvent.providedBy( event ):
-				process_event( _get_video_queue, _add_video_event, **kwargs )
-			elif ISelfAssessmentViewEvent.providedBy( event ):
-				process_event( _get_resource_queue, _add_self_assessment_event, **kwargs )
-			elif IAssignmentViewEvent.providedBy( event ):
-				process_event( _get_resource_queue, _add_assignment_event, **kwargs )
-			elif ISurveyViewEvent.providedBy( event ):
-				process_event( _get_resource_queue, _add_survey_event, **kwargs )
-			elif IResourceEvent.providedBy( event ):
-				process_event( _get_resource_queue, _add_resource_event, **kwargs )
-			elif ICourseCatalogViewEvent.providedBy( event ):
-				process_event( _get_catalog_queue, _add_catalog_event, **kwargs )
-			elif IVideoPlaySpeedChangeEvent.providedBy( event ):
-				process_event( _get_video_queue, _add_play_speed_event, **kwargs )
-			elif IProfileActivityViewEvent.providedBy( event ):
-				process_event( _get_profile_queue, _add_profile_activity_event, **kwargs )
-			elif IProfileMembershipViewEvent.providedBy( event ):
-				process_event( _get_profile_queue, _add_profile_membership_event, **kwargs )
-			elif IProfileViewEvent.providedBy( event ):
-				process_event( _get_profile_queue, _add_profile_event, **kwargs )
+			if processor is not None:
+				get_queue, to_call = processor
+				process_event( get_queue, to_call,
+							   partition_key=event.user, **kwargs )
 		except AnalyticsEventValidationError as e:
-			if return_invalid:
-				# If returning, we want to capture all errors and process the rest.
-				validation_errors.append(e)
-			else:
-				raise
+			_handle_validation_error(e, validation_errors, return_invalid)
 		else:
 			handled.append(event)
+
+	if event_kwargs:
+		_handle_batched_events(event_kwargs, validation_errors,
+							   return_invalid, handled)
+	# These are subsumed by the events we processed.
+	handled.extend( coalesced )
 	# If we validated early, we could return something meaningful.
 	# But we'd have to handle all validation exceptions as to not lose the valid
 	# events. The nti.asynchronous.processor does this and at least drops the bad
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Micro-batching job runner for the analytics queues.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from threading import local
+
+import transaction
+
+from transaction.interfaces import TransientError
+
+from gevent import sleep
+
+from zope import component
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The maximum number of jobs executed in a single transaction.
+DEFAULT_BATCH_SIZE = 50
+
+#: How long (in milliseconds) we wait to fill a batch.
+DEFAULT_MAX_WAIT = 500
+
+#: How long (in milliseconds) we sleep between polling an empty queue.
+DEFAULT_POLL_INTERVAL = 50
+
+
+class AnalyticsJobFailedError(Exception):
+	"""
+	Raised when a job reports failure without raising.
+	"""
+
+
+_state = local()
+
+
+def record_transient_error(error):
+	"""
+	Record the transient error (e.g. a conflict) of the job being run,
+	which the job itself may trap, so that :func:`run_job` raises it.
+	"""
+	_state.error = error
+
+
+def run_job(job):
+	"""
+	Run the given job, raising if it fails; transient errors are raised
+	as such, such that the batch is retried.
+	"""
+	_state.error = None
+	result = job()
+	has_failed = getattr(job, 'has_failed', None)
+	if has_failed is not None and has_failed():
+		error = getattr(job, 'error', None)
+		if isinstance(error, TransientError):
+			raise error
+		if _state.error is not None:
+			raise _state.error
+		raise AnalyticsJobFailedError(error or job)
+	return result
+
+
+class AnalyticsBatchJobRunner(object):
+	"""
+	Drains an analytics queue in micro-batches. Up to `batch_size` jobs,
+	or as many as arrive within `max_wait` milliseconds, are executed in a
+	single transaction, with a savepoint per job. A failing job only rolls
+	back its own savepoint and is placed on the failed queue; the batch
+	commits once.
+	"""
+
+	def __init__(self, queue, batch_size=DEFAULT_BATCH_SIZE,
+				 max_wait=DEFAULT_MAX_WAIT, retries=2,
+				 poll_interval=DEFAULT_POLL_INTERVAL, site_names=()):
+		self.queue = queue
+		self.retries = retries
+		self.max_wait = max_wait
+		self.batch_size = batch_size
+		self.site_names = site_names
+		self.poll_interval = poll_interval
+
+	def claim_batch(self):
+		"""
+		Claim up to `batch_size` jobs, waiting at most `max_wait` ms.
+		"""
+		result = []
+		deadline = time.time() + self.max_wait / 1000.0
+		while len(result) < self.batch_size:
+			job = self.queue.claim()
+			if job is not None:
+				result.append(job)
+				continue
+			if time.time() >= deadline:
+				break
+			sleep(self.poll_interval / 1000.0)
+		return result
+
+	def execute_batch(self, jobs):
+		"""
+		Execute the given jobs in the current transaction, returning
+		those that failed.
+		"""
+		failed = []
+		for job in jobs:
+			try:
+				savepoint = transaction.savepoint()
+			except TypeError:
+				# Some participating data manager cannot savepoint; the
+				# whole batch succeeds or fails together.
+				run_job(job)
+				continue
+
+			try:
+				run_job(job)
+				# Flush within our savepoint, so that any integrity errors
+				# are attributed to this job.
+				transaction.savepoint()
+			except TransientError:
+				# Conflicts and the like; retry the batch as a whole.
+				raise
+			except Exception as e:
+				self.job_failed(job, e)
+				savepoint.rollback()
+				failed.append(job)
+		return failed
+
+	def job_failed(self, job, unused_error):
+		"""
+		Called, while handling the error, when a job in a batch fails.
+		"""
+		logger.exception('Analytics job failed (%s)', job)
+
+	def batch_failed(self, jobs, unused_error):
+		"""
+		Called, while handling the error, when a batch fails to commit.
+		"""
+		logger.exception('Analytics batch failed to commit (size=%s)',
+						 len(jobs))
+
+	def _put_failed(self, jobs):
+		for job in jobs:
+			self.queue.putFailed(job)
+
+	def _run_in_transaction(self, func):
+		runner = component.getUtility(IDataserverTransactionRunner)
+		kwargs = {'retries': self.retries}
+		if self.site_names:
+			kwargs['site_names'] = self.site_names
+		return runner(func, **kwargs)
+
+	def _after_batch_commit(self, status, failed):
+		if status:
+			self._put_failed(failed)
+
+	def _execute_and_record(self, jobs):
+		failed = self.execute_batch(jobs)
+		# Only once we know our outcome; a retried (or aborted) attempt
+		# must not put its failed jobs, and a batch that cannot commit
+		# puts all of its jobs.
+		transaction.get().addAfterCommitHook(self._after_batch_commit,
+											 args=(failed,))
+		return failed
+
+	def __call__(self):
+		"""
+		Claim and execute a single batch, returning the number of jobs
+		processed.
+		"""
+		jobs = self.claim_batch()
+		if not jobs:
+			return 0
+		try:
+			failed = self._run_in_transaction(lambda: self._execute_and_record(jobs))
+		except Exception as e:
+			# The batch as a whole could not commit; our jobs were claimed
+			# outside of the transaction, so make sure they are not lost.
+			self.batch_failed(jobs, e)
+			failed = jobs
+			self._run_in_transaction(lambda: self._put_failed(jobs))
+		logger.debug('Processed analytics batch (size=%s) (failed=%s)',
+					 len(jobs), len(failed))
+		return len(jobs)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Weighted fair scheduling across the analytics queues.
+
+Draining our queues in order lets a flood of (e.g.) video events starve
+low-volume, time-sensitive queues. Instead, the scheduler picks the queue
+to draw the next batch from by smooth weighted round-robin over the
+non-empty queues. A queue may also have a maximum latency target; a
+non-empty queue not served within its target preempts the round-robin
+(most overdue first).
+
+Our `PRIORITY_QUEUES` default to `PRIORITY_WEIGHT` and
+`PRIORITY_MAX_LATENCY`.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from nti.analytics import PRIORITY_QUEUES
+
+from nti.analytics import get_base_queue_name
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The weight of queues not otherwise configured.
+DEFAULT_WEIGHT = 1
+
+#: The default weight of our priority queues.
+PRIORITY_WEIGHT = 4
+
+#: The default maximum latency target (in seconds) of our priority queues.
+PRIORITY_MAX_LATENCY = 5
+
+
+class WeightedQueueScheduler(object):
+	"""
+	Decides which of the given queues the next batch comes from.
+
+	`weights` and `max_latency` map queue names (a partitioned queue's
+	base name applies to all of its partitions) to a relative weight and
+	a maximum latency target in seconds (or None), respectively.
+	"""
+
+	def __init__(self, queue_names, weights=None, max_latency=None, now=None):
+		now = time.time() if now is None else now
+		self.queue_names = tuple(queue_names)
+		self.weights = {}
+		self.max_latency = {}
+		weights = weights or {}
+		max_latency = max_latency or {}
+		for name in self.queue_names:
+			self.weights[name] = self._lookup(name, weights, PRIORITY_WEIGHT, DEFAULT_WEIGHT)
+			self.max_latency[name] = self._lookup(name, max_latency, PRIORITY_MAX_LATENCY, None)
+		self.current = dict.fromkeys(self.queue_names, 0)
+		self.last_served = dict.fromkeys(self.queue_names, now)
+
+	def _lookup(self, name, values, priority_default, default):
+		base_name = get_base_queue_name(name)
+		for key in (name, base_name):
+			if key in values:
+				return values[key]
+		return priority_default if base_name in PRIORITY_QUEUES else default
+
+	def _overdue(self, ready, now):
+		result = None
+		max_ratio = 1
+		for name in ready:
+			target = self.max_latency[name]
+			if not target:
+				continue
+			ratio = (now - self.last_served[name]) / target
+			if ratio >= max_ratio:
+				result, max_ratio = name, ratio
+		return result
+
+	def _round_robin(self, ready):
+		# Smooth weighted round-robin: over time, each queue is chosen in
+		# proportion to its weight, interleaved rather than in runs.
+		total = 0
+		result = None
+		for name in ready:
+			weight = self.weights[name]
+			self.current[name] += weight
+			total += weight
+			if result is None or self.current[name] > self.current[result]:
+				result = name
+		self.current[result] -= total
+		return result
+
+	def select(self, depths, now=None):
+		"""
+		Given a map of queue name to depth, return the name of the queue to
+		drain next (and mark it served), or None if all are empty.
+		"""
+		now = time.time() if now is None else now
+		ready = []
+		for name in self.queue_names:
+			if depths.get(name):
+				ready.append(name)
+			else:
+				# Nothing waiting, so nothing is late.
+				self.last_served[name] = now
+				self.current[name] = 0
+		if not ready:
+			return None
+		result = self._overdue(ready, now)
+		if result is not None:
+			logger.debug('Analytics queue over latency target (%s)', result)
+		else:
+			result = self._round_robin(ready)
+		self.last_served[result] = now
+		return result
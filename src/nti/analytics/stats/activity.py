@@ -8,8 +8,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import heapq
+
 from collections import defaultdict
 
+from itertools import islice
+
 from gevent import sleep
 
 from zope import interface
@@ -20,6 +24,14 @@ from nti.analytics.lti import get_lti_asset_launches
 from nti.analytics.assessments import get_active_users_with_assignments_taken
 from nti.analytics.assessments import get_assignment_taken_views
 
+from nti.analytics.database import ProjectedRows
+from nti.analytics.database import get_analytics_db
+
+from nti.analytics.database.query_utils import get_user_counts
+from nti.analytics.database.query_utils import get_timestamp_bucket_counts
+
+from nti.analytics.identifier import get_ds_object
+
 from nti.analytics.stats.interfaces import IActivitySource
 from nti.analytics.stats.interfaces import IActiveTimesStats
 from nti.analytics.stats.interfaces import IActiveTimesStatsSource
@@ -57,17 +69,17 @@ class ActiveTimeStats(object):
     def __init__(self):
         self.counts = {}
 
-    def process_event(self, event):
-        day = event.timestamp.weekday()
-        hour = event.timestamp.hour
-
+    def add_count(self, day, hour, count=1):
         try:
             day_counts = self.counts[day]
         except KeyError:
             day_counts = {}
             self.counts[day] = day_counts
 
-        day_counts[hour] = day_counts.get(hour, 0) + 1
+        day_counts[hour] = day_counts.get(hour, 0) + count
+
+    def process_event(self, event):
+        self.add_count(event.timestamp.weekday(), event.timestamp.hour)
 
     def __getitem__(self, key):
         day_counts = self.counts.get(key, {})
@@ -82,6 +94,12 @@ EVENT_SOURCES = (get_video_views,
 
 _DEFAULT_YIELD_PER = 1000
 
+#: For our stats that only bucket events by time.
+_TIMESTAMP_COLUMNS = ('timestamp',)
+
+#: For our stats that only count events by user.
+_USER_COLUMNS = ('user_id',)
+
 
 def _activity_source(**kwargs):
     yield_to_hub_per = kwargs.get('yield_per', None) or _DEFAULT_YIELD_PER
@@ -95,6 +113,110 @@ def _activity_source(**kwargs):
                 sleep() # Yield to the gevent hub
 
 
+def _activity_queries(columns, **kwargs):
+    """
+    Return the queries of the given (single) columns of our
+    `EVENT_SOURCES`, or None if any source cannot provide one.
+    """
+    kwargs = dict(kwargs, yield_per=None, columns=columns)
+    result = []
+    for source in EVENT_SOURCES:
+        rows = source(**kwargs)
+        if isinstance(rows, ProjectedRows):
+            result.append(rows.rows)
+        elif rows:
+            return None
+    return result
+
+
+def _activity_bucket_counts(buckets, **kwargs):
+    """
+    Count our activity by the given timestamp buckets (e.g. weekday and
+    hour) with a single, grouped query of all our `EVENT_SOURCES`
+    tables, rather than streaming every event to us. Returns None if we
+    cannot; :func:`_activity_source` is our fallback.
+    """
+    if get_analytics_db(strict=False) is None:
+        return None
+    queries = _activity_queries(_TIMESTAMP_COLUMNS, **kwargs)
+    if queries is None:
+        return None
+    return get_timestamp_bucket_counts(queries, buckets)
+
+
+def _active_user_counts(limit=None, **kwargs):
+    """
+    Count our activity by user with a single, grouped query of all our
+    `EVENT_SOURCES` tables, returning (at most `limit`) (user_ds_id,
+    count) tuples, most active first, or None if we cannot;
+    `BY_USER_EVENTS` is our fallback.
+    """
+    if get_analytics_db(strict=False) is None:
+        return None
+    queries = _activity_queries(_USER_COLUMNS, **kwargs)
+    if queries is None:
+        return None
+    return get_user_counts(queries, limit=limit)
+
+
+class _Descending(object):
+    """
+    A heap entry ordering (the largest of) `key` first; ties keep the
+    order of our sources.
+    """
+
+    __slots__ = ('key', 'index', 'event', 'events')
+
+    def __init__(self, key, index, event, events):
+        self.key = key
+        self.index = index
+        self.event = event
+        self.events = events
+
+    def __lt__(self, other):
+        if self.key == other.key:
+            return self.index < other.index
+        return self.key > other.key
+
+
+def _merge_descending(streams, order_by):
+    """
+    Lazily merge the given event iterables, each already in descending
+    `order_by` order, into one descending stream.
+    """
+    heap = []
+    for index, events in enumerate(streams):
+        events = iter(events)
+        for event in events:
+            heap.append(_Descending(getattr(event, order_by), index, event, events))
+            break
+    heapq.heapify(heap)
+    while heap:
+        entry = heap[0]
+        yield entry.event
+        for event in entry.events:
+            entry.key = getattr(event, order_by)
+            entry.event = event
+            heapq.heapreplace(heap, entry)
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _ordered_activity_source(order_by, **kwargs):
+    """
+    Our `EVENT_SOURCES` activity, in descending `order_by` order. Each
+    source orders its own query and streams it, resolving (and dropping
+    unresolvable) events as we consume them, such that a `limit` applied
+    to our merged result is never short because a source dropped rows
+    after limiting its query.
+    """
+    kwargs.pop('limit', None)
+    streams = [source(order_by=order_by, stream=True, **kwargs)
+               for source in EVENT_SOURCES]
+    return _merge_descending(streams, order_by)
+
+
 @interface.implementer(IActivitySource)
 class ActivitySource(object):
 
@@ -103,21 +225,23 @@ class ActivitySource(object):
         self.root_context = root_context
 
     def activity(self, **kwargs):
+        """
+        Our activity events; given `order_by` (an event attribute),
+        newest (largest) first and, given a `limit`, at most that many.
+        """
         kwargs['user'] = self.user
         kwargs['root_context'] = self.root_context
         if 'yield_per' not in kwargs:
             kwargs['yield_per'] = _DEFAULT_YIELD_PER
-        events = _activity_source(**kwargs)
-
-        order_by = kwargs.get('order_by', None)
 
+        limit = kwargs.get('limit', None)
+        order_by = kwargs.pop('order_by', None)
         if order_by:
-            events = sorted(events,
-                            key=lambda a: getattr(a, order_by),
-                            reverse=True)
+            events = _ordered_activity_source(order_by, **kwargs)
+            return list(islice(events, limit) if limit else events)
 
-        limit = kwargs.get('limit', None)
-        return events[:limit] if limit else events
+        events = _activity_source(**kwargs)
+        return list(islice(events, limit)) if limit else events
 
 
 def _root_context_activity_source(root_context):
@@ -150,10 +274,22 @@ class ActiveTimeSource(object):
 
     def active_times_for_window(self, start, end):
         stats = ActiveTimeStats()
+        counts = _activity_bucket_counts(('weekday', 'hour'),
+                                         user=self.user,
+                                         root_context=self.root_context,
+                                         timestamp=start,
+                                         max_timestamp=end)
+        if counts is not None:
+            for (day, hour), count in counts.items():
+                stats.add_count(day, hour, count)
+            return stats
+
         activity_source = ActivitySource(user=self.user,
                                          root_context=self.root_context)
+        # We only need timestamps, not full records.
         for event in activity_source.activity(timestamp=start,
-                                              max_timestamp=end):
+                                              max_timestamp=end,
+                                              columns=_TIMESTAMP_COLUMNS):
             stats.process_event(event)
         return stats
     stats_for_window = active_times_for_window
@@ -185,12 +321,22 @@ class DailyActivitySource(object):
 
     def stats_for_window(self, start, end):
         dates = defaultdict(lambda: 0)
-        activity_source = ActivitySource(user=self.user,
-                                         root_context=self.root_context)
-        for event in activity_source.activity(timestamp=start,
-                                              max_timestamp=end):
-            date = event.timestamp.date()
-            dates[date] += 1
+        counts = _activity_bucket_counts(('date',),
+                                         user=self.user,
+                                         root_context=self.root_context,
+                                         timestamp=start,
+                                         max_timestamp=end)
+        if counts is not None:
+            for (date,), count in counts.items():
+                dates[date] += count
+        else:
+            activity_source = ActivitySource(user=self.user,
+                                             root_context=self.root_context)
+            for event in activity_source.activity(timestamp=start,
+                                                  max_timestamp=end,
+                                                  columns=_TIMESTAMP_COLUMNS):
+                date = event.timestamp.date()
+                dates[date] += 1
         return LocatedExternalDict({k: CountStats(Count=v)
                                     for k, v in dates.items()})
 
@@ -209,9 +355,22 @@ class ActiveUsersSource(object):
         self.root_context = root_context
 
     def users(self, **kwargs):
+        """
+        Our active users, most active first; given a `limit`, only the
+        (top) that many.
+        """
+        limit = kwargs.pop('limit', None)
+        counts = _active_user_counts(limit=limit,
+                                     root_context=self.root_context,
+                                     **kwargs)
+        if counts is not None:
+            result = (get_ds_object(user_ds_id) for user_ds_id, _ in counts)
+            return [x for x in result if x is not None]
+
         aggregate = defaultdict(lambda: 0)
         for source in BY_USER_EVENTS:
             for user, count in source(root_context=self.root_context, **kwargs):
                 aggregate[user] += count
-        return sorted(aggregate, key=aggregate.get, reverse=True)
+        result = sorted(aggregate, key=aggregate.get, reverse=True)
+        return result[:limit] if limit else result
 
@@ -9,6 +9,10 @@ from __future__ import absolute_import
 # pylint: disable=W0212,R0904
 
 from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import not_none
+from hamcrest import has_length
+from hamcrest import has_key
 from hamcrest import assert_that
 from hamcrest import has_entries
 from hamcrest import has_property
@@ -21,13 +25,23 @@ from datetime import timedelta
 
 from zope import component
 
+from nti.analytics.database import resource_views as db_views
+
+from nti.analytics.stats import activity
+
+from nti.analytics.stats.activity import ActivitySource
 from nti.analytics.stats.activity import ActiveTimeStats
+from nti.analytics.stats.activity import ActiveTimeSource
+from nti.analytics.stats.activity import ActiveUsersSource
 from nti.analytics.stats.activity import DailyActivitySource
 
 from nti.analytics.stats.interfaces import IActiveTimesStatsSource
 from nti.analytics.stats.interfaces import IDailyActivityStatsSource
 
+from nti.analytics.tests import test_session_id
+from nti.analytics.tests import AnalyticsTestBase
 from nti.analytics.tests import NTIAnalyticsTestCase
+from nti.analytics.tests import assert_max_statements
 
 from nti.contentlibrary.bundle import ContentPackageBundle
 
@@ -100,6 +114,66 @@ class TestActiveTimeStats(unittest.TestCase):
 
         assert_that(stats[5][1].Count, is_(0))
 
+class TestActivitySource(unittest.TestCase):
+
+    def setUp(self):
+        self.old_sources = activity.EVENT_SOURCES
+        self.calls = []
+        self.unresolvable = ()
+        now = datetime.now()
+        times = ([now - timedelta(hours=x) for x in (0, 4, 5)],
+                 [now - timedelta(hours=x) for x in (1, 2, 7)],
+                 [],
+                 [now - timedelta(hours=x) for x in (3, 6)])
+        activity.EVENT_SOURCES = [self._source(x) for x in times]
+
+    def tearDown(self):
+        activity.EVENT_SOURCES = self.old_sources
+
+    def _source(self, times):
+        def source(**kwargs):
+            self.calls.append(kwargs)
+            events = [FakeEvent(x) for x in times]
+            # As our queries would
+            if kwargs.get('order_by') is None:
+                events.reverse()
+            if kwargs.get('limit'):
+                events = events[:kwargs['limit']]
+            # Unresolvable events are dropped after our query
+            return [x for x in events if x.timestamp not in self.unresolvable]
+        return source
+
+    def test_merged(self):
+        source = ActivitySource()
+        events = list(source.activity(order_by='timestamp'))
+        assert_that(events, has_length(8))
+        timestamps = [x.timestamp for x in events]
+        assert_that(timestamps, is_(sorted(timestamps, reverse=True)))
+
+        # Each source is queried ordered and streamed
+        self.calls = []
+        events = source.activity(order_by='timestamp', limit=3)
+        assert_that(events, is_(list))
+        assert_that([x.timestamp for x in events], is_(timestamps[:3]))
+        assert_that(self.calls, has_length(4))
+        for call in self.calls:
+            assert_that(call, has_entries('order_by', 'timestamp',
+                                          'stream', True))
+            assert_that(call, is_not(has_key('limit')))
+
+        # Events a source cannot resolve do not shorten our result
+        self.unresolvable = timestamps[:2]
+        events = source.activity(order_by='timestamp', limit=3)
+        assert_that([x.timestamp for x in events], is_(timestamps[2:5]))
+
+        # Without an order, a limit still applies
+        self.unresolvable = ()
+        events = source.activity(limit=4)
+        assert_that(events, has_length(4))
+        events = list(source.activity())
+        assert_that(events, has_length(8))
+
+
 class TestActiveTimeStatsAdapters(NTIAnalyticsTestCase):
 
     def setUp(self):
@@ -110,8 +184,15 @@ class TestActiveTimeStatsAdapters(NTIAnalyticsTestCase):
         self.start = datetime.now()
         self.end = datetime.now()
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_user_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_user_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=self.user,
+                                                            root_context=None,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=self.user,
                                                      root_context=None,
                                                      timestamp=self.start,
@@ -121,8 +202,15 @@ class TestActiveTimeStatsAdapters(NTIAnalyticsTestCase):
         source = IActiveTimesStatsSource(self.user)
         source.stats_for_window(self.start, self.end)
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_course_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_course_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=None,
+                                                            root_context=self.course,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=None,
                                                      root_context=self.course,
                                                      timestamp=self.start,
@@ -132,8 +220,15 @@ class TestActiveTimeStatsAdapters(NTIAnalyticsTestCase):
         source = IActiveTimesStatsSource(self.course)
         source.stats_for_window(self.start, self.end)
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_bundle_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_bundle_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=None,
+                                                            root_context=self.bundle,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=None,
                                                      root_context=self.bundle,
                                                      timestamp=self.start,
@@ -143,8 +238,15 @@ class TestActiveTimeStatsAdapters(NTIAnalyticsTestCase):
         source = IActiveTimesStatsSource(self.bundle)
         source.stats_for_window(self.start, self.end)
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_enrollment_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_enrollment_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=self.user,
+                                                            root_context=self.course,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=self.user,
                                                      root_context=self.course,
                                                      timestamp=self.start,
@@ -163,9 +265,11 @@ class TestDailyActivitySource(unittest.TestCase):
              '2010-01-02 12:03',
              '2010-03-01 15:03', ]
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_daily_activity_summary(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_daily_activity_summary(self, mock_bucket_counts, mock_activity_source):
 
+        mock_bucket_counts.is_callable().returns(None)
         mock_activity_source.is_callable()
         mock_activity_source.returns([
             FakeEvent(datetime.strptime(s, "%Y-%m-%d %H:%M")) for s in self.TIMES
@@ -188,8 +292,15 @@ class TestDailyActivitySourceAdapters(NTIAnalyticsTestCase):
         self.start = datetime.now()
         self.end = datetime.now()
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_user_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_user_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=self.user,
+                                                            root_context=None,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=self.user,
                                                      root_context=None,
                                                      timestamp=self.start,
@@ -199,8 +310,15 @@ class TestDailyActivitySourceAdapters(NTIAnalyticsTestCase):
         source = IDailyActivityStatsSource(self.user)
         source.stats_for_window(self.start, self.end)
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_course_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_course_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=None,
+                                                            root_context=self.course,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=None,
                                                      root_context=self.course,
                                                      timestamp=self.start,
@@ -210,8 +328,15 @@ class TestDailyActivitySourceAdapters(NTIAnalyticsTestCase):
         source = IDailyActivityStatsSource(self.course)
         source.stats_for_window(self.start, self.end)
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_bundle_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_bundle_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=None,
+                                                            root_context=self.bundle,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=None,
                                                      root_context=self.bundle,
                                                      timestamp=self.start,
@@ -221,8 +346,15 @@ class TestDailyActivitySourceAdapters(NTIAnalyticsTestCase):
         source = IDailyActivityStatsSource(self.bundle)
         source.stats_for_window(self.start, self.end)
 
-    @fudge.patch('nti.analytics.stats.activity._activity_source')
-    def test_enrollment_scoped(self, mock_activity_source):
+    @fudge.patch('nti.analytics.stats.activity._activity_bucket_counts',
+                 'nti.analytics.stats.activity._activity_source')
+    def test_enrollment_scoped(self, mock_bucket_counts, mock_activity_source):
+        # Our fallback, if we cannot count on the database
+        mock_bucket_counts.is_callable().with_matching_args(user=self.user,
+                                                            root_context=self.course,
+                                                            timestamp=self.start,
+                                                            max_timestamp=self.end)
+        mock_bucket_counts.returns(None)
         mock_activity_source.is_callable().with_matching_args(user=self.user,
                                                      root_context=self.course,
                                                      timestamp=self.start,
@@ -232,3 +364,87 @@ class TestDailyActivitySourceAdapters(NTIAnalyticsTestCase):
         source = component.getMultiAdapter((self.user, self.course),
                                            IDailyActivityStatsSource)
         source.stats_for_window(self.start, self.end)
+
+
+class TestActivityBuckets(AnalyticsTestBase):
+    """
+    Our database bucketing matches our (reference) python bucketing.
+    """
+
+    TIMES = ['2010-01-01 12:03',
+             '2010-01-01 12:59',
+             '2010-01-02 00:03',
+             '2010-01-04 23:03',
+             '2010-03-01 15:03', ]
+
+    def setUp(self):
+        super(TestActivityBuckets, self).setUp()
+        for idx, timestamp in enumerate(self.TIMES):
+            timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M")
+            db_views.create_course_resource_view(self.db_user,
+                                                 test_session_id,
+                                                 timestamp,
+                                                 self.course_record,
+                                                 ['dashboard'],
+                                                 'ntiid:resource%s' % idx,
+                                                 30)
+
+    def _python(self, func):
+        old_bucket_counts = activity._activity_bucket_counts
+        activity._activity_bucket_counts = lambda *unused_args, **unused_kwargs: None
+        try:
+            return func()
+        finally:
+            activity._activity_bucket_counts = old_bucket_counts
+
+    def test_buckets(self):
+        assert_that(activity._activity_bucket_counts(('date',)), not_none())
+
+        source = ActiveTimeSource()
+        result = source.active_times_for_window(None, None)
+        expected = self._python(lambda: source.active_times_for_window(None, None))
+        assert_that(result.counts, has_length(3))
+        assert_that(result.counts, is_(expected.counts))
+
+        source = DailyActivitySource()
+        result = source.stats_for_window(None, None)
+        expected = self._python(lambda: source.stats_for_window(None, None))
+        assert_that(result, has_length(4))
+        assert_that({k: v.Count for k, v in result.items()},
+                    is_({k: v.Count for k, v in expected.items()}))
+
+
+class _FakeUser(object):
+
+    def __init__(self, intid):
+        self._ds_intid = intid
+
+
+class TestActiveUsers(AnalyticsTestBase):
+
+    def setUp(self):
+        super(TestActiveUsers, self).setUp()
+        self.users = [_FakeUser(x) for x in (9001, 9002, 9003)]
+        timestamp = datetime(2010, 1, 1)
+        for idx, user in enumerate(self.users):
+            for view in range(idx + 1):
+                db_views.create_course_resource_view(user,
+                                                     test_session_id,
+                                                     timestamp + timedelta(hours=view),
+                                                     self.course_record,
+                                                     ['dashboard'],
+                                                     'ntiid:resource%s' % view,
+                                                     30)
+
+    def test_users(self):
+        expected = list(reversed(self.users))
+        counts = activity._active_user_counts()
+        assert_that(counts, is_([(9003, 3), (9002, 2), (9001, 1)]))
+
+        source = ActiveUsersSource()
+        # Our watermark and our single, grouped query
+        with assert_max_statements(2):
+            assert_that(source.users(), is_(expected))
+        assert_that(source.users(limit=2), is_(expected[:2]))
+        assert_that(source.users(timestamp=datetime(2010, 1, 1, 2)),
+                    is_(expected[:1]))
@@ -14,8 +14,13 @@ import shutil
 import tempfile
 import unittest
 
+from contextlib import contextmanager
+
 from fudge import patch_object
 
+from hamcrest import assert_that
+from hamcrest import less_than_or_equal_to
+
 from six import string_types
 from six import integer_types
 
@@ -47,6 +52,8 @@ from nti.analytics.database import users as db_users
 from nti.analytics.database import sessions as db_sessions
 from nti.analytics.database import root_context as db_courses
 
+from nti.analytics.database.profiling import sql_profile
+
 from nti.app.assessment.tests import RegisterAssignmentLayerMixin
 
 from nti.dataserver.tests.mock_dataserver import WithMockDS
@@ -151,6 +158,18 @@ test_user_ds_id = 78
 test_session_id = 1
 
 
+@contextmanager
+def assert_max_statements(count, name='test'):
+    """
+    Assert the enclosed block issues at most `count` SQL statements; e.g.
+    to lock in fixes of per-row lookups.
+    """
+    with sql_profile(name) as profile:
+        yield profile
+    assert_that(profile.statements, less_than_or_equal_to(count),
+                'Too many statements: %s' % dict(profile.shapes))
+
+
 class AnalyticsTestBase(unittest.TestCase):
     """
     A base class that creates a user and session, as well as mocks out
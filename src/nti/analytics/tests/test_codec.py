@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import pickle
+import unittest
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import assert_that
+from hamcrest import has_properties
+
+from nti.analytics.codec import CODEC_VERSION
+
+from nti.analytics.codec import decode_event
+from nti.analytics.codec import encode_event
+
+from nti.analytics.model import ResourceEvent
+from nti.analytics.model import WatchVideoEvent
+from nti.analytics.model import VideoPlaySpeedChangeEvent
+
+from nti.analytics.tests.test_externalization import play_speed_event
+from nti.analytics.tests.test_externalization import start_video_event
+from nti.analytics.tests.test_externalization import watch_video_event
+
+
+class TestCodec(unittest.TestCase):
+
+	def _round_trip(self, event, fields):
+		new_event = pickle.loads(pickle.dumps(event, pickle.HIGHEST_PROTOCOL))
+		assert_that(new_event, is_(type(event)))
+		expected = {name: getattr(event, name) for name in fields}
+		assert_that(new_event, has_properties(expected))
+		return new_event
+
+	def test_round_trip(self):
+		self._round_trip(watch_video_event,
+						 ('user', 'timestamp', 'RootContextID', 'context_path',
+						  'ResourceId', 'Duration', 'MaxDuration', 'event_type',
+						  'video_start_time', 'video_end_time', 'with_transcript'))
+		self._round_trip(play_speed_event,
+						 ('user', 'timestamp', 'RootContextID', 'ResourceId',
+						  'OldPlaySpeed', 'NewPlaySpeed', 'VideoTime'))
+
+		# Explicit None values survive, rather than reverting to defaults
+		new_event = self._round_trip(start_video_event, ('Duration', 'video_end_time'))
+		assert_that(new_event.video_end_time, none())
+
+	def test_payload(self):
+		version, _, values, extras = encode_event(watch_video_event)
+		assert_that(version, is_(CODEC_VERSION))
+		assert_that(extras, none())
+		assert_that(values, is_(tuple))
+		assert_that(isinstance(decode_event((version, 1, values, None)), WatchVideoEvent),
+					is_(True))
+
+		payload = (CODEC_VERSION + 1, 0, (), None)
+		assert_that(calling(decode_event).with_args(payload), raises(ValueError))
+
+	def test_legacy_state(self):
+		event = ResourceEvent()
+		del event.Duration
+		del event.RootContextID
+		event.__dict__['course'] = 'foo'
+		event.__dict__['time_length'] = 10
+		new_event = pickle.loads(pickle.dumps(event))
+		assert_that(new_event, has_properties('Duration', 10,
+											  'RootContextID', 'foo'))
+
+	def test_unknown_extras(self):
+		event = VideoPlaySpeedChangeEvent(user=u'bob', ResourceId=u'video',
+										  OldPlaySpeed=1, NewPlaySpeed=2,
+										  VideoTime=3, RootContextID=u'course')
+		event.__dict__['extra'] = 42
+		new_event = pickle.loads(pickle.dumps(event))
+		assert_that(new_event.__dict__['extra'], is_(42))
@@ -13,10 +13,22 @@ from datetime import datetime
 
 from unittest import TestCase
 
+from hamcrest import is_
+from hamcrest import is_in
+from hamcrest import contains
+from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import not_none
 
+from nti.analytics import NOTE_VIEW_ANALYTICS
+from nti.analytics import VIDEO_VIEW_ANALYTICS
+
+from nti.analytics import get_partition_name
+from nti.analytics import get_partition_names
+
+from nti.analytics.common import memoized
 from nti.analytics.common import timestamp_type
+from nti.analytics.common import resolution_memo
 
 class TestTimestamp( TestCase ):
 	"""
@@ -37,3 +49,57 @@ class TestTimestamp( TestCase ):
 		result = timestamp_type( ms_ts )
 		assert_that( result, not_none() )
 
+class TestQueuePartitions( TestCase ):
+
+	def test_partition_names(self):
+		names = get_partition_names( VIDEO_VIEW_ANALYTICS, partitions=1 )
+		assert_that( names, contains( VIDEO_VIEW_ANALYTICS ) )
+
+		names = get_partition_names( VIDEO_VIEW_ANALYTICS, partitions=4 )
+		assert_that( names, has_length( 4 ) )
+		assert_that( names[0], is_( VIDEO_VIEW_ANALYTICS ) )
+
+		# Not partitioned
+		names = get_partition_names( NOTE_VIEW_ANALYTICS, partitions=4 )
+		assert_that( names, contains( NOTE_VIEW_ANALYTICS ) )
+
+	def test_partition_name(self):
+		names = get_partition_names( VIDEO_VIEW_ANALYTICS, partitions=4 )
+		name = get_partition_name( VIDEO_VIEW_ANALYTICS, u'bob', partitions=4 )
+		assert_that( name, is_in( names ) )
+		# Stable for a given user
+		for _ in range(5):
+			assert_that( get_partition_name( VIDEO_VIEW_ANALYTICS, u'bob', partitions=4 ),
+						 is_( name ) )
+		# Users are spread across partitions
+		used = {get_partition_name( VIDEO_VIEW_ANALYTICS, u'user%s' % x, partitions=4 )
+				for x in range(50)}
+		assert_that( used, has_length( 4 ) )
+
+		assert_that( get_partition_name( VIDEO_VIEW_ANALYTICS, None, partitions=4 ),
+					 is_( VIDEO_VIEW_ANALYTICS ) )
+
+class TestResolutionMemo( TestCase ):
+
+	def test_memo(self):
+		calls = []
+		def _factory( key ):
+			calls.append( key )
+			return key.upper()
+
+		assert_that( memoized( 'kind', 'a', _factory ), is_( 'A' ) )
+		assert_that( memoized( 'kind', 'a', _factory ), is_( 'A' ) )
+		assert_that( calls, has_length( 2 ) )
+
+		del calls[:]
+		with resolution_memo() as memo:
+			assert_that( memoized( 'kind', 'a', _factory ), is_( 'A' ) )
+			with resolution_memo():
+				assert_that( memoized( 'kind', 'a', _factory ), is_( 'A' ) )
+				assert_that( memoized( 'other', 'a', _factory ), is_( 'A' ) )
+			assert_that( memo, has_length( 2 ) )
+		assert_that( calls, contains( 'a', 'a' ) )
+
+		# Memo is gone
+		memoized( 'kind', 'a', _factory )
+		assert_that( calls, has_length( 3 ) )
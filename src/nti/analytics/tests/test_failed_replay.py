@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+from collections import defaultdict
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import contains
+from hamcrest import has_entry
+from hamcrest import assert_that
+
+from nti.analytics.common import _execute_job
+from nti.analytics.common import _do_execute_batch
+
+from nti.analytics.utils.failed_replay import _pickle
+from nti.analytics.utils.failed_replay import _unpickle
+from nti.analytics.utils.failed_replay import parse_time
+from nti.analytics.utils.failed_replay import scan_failed_jobs
+from nti.analytics.utils.failed_replay import FailedJobFilter
+from nti.analytics.utils.failed_replay import _FailedJobSource
+from nti.analytics.utils.failed_replay import get_job_function_names
+
+
+def _view_op(**unused_kwargs):
+	pass
+
+
+def _delete_op(**unused_kwargs):
+	pass
+
+
+class _MockJob(object):
+
+	def __init__(self, id_, *args, **kwargs):
+		self.id = id_
+		self.callable = _execute_job
+		self.args = args
+		self.kwargs = kwargs
+
+
+class _MockRedis(object):
+
+	def __init__(self):
+		self.lists = defaultdict(list)
+		self.hashes = defaultdict(dict)
+
+	def exists(self, name):
+		return bool(self.lists.get(name))
+
+	def renamenx(self, src, dst):
+		self.lists[dst] = self.lists.pop(src)
+
+	def llen(self, name):
+		return len(self.lists[name])
+
+	def rpoplpush(self, src, dst):
+		items = self.lists[src]
+		if not items:
+			return None
+		data = items.pop()
+		self.lists[dst].insert(0, data)
+		return data
+
+	def lrem(self, name, count, data):
+		items = self.lists[name]
+		for unused in range(count):
+			if data not in items:
+				break
+			items.remove(data)
+
+	def rpush(self, name, data):
+		self.lists[name].append(data)
+
+	def lrange(self, name, start, end):
+		return self.lists[name][start:end + 1]
+
+	def hdel(self, name, *keys):
+		for key in keys:
+			self.hashes[name].pop(key, None)
+
+
+class TestFailedReplay(unittest.TestCase):
+
+	def _jobs(self):
+		return [_MockJob('1', _view_op, site_name='alpha', job_enqueue_time=100),
+				_MockJob('2', _delete_op, site_name='beta', job_enqueue_time=200),
+				_MockJob('3', _do_execute_batch, [(_view_op, {}), (_delete_op, {})],
+						 site_name='alpha')]
+
+	def test_filter(self):
+		jobs = self._jobs()
+		assert_that(get_job_function_names(jobs[2]),
+					contains(__name__ + '._view_op', __name__ + '._delete_op'))
+
+		matcher = FailedJobFilter(functions=('_delete_op',))
+		assert_that([matcher(x) for x in jobs], is_([False, True, True]))
+
+		matcher = FailedJobFilter(site_names=('alpha',), start=50, end=150)
+		# Jobs without a time do not match a time window
+		assert_that([matcher(x) for x in jobs], is_([True, False, False]))
+
+		assert_that(parse_time('1970-01-02'), is_(86400))
+		assert_that(parse_time('10.5'), is_(10.5))
+		assert_that(parse_time(None), none())
+
+	def test_source(self):
+		redis = _MockRedis()
+		for job in self._jobs():
+			redis.rpush('queue/failed', _pickle(job))
+			redis.hashes['queue/failed/hash'][job.id] = '1'
+
+		source = _FailedJobSource(redis, 'queue', FailedJobFilter(site_names=('alpha',)))
+		counts = scan_failed_jobs(redis, 'queue', source.matcher)
+		assert_that(counts, has_entry(('total', None), 2))
+		assert_that(counts, has_entry(('function', __name__ + '._view_op'), 2))
+
+		assert_that(source.stage(), is_(3))
+		assert_that(redis.llen('queue/failed'), is_(0))
+
+		job = source.claim()
+		assert_that(job.id, is_('3'))
+		# Held until completed
+		assert_that(redis.llen('queue/failed/replay/claimed'), is_(1))
+		source.complete([job])
+		assert_that(redis.llen('queue/failed/replay/claimed'), is_(0))
+
+		# A failing job goes back to the failed queue, as do those we skip
+		job = source.claim()
+		assert_that(job.id, is_('1'))
+		source.putFailed(job)
+		assert_that(source.claim(), none())
+		assert_that(source.skipped, is_(1))
+
+		failed = [_unpickle(x).id for x in redis.lists['queue/failed']]
+		assert_that(failed, is_(['2', '1']))
+		assert_that(sorted(redis.hashes['queue/failed/hash']), is_(['1', '2']))
+		assert_that(redis.llen('queue/failed/replay/claimed'), is_(0))
+
+	def test_resume_claimed(self):
+		redis = _MockRedis()
+		for job in self._jobs():
+			redis.rpush('queue/failed', _pickle(job))
+
+		source = _FailedJobSource(redis, 'queue', FailedJobFilter())
+		source.stage()
+		job = source.claim()
+		assert_that(job.id, is_('3'))
+
+		# Our process died before its batch committed; our claimed job
+		# is replayed again
+		source = _FailedJobSource(redis, 'queue', FailedJobFilter())
+		assert_that(source.stage(), is_(3))
+		assert_that(redis.llen('queue/failed/replay/claimed'), is_(0))
+		assert_that(scan_failed_jobs(redis, 'queue', source.matcher),
+					has_entry(('total', None), 3))
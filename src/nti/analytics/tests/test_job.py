@@ -7,13 +7,35 @@ __docformat__ = "restructuredtext en"
 # disable: accessing protected members, too many methods
 # pylint: disable=W0212,R0904
 
+import fudge
+
+import transaction
+
 from hamcrest import is_
+from hamcrest import none
+from hamcrest import contains
+from hamcrest import has_length
 from hamcrest import assert_that
+from hamcrest import instance_of
+
+from zope import component
 
+from zope.component.hooks import site as current_site
+
+from nti.analytics import common
+
+from nti.analytics.common import _site_cache
 from nti.analytics.common import _execute_job
+from nti.analytics.common import _do_execute_batch
+
+from nti.analytics.interfaces import AnalyticsEventValidationError
+
+from nti.analytics.metrics import get_metrics
 
 from nti.analytics.tests import NTIAnalyticsTestCase
 
+from nti.dataserver.interfaces import IDataserver
+
 from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
 
 class TestJob( NTIAnalyticsTestCase ):
@@ -36,3 +58,144 @@ class TestJob( NTIAnalyticsTestCase ):
 		result = _execute_job( self._call, 10, site_name='bleh' )
 		assert_that( result, is_( 10 ) )
 
+class _MockFailedQueue(object):
+
+	def __init__(self):
+		self.name = 'queue'
+		self.failed = []
+
+	def putFailed(self, job):
+		self.failed.append( job )
+
+
+def _run_after_commit_hooks( status ):
+	for hook, args, kwargs in transaction.get().getAfterCommitHooks():
+		hook( status, *args, **kwargs )
+
+
+class TestBatchJob( NTIAnalyticsTestCase ):
+	"""
+	Tests that a batch of jobs can be executed, isolating failures.
+	"""
+
+	def _call( self, arg1 ):
+		self.called.append( arg1 )
+		return arg1
+
+	def _invalid( self, arg1 ):
+		raise AnalyticsEventValidationError( arg1 )
+
+	def _fail( self, arg1 ):
+		raise ValueError( arg1 )
+
+	def setUp(self):
+		super( TestBatchJob, self ).setUp()
+		self.called = []
+
+	@WithMockDSTrans
+	def test_batch(self):
+		jobs = [ (self._call, {'arg1': 1}),
+				 (self._invalid, {'arg1': 2}),
+				 (self._call, {'arg1': 3}) ]
+		result = _execute_job( _do_execute_batch, jobs, site_name='bleh' )
+		assert_that( result, has_length( 3 ) )
+		assert_that( result[0], none() )
+		assert_that( result[1], instance_of( AnalyticsEventValidationError ) )
+		assert_that( result[2], none() )
+		assert_that( self.called, contains( 1, 3 ) )
+
+	@WithMockDSTrans
+	def test_prepared_batch(self):
+		prepared = []
+		jobs = [ (self._call, {'arg1': 1}),
+				 (self._call, {'arg1': 2}) ]
+		_execute_job( _do_execute_batch, jobs,
+					  prepare_batch=prepared.append,
+					  site_name='bleh' )
+		assert_that( prepared, contains( [{'arg1': 1}, {'arg1': 2}] ) )
+		assert_that( self.called, contains( 1, 2 ) )
+
+		# Failing to prepare does not fail our batch
+		def _prepare( unused_kwargs ):
+			raise ValueError()
+		_execute_job( _do_execute_batch, jobs,
+					  prepare_batch=_prepare,
+					  site_name='bleh' )
+		assert_that( self.called, contains( 1, 2, 1, 2 ) )
+
+	@WithMockDSTrans
+	def test_queued_batch(self):
+		queue = _MockFailedQueue()
+		jobs = [ (self._call, {'arg1': 1}),
+				 (self._fail, {'arg1': 2}),
+				 (self._call, {'arg1': 3}) ]
+		_execute_job( _do_execute_batch, jobs,
+					  get_job_queue=lambda: queue,
+					  event_site_name='bleh',
+					  site_name='bleh' )
+		assert_that( self.called, contains( 1, 3 ) )
+		# Only once our batch commits
+		assert_that( queue.failed, has_length( 0 ) )
+		_run_after_commit_hooks( False )
+		assert_that( queue.failed, has_length( 0 ) )
+		# Only our failing op is placed on the failed queue
+		get_metrics().reset()
+		_run_after_commit_hooks( True )
+		assert_that( queue.failed, has_length( 1 ) )
+		assert_that( get_metrics().queues['queue'].failed, is_( 1 ) )
+		assert_that( queue.failed[0].kwargs.get( 'arg1' ), is_( 2 ) )
+
+	@WithMockDSTrans
+	def test_partitioned_batch(self):
+		queues = {}
+		def _get_job_queue( partition_key=None ):
+			return queues.setdefault( partition_key, _MockFailedQueue() )
+		jobs = [ (self._fail, {'arg1': 1}) ]
+		_execute_job( _do_execute_batch, jobs,
+					  get_job_queue=_get_job_queue,
+					  event_site_name='bleh',
+					  partition_key='user1',
+					  site_name='bleh' )
+		# Our failed op is placed on its partition's failed queue
+		_run_after_commit_hooks( True )
+		assert_that( queues, has_length( 1 ) )
+		assert_that( queues['user1'].failed, has_length( 1 ) )
+
+
+class TestSiteCache( NTIAnalyticsTestCase ):
+	"""
+	Tests that resolved sites are cached until our host sites sync.
+	"""
+
+	def setUp(self):
+		super( TestSiteCache, self ).setUp()
+		self.resolved = []
+		_site_cache.reset( None )
+
+	def tearDown(self):
+		_site_cache.reset( None )
+		super( TestSiteCache, self ).tearDown()
+
+	def _resolve_site( self, site_name ):
+		self.resolved.append( site_name )
+		return self.ds_folder
+
+	@WithMockDSTrans
+	@fudge.patch( 'nti.analytics.common._get_site_sync_time',
+				  'nti.analytics.common._resolve_site' )
+	def test_site_cache(self, mock_sync_time, mock_resolve_site):
+		sync_times = [1]
+		mock_sync_time.is_callable().calls( lambda: sync_times[-1] )
+		mock_resolve_site.is_callable().calls( self._resolve_site )
+		dataserver = component.getUtility( IDataserver )
+		self.ds_folder = dataserver.root_folder['dataserver2']
+		get_site = common._get_site_for_site_name
+		with current_site( self.ds_folder ):
+			assert_that( get_site( self.ds_folder, 'bleh' ), is_( self.ds_folder ) )
+			assert_that( get_site( self.ds_folder, 'bleh' ), is_( self.ds_folder ) )
+			assert_that( self.resolved, has_length( 1 ) )
+
+			# Sync invalidates
+			sync_times.append( 2 )
+			assert_that( get_site( self.ds_folder, 'bleh' ), is_( self.ds_folder ) )
+			assert_that( self.resolved, has_length( 2 ) )
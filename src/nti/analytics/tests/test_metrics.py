@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+import transaction
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_key
+from hamcrest import has_entry
+from hamcrest import assert_that
+from hamcrest import has_property
+from hamcrest import has_entries
+
+from nti.analytics import QUEUE_NAMES
+
+from nti.analytics.common import _do_execute_recorded_job
+
+from nti.analytics.metrics import AnalyticsMetrics
+
+from nti.analytics.metrics import get_metrics
+from nti.analytics.metrics import get_function_name
+from nti.analytics.metrics import sample_queue_depths
+
+
+def _op(fail=False):
+	if fail:
+		raise ValueError()
+	return 1
+
+
+class _MockQueue(object):
+
+	def __init__(self, size):
+		self.size = size
+
+	def __len__(self):
+		return self.size
+
+
+class _MockFactory(object):
+
+	def get_queue(self, name):
+		return _MockQueue(len(name))
+
+
+class TestMetrics(unittest.TestCase):
+
+	def setUp(self):
+		get_metrics().reset()
+
+	def tearDown(self):
+		transaction.abort()
+		get_metrics().reset()
+
+	def test_registry(self):
+		metrics = AnalyticsMetrics()
+		metrics.record_enqueue('queue')
+		metrics.record_job('queue', 10, now=12)
+		metrics.record_job('queue', 10, failed=True, now=16)
+		metrics.record_commit('queue', 10, True, now=20)
+		metrics.record_execution('func', 0.5)
+
+		snapshot = metrics.snapshot()
+		assert_that(snapshot['queues']['queue'],
+					has_entries('enqueued', 1,
+								'executed', 2,
+								'failed', 1,
+								'depth', none(),
+								'wait', has_entries('count', 2,
+													'mean', 4.0,
+													'max', 6),
+								'commit_latency', has_entries('count', 1,
+															  'max', 10)))
+		assert_that(snapshot['functions']['func'],
+					has_entries('failed', 0,
+								'execution', has_entry('total', 0.5)))
+
+	def test_recorded_job(self):
+		metrics = get_metrics()
+		transaction.begin()
+		result = _do_execute_recorded_job('queue', 0, _op)
+		assert_that(result, is_(1))
+		assert_that(metrics.queues['queue'].commit_latency.count, is_(0))
+		transaction.commit()
+		assert_that(metrics.queues['queue'].commit_latency.count, is_(1))
+		assert_that(metrics.queues['queue'].wait.count, is_(1))
+
+		transaction.begin()
+		assert_that(calling(_do_execute_recorded_job).with_args('queue', 0, _op, fail=True),
+					raises(ValueError))
+		assert_that(metrics.queues['queue'].failed, is_(1))
+		assert_that(metrics.functions[get_function_name(_op)],
+					has_property('failed', 1))
+
+		# Unstamped jobs are only recorded by function
+		_do_execute_recorded_job(None, None, _op)
+		assert_that(metrics.snapshot()['queues'], has_key('queue'))
+		assert_that(metrics.queues['queue'].executed, is_(2))
+		assert_that(metrics.functions[get_function_name(_op)].execution.count, is_(3))
+
+	def test_queue_depths(self):
+		depths = sample_queue_depths(_MockFactory())
+		assert_that(depths, has_entry(QUEUE_NAMES[0], len(QUEUE_NAMES[0])))
+		snapshot = get_metrics().snapshot()
+		assert_that(snapshot['queues'][QUEUE_NAMES[0]],
+					has_entry('depth', len(QUEUE_NAMES[0])))
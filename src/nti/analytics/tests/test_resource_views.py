@@ -10,6 +10,7 @@ from __future__ import absolute_import
 
 import time
 import fudge
+import unittest
 import zope.intid
 
 from zope import component
@@ -18,11 +19,15 @@ from hamcrest import is_
 from hamcrest import none
 from hamcrest import not_none
 from hamcrest import assert_that
+from hamcrest import contains
 from hamcrest import has_length
 from hamcrest import contains_inanyorder
 
 from nti.analytics.database import resource_views as db_views
 
+from nti.analytics.model import ResourceEvent
+from nti.analytics.model import WatchVideoEvent
+
 from nti.analytics.progress import get_progress_for_video_views
 from nti.analytics.progress import get_progress_for_resource_views
 from nti.analytics.progress import get_video_progress_for_course
@@ -32,6 +37,7 @@ from nti.analytics.resource_views import get_video_views_for_ntiid
 from nti.analytics.resource_views import get_user_video_views_for_ntiid
 from nti.analytics.resource_views import get_user_resource_views_for_ntiid
 from nti.analytics.resource_views import get_watched_segments_for_ntiid
+from nti.analytics.resource_views import _coalesce_heartbeats
 
 from nti.analytics.tests import test_session_id
 from nti.analytics.tests import AnalyticsTestBase
@@ -255,3 +261,53 @@ class TestResourceViews( NTIAnalyticsTestCase ):
 		results = get_watched_segments_for_ntiid(video_ntiid)
 
 		assert_that(results, is_([(100, 200, 1)]))
+
+
+class TestCoalesceHeartbeats(unittest.TestCase):
+
+	def _video_event(self, duration, resource_id=u'tag:nextthought.com,2011-10:video1',
+					 timestamp=1421118460):
+		return WatchVideoEvent(user=u'bob',
+							   timestamp=timestamp,
+							   RootContextID=u'tag:nextthought.com,2011-10:course1',
+							   ResourceId=resource_id,
+							   Duration=duration,
+							   video_start_time=10,
+							   video_end_time=10 + (duration or 0),
+							   with_transcript=False)
+
+	def test_coalesce(self):
+		start = self._video_event(None)
+		beat1 = self._video_event(10)
+		beat2 = self._video_event(20)
+		other_video = self._video_event(5, resource_id=u'tag:nextthought.com,2011-10:video2')
+		other_time = self._video_event(5, timestamp=1421118999)
+		resource = ResourceEvent(user=u'bob',
+								 timestamp=1421118460,
+								 RootContextID=u'tag:nextthought.com,2011-10:course1',
+								 ResourceId=u'tag:nextthought.com,2011-10:video1',
+								 Duration=30)
+
+		events = [start, beat1, other_video, beat2, other_time, resource]
+		result, coalesced = _coalesce_heartbeats(events)
+		assert_that(result, contains(beat2, other_video, other_time, resource))
+		assert_that(coalesced, contains_inanyorder(start, beat1))
+
+		# Out of order heartbeats keep the longest
+		result, coalesced = _coalesce_heartbeats([beat2, beat1])
+		assert_that(result, contains(beat2))
+		assert_that(coalesced, contains(beat1))
+
+	def test_coalesce_start_end(self):
+		# Heartbeats with only their video start and end times
+		beat1 = self._video_event(None)
+		beat1.video_end_time = 20
+		beat2 = self._video_event(None)
+		beat2.video_end_time = 40
+		result, coalesced = _coalesce_heartbeats([beat1, beat2])
+		assert_that(result, contains(beat2))
+		assert_that(coalesced, contains(beat1))
+
+		result, coalesced = _coalesce_heartbeats([beat2, beat1])
+		assert_that(result, contains(beat2))
+		assert_that(coalesced, contains(beat1))
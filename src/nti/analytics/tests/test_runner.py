@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+import transaction
+
+from hamcrest import is_
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import raises
+
+from transaction.interfaces import TransientError
+
+from nti.analytics.runner import AnalyticsBatchJobRunner
+from nti.analytics.runner import record_transient_error
+
+
+class _MockJob(object):
+
+	def __init__(self, value, fail=False):
+		self.value = value
+		self.fail = fail
+		self.called = False
+
+	def __call__(self):
+		self.called = True
+		if self.fail:
+			raise ValueError(self.value)
+		return self.value
+
+
+class _TrappingJob(object):
+	"""
+	Traps its errors, as our queue jobs do.
+	"""
+
+	def __init__(self, error):
+		self.error = None
+		self._error = error
+
+	def __call__(self):
+		try:
+			raise self._error
+		except TransientError as e:
+			record_transient_error(e)
+		except Exception as e:
+			self.error = e
+
+	def has_failed(self):
+		return True
+
+
+class _MockQueue(object):
+
+	def __init__(self, jobs):
+		self.jobs = list(jobs)
+		self.failed = []
+
+	def claim(self):
+		return self.jobs.pop(0) if self.jobs else None
+
+	def putFailed(self, job):
+		self.failed.append(job)
+
+
+class _TransactionRunner(AnalyticsBatchJobRunner):
+
+	attempts = 0
+
+	def _run_in_transaction(self, func):
+		for _ in range(self.retries + 1):
+			self.attempts += 1
+			transaction.begin()
+			try:
+				result = func()
+				transaction.commit()
+				return result
+			except TransientError:
+				transaction.abort()
+		raise TransientError()
+
+
+class TestBatchJobRunner(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_claim_batch(self):
+		queue = _MockQueue([_MockJob(x) for x in range(5)])
+		runner = AnalyticsBatchJobRunner(queue, batch_size=3, max_wait=0)
+		batch = runner.claim_batch()
+		assert_that(batch, has_length(3))
+		batch = runner.claim_batch()
+		assert_that(batch, has_length(2))
+		assert_that(runner.claim_batch(), has_length(0))
+
+	def test_execute_batch(self):
+		jobs = [_MockJob(1), _MockJob(2, fail=True), _MockJob(3)]
+		queue = _MockQueue(())
+		runner = AnalyticsBatchJobRunner(queue, max_wait=0)
+		transaction.begin()
+		failed = runner.execute_batch(jobs)
+		assert_that(failed, contains(jobs[1]))
+		assert_that([x.called for x in jobs], is_([True, True, True]))
+
+	def test_transient_error(self):
+		queue = _MockQueue(())
+		runner = AnalyticsBatchJobRunner(queue, max_wait=0)
+		transaction.begin()
+		jobs = [_TrappingJob(TransientError())]
+		assert_that(calling(runner.execute_batch).with_args(jobs),
+					raises(TransientError))
+		jobs = [_TrappingJob(ValueError())]
+		assert_that(runner.execute_batch(jobs), is_(jobs))
+
+	def test_failed_once(self):
+		jobs = [_MockJob(1), _MockJob(2, fail=True)]
+		queue = _MockQueue(jobs)
+		runner = _TransactionRunner(queue, max_wait=0)
+		attempts = []
+
+		def _execute_batch(batch):
+			attempts.append(batch)
+			result = AnalyticsBatchJobRunner.execute_batch(runner, batch)
+			if len(attempts) == 1:
+				raise TransientError()
+			return result
+		runner.execute_batch = _execute_batch
+
+		assert_that(runner(), is_(2))
+		# Retried, but our failed job is only put once, after commit
+		assert_that(attempts, has_length(2))
+		assert_that(queue.failed, contains(jobs[1]))
+
+	def test_batch_failed(self):
+		jobs = [_MockJob(1), _MockJob(2, fail=True)]
+		queue = _MockQueue(jobs)
+		runner = _TransactionRunner(queue, max_wait=0, retries=1)
+
+		def _execute_batch(batch):
+			AnalyticsBatchJobRunner.execute_batch(runner, batch)
+			raise TransientError()
+		runner.execute_batch = _execute_batch
+		runner.batch_failed = lambda *args: None
+
+		assert_that(runner(), is_(2))
+		# Both attempts, then putting our jobs
+		assert_that(runner.attempts, is_(3))
+		# Each of our jobs is put once
+		assert_that(queue.failed, is_(jobs))
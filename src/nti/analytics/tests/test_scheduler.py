@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+from collections import Counter
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+
+from nti.analytics import USERS_ANALYTICS
+from nti.analytics import DELETE_ANALYTICS
+from nti.analytics import VIDEO_VIEW_ANALYTICS
+
+from nti.analytics.scheduler import PRIORITY_WEIGHT
+from nti.analytics.scheduler import PRIORITY_MAX_LATENCY
+
+from nti.analytics.scheduler import WeightedQueueScheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+	def test_defaults(self):
+		scheduler = WeightedQueueScheduler((VIDEO_VIEW_ANALYTICS + '++1',
+											DELETE_ANALYTICS),
+										   weights={VIDEO_VIEW_ANALYTICS: 2})
+		assert_that(scheduler.weights[VIDEO_VIEW_ANALYTICS + '++1'], is_(2))
+		assert_that(scheduler.weights[DELETE_ANALYTICS], is_(PRIORITY_WEIGHT))
+		assert_that(scheduler.max_latency[VIDEO_VIEW_ANALYTICS + '++1'], none())
+		assert_that(scheduler.max_latency[DELETE_ANALYTICS], is_(PRIORITY_MAX_LATENCY))
+
+	def test_weights(self):
+		scheduler = WeightedQueueScheduler(('a', 'b', 'c'),
+										   weights={'a': 3, 'b': 1})
+		depths = {'a': 10, 'b': 10, 'c': 0}
+		picks = [scheduler.select(depths, now=0) for _ in range(8)]
+		assert_that(Counter(picks), is_({'a': 6, 'b': 2}))
+		# Interleaved, not in runs
+		assert_that(picks[:4], is_(['a', 'a', 'b', 'a']))
+
+		assert_that(scheduler.select({}, now=0), none())
+
+	def test_max_latency(self):
+		scheduler = WeightedQueueScheduler((VIDEO_VIEW_ANALYTICS, USERS_ANALYTICS),
+										   weights={VIDEO_VIEW_ANALYTICS: 100},
+										   max_latency={USERS_ANALYTICS: 5},
+										   now=0)
+		depths = {VIDEO_VIEW_ANALYTICS: 1000, USERS_ANALYTICS: 1}
+		assert_that(scheduler.select(depths, now=1), is_(VIDEO_VIEW_ANALYTICS))
+		assert_that(scheduler.select(depths, now=4), is_(VIDEO_VIEW_ANALYTICS))
+		# Overdue
+		assert_that(scheduler.select(depths, now=5), is_(USERS_ANALYTICS))
+		assert_that(scheduler.select(depths, now=6), is_(VIDEO_VIEW_ANALYTICS))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+import fudge
+
+from hamcrest import is_
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import has_item
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+
+from nti.analytics import QUEUE_NAMES
+from nti.analytics import USERS_ANALYTICS
+from nti.analytics import SESSIONS_ANALYTICS
+from nti.analytics import RESOURCE_VIEW_ANALYTICS
+
+from nti.analytics.metrics import get_metrics
+
+from nti.analytics.utils.worker import assign_queues
+from nti.analytics.utils.worker import parse_queue_values
+from nti.analytics.utils.worker import _AnalyticsWorker
+
+from nti.analytics.zcml import _AnalyticsBatchingRedisProcessingQueueFactory
+
+
+class _MockQueue(object):
+
+	def __init__(self, counts):
+		self.counts = list(counts)
+
+	def __len__(self):
+		return len(self.counts)
+
+
+class _MockClaimQueue(object):
+
+	def claim(self):
+		return None
+
+
+class _MockRunner(object):
+
+	def __init__(self, counts):
+		self.queue = _MockQueue(counts)
+
+	def __call__(self):
+		return self.queue.counts.pop(0)
+
+
+class TestWorker(unittest.TestCase):
+
+	def test_assign_queues(self):
+		result = assign_queues(1)
+		assert_that(result, contains(QUEUE_NAMES))
+
+		result = assign_queues(3, affinity=[['resource++views', 'sessions'],
+											[USERS_ANALYTICS]])
+		assert_that(result, has_length(3))
+		assert_that(result[0], has_item(RESOURCE_VIEW_ANALYTICS))
+		assert_that(result[0], has_item(SESSIONS_ANALYTICS))
+		assert_that(result[1], contains(USERS_ANALYTICS))
+		# Everything else lands on the unpinned worker
+		assert_that(result[2], has_length(len(QUEUE_NAMES) - len(result[0]) - 1))
+		assert_that([x for group in result for x in group],
+					contains_inanyorder(*QUEUE_NAMES))
+
+		assert_that(calling(assign_queues).with_args(1, affinity=[['sessions'], ['users']]),
+					raises(ValueError))
+		assert_that(calling(assign_queues).with_args(1, affinity=[['unknown']]),
+					raises(ValueError))
+
+	def test_worker(self):
+		worker = _AnalyticsWorker(('queue1', 'queue2'), idle_sleep=0)
+		runners = [_MockRunner((2, 1)), _MockRunner((3,))]
+		worker.get_runners = lambda: runners
+
+		get_depths = worker.get_depths
+		def _get_depths(runners):
+			result = get_depths(runners)
+			if not any(result.values()):
+				worker.stop()
+			return result
+		worker.get_depths = _get_depths
+
+		assert_that(worker(), is_(6))
+		assert_that(worker.running, is_(False))
+		# Our sampled depths
+		assert_that(get_metrics().queues['queue2'].depth, is_(0))
+
+	@fudge.patch('nti.analytics.utils.worker.get_factory')
+	def test_get_runners(self, mock_get_factory):
+		factory = _AnalyticsBatchingRedisProcessingQueueFactory.__new__(
+							_AnalyticsBatchingRedisProcessingQueueFactory)
+		factory.batch_size = 10
+		factory.max_wait = 250
+		factory.get_queue = lambda unused_name: _MockClaimQueue()
+		mock_get_factory.is_callable().returns(factory)
+
+		# Our configured batch settings
+		worker = _AnalyticsWorker(('queue1',), site_names=('alpha',))
+		runner, = worker.get_runners()
+		assert_that(runner.batch_size, is_(10))
+		assert_that(runner.max_wait, is_(250))
+		assert_that(runner.site_names, is_(('alpha',)))
+
+		worker = _AnalyticsWorker(('queue1',), batch_size=5)
+		runner, = worker.get_runners()
+		assert_that(runner.batch_size, is_(5))
+		assert_that(runner.max_wait, is_(250))
+
+	def test_parse_queue_values(self):
+		result = parse_queue_values(['sessions=3', '%s=2' % USERS_ANALYTICS], int)
+		assert_that(result, is_({SESSIONS_ANALYTICS: 3, USERS_ANALYTICS: 2}))
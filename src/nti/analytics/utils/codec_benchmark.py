@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the compact analytics event wire format (:mod:`nti.analytics.codec`)
+against the legacy `SchemaConfigured` pickles, for payload size (raw and
+zlib compressed, as queued) and encode/decode cost.
+
+Usage::
+
+	python -m nti.analytics.utils.codec_benchmark [-n COUNT] [-r REPEAT]
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import time
+import zlib
+import argparse
+
+try:
+	import cPickle as pickle
+	import copy_reg as copyreg
+except ImportError:  # pragma: no cover
+	import pickle
+	import copyreg
+
+from contextlib import contextmanager
+
+from nti.analytics.codec import EVENT_TYPES
+
+from nti.analytics.model import ResourceEvent
+from nti.analytics.model import WatchVideoEvent
+
+from zope.dottedname.resolve import resolve
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+
+def _legacy_reduce(event):
+	return (copyreg.__newobj__, (type(event),), dict(event.__dict__))
+
+
+@contextmanager
+def _legacy_pickles():
+	"""
+	Temporarily pickle our events the way we did before the codec.
+	"""
+	classes = [resolve(name) for name, _ in EVENT_TYPES]
+	for cls in classes:
+		copyreg.dispatch_table[cls] = _legacy_reduce
+	try:
+		yield
+	finally:
+		for cls in classes:
+			copyreg.dispatch_table.pop(cls, None)
+
+
+def _sample_events(count):
+	result = []
+	root_context = 'tag:nextthought.com,2011-10:NTI-CourseInfo-Fall2015_CS_1323'
+	context_path = [root_context,
+					'tag:nextthought.com,2011-10:NTI-NTICourseOutlineNode-Fall2015_CS_1323.0.1',
+					'tag:nextthought.com,2011-10:NTI-HTML-CS1323_F_2015_Intro_to_Computer_Programming.lec:01.01']
+	for idx in range(count):
+		username = 'student%s@example.edu' % (idx % 50)
+		timestamp = 1444936880.005 + idx
+		if idx % 2:
+			event = WatchVideoEvent(user=username,
+									timestamp=timestamp,
+									RootContextID=root_context,
+									context_path=context_path,
+									ResourceId='tag:nextthought.com,2011-10:NTI-NTIVideo-CS1323.ntivideo.video_%s' % idx,
+									Duration=30 + idx % 60,
+									MaxDuration=600,
+									video_start_time=idx % 300,
+									video_end_time=idx % 300 + 30,
+									with_transcript=False)
+		else:
+			event = ResourceEvent(user=username,
+								  timestamp=timestamp,
+								  RootContextID=root_context,
+								  context_path=context_path,
+								  ResourceId='tag:nextthought.com,2011-10:NTI-RelatedWorkRef-CS1323.relatedworkref.%s' % idx,
+								  Duration=45)
+		result.append(event)
+	return result
+
+
+def _time(func, repeat):
+	best = None
+	for _ in range(repeat):
+		start = time.time()
+		func()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def _measure(events, repeat):
+	# Events are queued one per job, so measure them individually.
+	payloads = [pickle.dumps(x, PROTOCOL) for x in events]
+	raw_size = sum(len(x) for x in payloads)
+	zlib_size = sum(len(zlib.compress(x)) for x in payloads)
+	encode = _time(lambda: [pickle.dumps(x, PROTOCOL) for x in events], repeat)
+	decode = _time(lambda: [pickle.loads(x) for x in payloads], repeat)
+	return raw_size, zlib_size, encode, decode
+
+
+def _report(label, count, measures):
+	raw_size, zlib_size, encode, decode = measures
+	print('%-8s raw=%8.1fB/event zlib=%8.1fB/event encode=%7.2fus/event decode=%7.2fus/event'
+		  % (label, raw_size / count, zlib_size / count,
+			 encode * 1e6 / count, decode * 1e6 / count))
+
+
+def main():
+	arg_parser = argparse.ArgumentParser(description="Benchmark the analytics event codec.")
+	arg_parser.add_argument('-n', '--count', dest='count', type=int, default=10000,
+							help="The number of events to encode")
+	arg_parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+							help="The number of timing runs (best is reported)")
+	args = arg_parser.parse_args()
+
+	events = _sample_events(args.count)
+	with _legacy_pickles():
+		legacy = _measure(events, args.repeat)
+	compact = _measure(events, args.repeat)
+
+	_report('legacy', args.count, legacy)
+	_report('compact', args.count, compact)
+	print('size ratio raw=%.2f zlib=%.2f' % (compact[0] / legacy[0],
+											 compact[1] / legacy[1]))
+
+
+if __name__ == '__main__':
+	main()
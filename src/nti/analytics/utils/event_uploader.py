@@ -47,6 +47,7 @@ from nti.analytics import resource_views
 
 from nti.analytics.common import timestamp_type
 from nti.analytics.common import process_event
+from nti.analytics.common import resolution_memo
 
 from nti.analytics.resource_views import UnrecoverableAnalyticsError
 
@@ -97,7 +98,13 @@ BATCH_SIZE = 5000
 
 def _load_events(events):
 	if events:
-		return resource_views.handle_events(events, return_invalid=False)
+		# We rely on our patched `process_event`, so do not batch. Our
+		# events all run in this transaction, so we can still resolve
+		# their users, courses and resources in bulk up front.
+		with resolution_memo():
+			resource_views.resolve_event_dimensions(events)
+			return resource_views.handle_events(events, return_invalid=False,
+												batch=False)
 	return 0, 0
 
 def _process_batch_events(events):
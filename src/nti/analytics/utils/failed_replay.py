@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Replay the jobs on the failed analytics queues (`<queue>/failed`), e.g.
+after a database outage.
+
+Jobs may be filtered by job function, site and time window (when queued,
+or else the event time). Each failed queue is first staged for replay
+(renamed to `<queue>/failed/replay`), so that jobs that fail again, or
+that do not match our filters, go back to the failed queue without being
+seen twice. The staged jobs are then replayed, in batches of one
+transaction each, by `N` worker processes. Claimed jobs are held (on
+`<queue>/failed/replay/claimed`) until their batch's outcome is known.
+An interrupted replay resumes from the staged and claimed jobs.
+
+With `--dry_run`, we only report the matching jobs.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import os
+import sys
+import zlib
+import signal
+import logging
+import argparse
+import calendar
+import multiprocessing
+
+from collections import Counter
+
+try:
+	from Queue import Empty
+except ImportError:  # pragma: no cover
+	from queue import Empty
+
+from datetime import datetime
+
+import transaction
+
+try:
+	import cPickle as pickle
+except ImportError:  # pragma: no cover
+	import pickle
+
+from zope import component
+
+from nti.dataserver.interfaces import IRedisClient
+
+from nti.dataserver.utils import run_with_dataserver
+
+from nti.analytics import QUEUE_NAMES
+
+from nti.analytics.common import _execute_job
+from nti.analytics.common import _do_execute_batch
+
+from nti.analytics.metrics import get_function_name
+
+from nti.analytics.runner import DEFAULT_BATCH_SIZE
+
+from nti.analytics.runner import AnalyticsJobFailedError
+from nti.analytics.runner import AnalyticsBatchJobRunner
+
+from nti.analytics.utils.ds_migrator import Processor as _MigratorProcessor
+
+from nti.analytics.utils.worker import get_queue_name
+
+FAILED_SUFFIX = '/failed'
+REPLAY_SUFFIX = '/replay'
+CLAIMED_SUFFIX = '/claimed'
+HASH_SUFFIX = '/hash'
+
+
+def _pickle(job):
+	return zlib.compress(pickle.dumps(job, pickle.HIGHEST_PROTOCOL))
+
+
+def _unpickle(data):
+	return pickle.loads(zlib.decompress(data))
+
+
+def _job_kwargs(job):
+	return getattr(job, 'kwargs', None) or {}
+
+
+def get_job_function_names(job):
+	"""
+	Return the names of the analytics ops the job executes.
+	"""
+	func = getattr(job, 'callable', None)
+	args = getattr(job, 'args', None) or ()
+	if func is _execute_job and args:
+		func, args = args[0], args[1:]
+	if func is _do_execute_batch and args:
+		return [get_function_name(op) for op, _ in args[0]]
+	return [get_function_name(func)]
+
+
+def get_job_site_name(job):
+	return _job_kwargs(job).get('site_name')
+
+
+def _to_epoch(value):
+	if isinstance(value, datetime):
+		return calendar.timegm(value.utctimetuple())
+	if value is not None and value > 10000000000:
+		# Milliseconds
+		value = value / 1000
+	return value
+
+
+def get_job_time(job):
+	"""
+	Return when the job was queued or, for older jobs, the event time
+	(in epoch seconds), if known.
+	"""
+	kwargs = _job_kwargs(job)
+	result = kwargs.get('job_enqueue_time')
+	if result is None:
+		event = kwargs.get('event')
+		result = getattr(event, 'timestamp', None) or kwargs.get('timestamp')
+	try:
+		return _to_epoch(result)
+	except TypeError:
+		return None
+
+
+def get_error_name(error):
+	"""
+	Return a name to group errors by: the exception type or, for jobs
+	that recorded their failure, the type (or first line) of that error.
+	"""
+	if isinstance(error, AnalyticsJobFailedError) and error.args:
+		error = error.args[0]
+	if isinstance(error, BaseException):
+		return type(error).__name__
+	for name in ('error_type', 'type', 'message'):
+		value = getattr(error, name, None)
+		if value:
+			return ('%s' % value).strip().split('\n')[0][:80]
+	return type(error).__name__
+
+
+def parse_time(value):
+	"""
+	Parse epoch seconds or a (UTC) `YYYY-MM-DD[THH:MM:SS]` string.
+	"""
+	if value is None:
+		return None
+	try:
+		return float(value)
+	except ValueError:
+		pass
+	for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+		try:
+			return _to_epoch(datetime.strptime(value, fmt))
+		except ValueError:
+			pass
+	raise ValueError("Invalid time (%s)" % value)
+
+
+class FailedJobFilter(object):
+	"""
+	Matches jobs by job function (dotted or bare name), site name and
+	time window; unset criteria match everything.
+	"""
+
+	def __init__(self, functions=(), site_names=(), start=None, end=None):
+		self.functions = set(functions or ())
+		self.site_names = set(site_names or ())
+		self.start = start
+		self.end = end
+
+	def _match_function(self, job):
+		for name in get_job_function_names(job):
+			if name in self.functions or name.rsplit('.', 1)[-1] in self.functions:
+				return True
+		return False
+
+	def _match_time(self, job):
+		job_time = get_job_time(job)
+		if job_time is None:
+			return False
+		if self.start is not None and job_time < self.start:
+			return False
+		if self.end is not None and job_time >= self.end:
+			return False
+		return True
+
+	def __call__(self, job):
+		if self.functions and not self._match_function(job):
+			return False
+		if self.site_names and get_job_site_name(job) not in self.site_names:
+			return False
+		if (self.start is not None or self.end is not None) and not self._match_time(job):
+			return False
+		return True
+
+
+class _FailedJobSource(object):
+	"""
+	The staged jobs of a failed queue, claimable by our batch runner.
+	Non-matching and failing jobs go back to the failed queue.
+
+	Claimed jobs are atomically moved to our claimed list, and only
+	removed once completed (after commit) or put back on the failed queue.
+	"""
+
+	def __init__(self, redis, name, matcher):
+		self.redis = redis
+		self.matcher = matcher
+		self.failed_name = name + FAILED_SUFFIX
+		self.staged_name = self.failed_name + REPLAY_SUFFIX
+		self.claimed_name = self.staged_name + CLAIMED_SUFFIX
+		self.hash_key = self.failed_name + HASH_SUFFIX
+		self.skipped = 0
+		self.errors = Counter()
+		self._claimed = {}
+
+	def stage(self):
+		"""
+		Stage the failed queue for replay, returning the number of staged
+		jobs. Any previously staged (or claimed) jobs are resumed instead.
+		"""
+		resumed = 0
+		while self.redis.rpoplpush(self.claimed_name, self.staged_name) is not None:
+			resumed += 1
+		if resumed:
+			logger.info('Resuming claimed failed jobs (%s) (count=%s)',
+						self.claimed_name, resumed)
+		if not self.redis.exists(self.staged_name):
+			if not self.redis.exists(self.failed_name):
+				return 0
+			self.redis.renamenx(self.failed_name, self.staged_name)
+		else:
+			logger.info('Resuming staged failed jobs (%s)', self.staged_name)
+		return len(self)
+
+	def __len__(self):
+		return self.redis.llen(self.staged_name)
+
+	def _release(self, data):
+		self.redis.lrem(self.claimed_name, 1, data)
+
+	def claim(self):
+		while True:
+			data = self.redis.rpoplpush(self.staged_name, self.claimed_name)
+			if data is None:
+				return None
+			try:
+				job = _unpickle(data)
+			except Exception as e:
+				logger.warn('Cannot unpickle failed job (%s) (%s)', self.failed_name, e)
+				self.errors[type(e).__name__] += 1
+				job = None
+			if job is not None and self.matcher(job):
+				self._claimed[id(job)] = data
+				return job
+			self.redis.rpush(self.failed_name, data)
+			self._release(data)
+			self.skipped += job is not None
+
+	def putFailed(self, job):
+		"""
+		Put the claimed job back on the failed queue, as it was claimed.
+		Our runner only does so once the outcome of its batch is known.
+		"""
+		data = self._claimed.pop(id(job), None)
+		if data is None:
+			data = _pickle(job)
+		self.redis.rpush(self.failed_name, data)
+		self._release(data)
+
+	def complete(self, jobs):
+		ids = [x.id for x in jobs if getattr(x, 'id', None)]
+		if ids:
+			self.redis.hdel(self.hash_key, *ids)
+		for job in jobs:
+			data = self._claimed.pop(id(job), None)
+			if data is not None:
+				self._release(data)
+
+
+class _FailedJobReplayer(AnalyticsBatchJobRunner):
+	"""
+	Replays the jobs of a :class:`_FailedJobSource`, counting errors by type.
+	"""
+
+	def __init__(self, source, **kwargs):
+		super(_FailedJobReplayer, self).__init__(source, max_wait=0, **kwargs)
+		self.replayed = 0
+		self.errors = source.errors
+
+	def job_failed(self, job, error):
+		self.errors[get_error_name(error)] += 1
+		logger.debug('Replayed analytics job failed (%s)', job, exc_info=True)
+
+	def batch_failed(self, jobs, error):
+		self.errors[get_error_name(error)] += len(jobs)
+		logger.warn('Replayed analytics batch failed to commit (size=%s) (%s)',
+					len(jobs), error)
+
+	def _after_commit(self, status, jobs):
+		if status:
+			self.queue.complete(jobs)
+			self.replayed += len(jobs)
+
+	def _execute_and_record(self, jobs):
+		failed = super(_FailedJobReplayer, self)._execute_and_record(jobs)
+		failed_ids = set(id(x) for x in failed)
+		succeeded = [x for x in jobs if id(x) not in failed_ids]
+		transaction.get().addAfterCommitHook(self._after_commit, args=(succeeded,))
+		return failed
+
+
+def scan_failed_jobs(redis, name, matcher, chunk_size=1000):
+	"""
+	Count (without modifying) the matching jobs on the given failed queue,
+	by job function and site.
+	"""
+	result = Counter()
+	failed_name = name + FAILED_SUFFIX
+	staged_name = failed_name + REPLAY_SUFFIX
+	for key in (failed_name, staged_name, staged_name + CLAIMED_SUFFIX):
+		start = 0
+		while True:
+			data = redis.lrange(key, start, start + chunk_size - 1)
+			if not data:
+				break
+			start += len(data)
+			for item in data:
+				try:
+					job = _unpickle(item)
+				except Exception as e:
+					result[('error', type(e).__name__)] += 1
+					continue
+				if matcher(job):
+					for func_name in get_job_function_names(job):
+						result[('function', func_name)] += 1
+					result[('site', get_job_site_name(job))] += 1
+					result[('total', None)] += 1
+	return result
+
+
+class _FailedJobReplay(object):
+
+	def __init__(self, queue_names, matcher, batch_size=DEFAULT_BATCH_SIZE,
+				 site_names=(), stage=True, staged=None):
+		self.running = True
+		self.stage = stage
+		self.staged = staged
+		self.matcher = matcher
+		self.batch_size = batch_size
+		self.site_names = site_names
+		self.queue_names = queue_names
+
+	def stop(self, *unused_args):
+		self.running = False
+
+	def _sources(self):
+		redis = component.getUtility(IRedisClient)
+		return [_FailedJobSource(redis, name, self.matcher) for name in self.queue_names]
+
+	def __call__(self):
+		sources = self._sources()
+		if self.stage:
+			try:
+				for source in sources:
+					logger.info('Staged failed jobs (%s) (count=%s)',
+								source.failed_name, source.stage())
+			finally:
+				if self.staged is not None:
+					self.staged.set()
+		elif self.staged is not None:
+			self.staged.wait()
+
+		result = {'replayed': 0, 'skipped': 0, 'errors': Counter()}
+		for source in sources:
+			replayer = _FailedJobReplayer(source,
+										  batch_size=self.batch_size,
+										  site_names=self.site_names)
+			while self.running and replayer():
+				pass
+			result['replayed'] += replayer.replayed
+			result['skipped'] += source.skipped
+			result['errors'].update(replayer.errors)
+		return result
+
+
+def _report(result):
+	print('Replayed=%s Skipped=%s Failed=%s' % (result['replayed'],
+												result['skipped'],
+												sum(result['errors'].values())))
+	for error, count in result['errors'].most_common():
+		print('\t%-40s %s' % (error, count))
+
+
+def _report_scan(counts):
+	print('Matching failed jobs=%s' % counts.pop(('total', None), 0))
+	for (kind, name), count in sorted(counts.items()):
+		print('\t%-8s %-60s %s' % (kind, name, count))
+
+
+class Processor(_MigratorProcessor):
+
+	def create_arg_parser(self):
+		arg_parser = argparse.ArgumentParser(description="Replay failed analytics jobs")
+		arg_parser.add_argument('--env_dir', dest='env_dir',
+								help="Dataserver environment root directory")
+		arg_parser.add_argument('-q', '--queue', dest='queues',
+								action='append', default=[],
+								help="A queue to replay; may be repeated (default all)")
+		arg_parser.add_argument('-f', '--function', dest='functions',
+								action='append', default=[],
+								help="Only replay jobs for this function; may be repeated")
+		arg_parser.add_argument('--job_site', dest='job_sites',
+								action='append', default=[],
+								help="Only replay jobs from this site; may be repeated")
+		arg_parser.add_argument('--start', dest='start',
+								help="Only replay jobs from this time (epoch or YYYY-MM-DD)")
+		arg_parser.add_argument('--end', dest='end',
+								help="Only replay jobs before this time (epoch or YYYY-MM-DD)")
+		arg_parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+								help="The number of replay processes")
+		arg_parser.add_argument('--batch_size', dest='batch_size', type=int,
+								default=DEFAULT_BATCH_SIZE,
+								help="The maximum number of jobs per transaction")
+		arg_parser.add_argument('--dry_run', dest='dry_run', action='store_true',
+								help="Only report the matching jobs")
+		arg_parser.add_argument('--site', dest='site', help="request SITE")
+		arg_parser.add_argument('-v', '--verbose', help="Be verbose",
+								action='store_true', dest='verbose')
+		return arg_parser
+
+	def _run(self, args, env_dir, function):
+		conf_packages = ('nti.analytics', 'nti.appserver', 'nti.dataserver',)
+		context = self.create_context(env_dir)
+		return run_with_dataserver(environment_dir=env_dir,
+								   xmlconfig_packages=conf_packages,
+								   verbose=args.verbose,
+								   context=context,
+								   use_transaction_runner=False,
+								   function=function)
+
+	def _dry_run(self, args, env_dir, queue_names, matcher):
+		def _scan():
+			redis = component.getUtility(IRedisClient)
+			result = Counter()
+			for name in queue_names:
+				result.update(scan_failed_jobs(redis, name, matcher))
+			return result
+		_report_scan(self._run(args, env_dir, _scan))
+
+	def _replay_worker(self, args, env_dir, replay, results):
+		signal.signal(signal.SIGTERM, replay.stop)
+		signal.signal(signal.SIGINT, replay.stop)
+		results.put(self._run(args, env_dir, replay))
+
+	def __call__(self, *args, **kwargs):
+		arg_parser = self.create_arg_parser()
+		args = arg_parser.parse_args()
+
+		env_dir = args.env_dir
+		if not env_dir:
+			env_dir = os.getenv('DATASERVER_DIR')
+		if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
+			raise ValueError("Invalid dataserver environment root directory", env_dir)
+
+		logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+		queue_names = [get_queue_name(x) for x in args.queues] or QUEUE_NAMES
+		matcher = FailedJobFilter(args.functions, args.job_sites,
+								  parse_time(args.start), parse_time(args.end))
+		if args.dry_run:
+			self._dry_run(args, env_dir, queue_names, matcher)
+			sys.exit(0)
+
+		# The first worker stages the failed queues; the rest wait on it.
+		staged = multiprocessing.Event()
+		results = multiprocessing.Queue()
+		processes = []
+		for idx in range(max(args.workers, 1)):
+			replay = _FailedJobReplay(queue_names, matcher,
+									  batch_size=args.batch_size,
+									  site_names=[args.site] if args.site else (),
+									  stage=idx == 0,
+									  staged=staged)
+			process = multiprocessing.Process(target=self._replay_worker,
+											  args=(args, env_dir, replay, results),
+											  name='analytics-replay-%s' % idx)
+			process.start()
+			processes.append(process)
+
+		result = {'replayed': 0, 'skipped': 0, 'errors': Counter()}
+		pending = len(processes)
+		while pending:
+			try:
+				worker_result = results.get(timeout=1)
+			except Empty:
+				if not any(x.is_alive() for x in processes):
+					logger.warn('Replay workers exited without results (count=%s)', pending)
+					break
+				continue
+			pending -= 1
+			result['replayed'] += worker_result['replayed']
+			result['skipped'] += worker_result['skipped']
+			result['errors'].update(worker_result['errors'])
+		for process in processes:
+			process.join()
+		_report(result)
+		sys.exit(0)
+
+def main():
+	return Processor()()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+A standalone, multi-process analytics queue worker. A lightweight
+supervisor starts `N` worker processes, each draining its assigned
+analytics queues in micro-batches (see :mod:`nti.analytics.runner`), and
+restarts any worker that dies.
+
+Queues may be pinned to workers with `--affinity`; the remaining queues
+are distributed across the other workers. Within a worker, the queue each
+batch is drawn from is chosen by weighted fair scheduling (see
+:mod:`nti.analytics.scheduler`), configured with `--weight` and
+`--max_latency`. Each worker loads its own
+dataserver (and so its own analytics db engines) after it is forked.
+
+On SIGTERM/SIGINT, workers finish (and commit) their current batch
+before exiting.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+import functools
+import multiprocessing
+
+from nti.dataserver.utils import run_with_dataserver
+
+from nti.analytics import QUEUE_NAME
+from nti.analytics import QUEUE_NAMES
+
+from nti.analytics import get_factory
+from nti.analytics import get_partition_names
+
+from nti.analytics.metrics import get_metrics
+
+from nti.analytics.runner import DEFAULT_BATCH_SIZE
+
+from nti.analytics.runner import AnalyticsBatchJobRunner
+
+from nti.analytics.scheduler import WeightedQueueScheduler
+
+from nti.analytics.utils.ds_migrator import Processor as _MigratorProcessor
+
+#: How long (in seconds) a worker sleeps when all of its queues are empty.
+DEFAULT_IDLE_SLEEP = 0.5
+
+#: How long (in seconds) we wait for workers to exit on shutdown.
+DEFAULT_SHUTDOWN_TIMEOUT = 60
+
+#: The minimum time (in seconds) between restarts of a worker.
+DEFAULT_RESTART_DELAY = 5
+
+
+def get_queue_name(name):
+	"""
+	Return the full queue name, given either the full name or its suffix
+	(e.g. `resource++views`).
+	"""
+	if not name.startswith(QUEUE_NAME):
+		name = '%s++%s' % (QUEUE_NAME, name)
+	return name
+
+
+def _expand_queue_names(names):
+	result = []
+	for name in names:
+		name = get_queue_name(name.strip())
+		if name not in QUEUE_NAMES:
+			raise ValueError("Unknown analytics queue (%s)" % name)
+		# A base queue name includes all of its partitions.
+		result.extend(x for x in get_partition_names(name) if x not in result)
+	return result
+
+
+def assign_queues(workers, affinity=(), queue_names=QUEUE_NAMES):
+	"""
+	Assign our queues to `workers` worker processes. Each entry in
+	`affinity` is a list of queue names pinned to its own worker; all
+	other queues are distributed round-robin across the remaining workers
+	(or all workers, if every worker is pinned).
+
+	Returns a list, per worker, of queue names.
+	"""
+	affinity = [_expand_queue_names(x) for x in affinity]
+	if len(affinity) > workers:
+		raise ValueError("More affinity groups (%s) than workers (%s)"
+						 % (len(affinity), workers))
+	result = [list(x) for x in affinity] + [[] for _ in range(workers - len(affinity))]
+	pinned = set(name for group in affinity for name in group)
+	free_workers = list(range(len(affinity), workers)) or list(range(workers))
+	remaining = [x for x in queue_names if x not in pinned]
+	for idx, name in enumerate(remaining):
+		result[free_workers[idx % len(free_workers)]].append(name)
+	return result
+
+
+def parse_queue_values(values, factory=float):
+	"""
+	Parse `QUEUE=VALUE` strings into a map of full queue name to value.
+	"""
+	result = {}
+	for value in values or ():
+		name, value = value.rsplit('=', 1)
+		result[get_queue_name(name.strip())] = factory(value)
+	return result
+
+
+class _AnalyticsWorker(object):
+	"""
+	Drains the given queues, one batch at a time, until stopped. The
+	queue for each batch is chosen by a :class:`WeightedQueueScheduler`.
+	"""
+
+	def __init__(self, queue_names, batch_size=None,
+				 idle_sleep=DEFAULT_IDLE_SLEEP, site_names=(),
+				 weights=None, max_latency=None):
+		self.running = True
+		self.weights = weights
+		self.max_latency = max_latency
+		self.batch_size = batch_size
+		self.idle_sleep = idle_sleep
+		self.site_names = site_names
+		self.queue_names = queue_names
+
+	def stop(self, *unused_args):
+		logger.info('Stopping analytics worker (pid=%s)', os.getpid())
+		self.running = False
+
+	def install_signal_handlers(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+	def get_runner(self, factory, name):
+		kwargs = {'site_names': self.site_names}
+		if self.batch_size is not None:
+			kwargs['batch_size'] = self.batch_size
+		get_batch_runner = getattr(factory, 'get_batch_runner', None)
+		if get_batch_runner is not None:
+			# As configured for our (batching) queues.
+			runner = get_batch_runner(name, **kwargs)
+		else:
+			# Do not wait on any single queue; we sleep once all are idle.
+			runner = AnalyticsBatchJobRunner(factory.get_queue(name),
+											 max_wait=0,
+											 **kwargs)
+		if not hasattr(runner.queue, 'claim'):
+			raise ValueError("Analytics queue cannot be claimed (%s)" % name)
+		return runner
+
+	def get_runners(self):
+		factory = get_factory()
+		return [self.get_runner(factory, name) for name in self.queue_names]
+
+	def get_depths(self, runners):
+		result = {}
+		metrics = get_metrics()
+		for name, runner in runners.items():
+			try:
+				result[name] = len(runner.queue)
+			except TypeError:
+				# Unsized; we have to try it.
+				result[name] = 1
+			else:
+				metrics.record_depth(name, result[name])
+		return result
+
+	def __call__(self):
+		logger.info('Starting analytics worker (pid=%s) (queues=%s)',
+					os.getpid(), self.queue_names)
+		total = 0
+		runners = dict(zip(self.queue_names, self.get_runners()))
+		scheduler = WeightedQueueScheduler(self.queue_names,
+										   weights=self.weights,
+										   max_latency=self.max_latency)
+		while self.running:
+			name = scheduler.select(self.get_depths(runners))
+			processed = runners[name]() if name is not None else 0
+			total += processed
+			if not processed and self.running:
+				time.sleep(self.idle_sleep)
+		logger.info('Analytics worker exiting (pid=%s) (processed=%s)',
+					os.getpid(), total)
+		return total
+
+
+class _AnalyticsSupervisor(object):
+	"""
+	Starts a process per queue assignment, restarting any that exit,
+	until signaled to shut down.
+	"""
+
+	def __init__(self, assignments, target,
+				 shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT,
+				 restart_delay=DEFAULT_RESTART_DELAY):
+		self.running = True
+		self.target = target
+		self.assignments = assignments
+		self.restart_delay = restart_delay
+		self.shutdown_timeout = shutdown_timeout
+		self.processes = [None] * len(assignments)
+		self.started = [0] * len(assignments)
+
+	def stop(self, *unused_args):
+		self.running = False
+
+	def _start(self, idx):
+		process = multiprocessing.Process(target=self.target,
+										  args=(self.assignments[idx],),
+										  name='analytics-worker-%s' % idx)
+		process.start()
+		self.processes[idx] = process
+		self.started[idx] = time.time()
+		logger.info('Started analytics worker (idx=%s) (pid=%s) (queues=%s)',
+					idx, process.pid, len(self.assignments[idx]))
+
+	def _check(self):
+		for idx, process in enumerate(self.processes):
+			if process is not None and process.is_alive():
+				continue
+			if process is not None:
+				logger.warn('Analytics worker exited (idx=%s) (pid=%s) (exitcode=%s)',
+							idx, process.pid, process.exitcode)
+				self.processes[idx] = None
+			if time.time() - self.started[idx] >= self.restart_delay:
+				self._start(idx)
+
+	def shutdown(self):
+		alive = [x for x in self.processes if x is not None and x.is_alive()]
+		logger.info('Shutting down analytics workers (count=%s)', len(alive))
+		for process in alive:
+			process.terminate()
+		deadline = time.time() + self.shutdown_timeout
+		for process in alive:
+			process.join(max(deadline - time.time(), 0))
+			if process.is_alive():
+				logger.warn('Killing analytics worker (pid=%s)', process.pid)
+				os.kill(process.pid, signal.SIGKILL)
+				process.join()
+
+	def __call__(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		for idx in range(len(self.assignments)):
+			self._start(idx)
+		try:
+			while self.running:
+				time.sleep(1)
+				if self.running:
+					self._check()
+		finally:
+			self.shutdown()
+
+
+class Processor(_MigratorProcessor):
+
+	def create_arg_parser(self):
+		arg_parser = argparse.ArgumentParser(description="Process the analytics queues")
+		arg_parser.add_argument('--env_dir', dest='env_dir',
+								help="Dataserver environment root directory")
+		arg_parser.add_argument('-w', '--workers', dest='workers', type=int,
+								default=multiprocessing.cpu_count(),
+								help="The number of worker processes")
+		arg_parser.add_argument('-a', '--affinity', dest='affinity',
+								action='append', default=[],
+								help="A comma-separated group of queues to pin "
+									 "to a worker; may be repeated")
+		arg_parser.add_argument('--weight', dest='weights',
+								action='append', default=[],
+								help="A QUEUE=WEIGHT scheduling weight; may be repeated")
+		arg_parser.add_argument('--max_latency', dest='max_latency',
+								action='append', default=[],
+								help="A QUEUE=SECONDS maximum latency target; "
+									 "may be repeated")
+		arg_parser.add_argument('--batch_size', dest='batch_size', type=int,
+								help="The maximum number of jobs per transaction "
+									 "(default as configured, or %s)" % DEFAULT_BATCH_SIZE)
+		arg_parser.add_argument('--idle_sleep', dest='idle_sleep', type=float,
+								default=DEFAULT_IDLE_SLEEP,
+								help="Seconds to sleep when all queues are empty")
+		arg_parser.add_argument('--site', dest='site', help="request SITE")
+		arg_parser.add_argument('-v', '--verbose', help="Be verbose",
+								action='store_true', dest='verbose')
+		return arg_parser
+
+	def run_worker(self, args, env_dir, queue_names):
+		worker = _AnalyticsWorker(queue_names,
+								  batch_size=args.batch_size,
+								  idle_sleep=args.idle_sleep,
+								  site_names=[args.site] if args.site else (),
+								  weights=parse_queue_values(args.weights, int),
+								  max_latency=parse_queue_values(args.max_latency))
+		# Installed before loading the dataserver, so that we can be
+		# stopped during startup.
+		worker.install_signal_handlers()
+		conf_packages = ('nti.analytics', 'nti.appserver', 'nti.dataserver',)
+		context = self.create_context(env_dir)
+		run_with_dataserver(environment_dir=env_dir,
+							xmlconfig_packages=conf_packages,
+							verbose=args.verbose,
+							context=context,
+							use_transaction_runner=False,
+							function=worker)
+
+	def __call__(self, *args, **kwargs):
+		arg_parser = self.create_arg_parser()
+		args = arg_parser.parse_args()
+
+		env_dir = args.env_dir
+		if not env_dir:
+			env_dir = os.getenv('DATASERVER_DIR')
+		if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
+			raise ValueError("Invalid dataserver environment root directory", env_dir)
+
+		logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+		affinity = [x.split(',') for x in args.affinity]
+		assignments = assign_queues(max(args.workers, 1), affinity)
+		# We may have more workers than queues.
+		assignments = [x for x in assignments if x]
+		target = functools.partial(self.run_worker, args, env_dir)
+		supervisor = _AnalyticsSupervisor(assignments, target)
+		supervisor()
+		sys.exit(0)
+
+def main():
+	return Processor()()
+
+if __name__ == '__main__':
+	main()
@@ -14,6 +14,8 @@ from zope import interface
 
 from zope.component.zcml import utility
 
+from zope.schema import Int
+
 from nti.asynchronous.interfaces import IQueue
 from nti.asynchronous.interfaces import IRedisQueue
 
@@ -27,9 +29,27 @@ from nti.asynchronous import get_job_queue as async_queue
 from nti.dataserver.interfaces import IRedisClient
 
 from . import QUEUE_NAMES
+from . import get_base_queue_name
 
 from .interfaces import IAnalyticsQueueFactory
 
+from .runner import DEFAULT_MAX_WAIT
+from .runner import DEFAULT_BATCH_SIZE
+from .runner import AnalyticsBatchJobRunner
+
+
+class IRegisterBatchingProcessingQueue(interface.Interface):
+	"""
+	The arguments needed for registering micro-batching analytics queues.
+	"""
+	batch_size = Int(title=u"The maximum number of jobs per transaction",
+					 default=DEFAULT_BATCH_SIZE,
+					 required=False)
+
+	max_wait = Int(title=u"The milliseconds to wait while filling a batch",
+				   default=DEFAULT_MAX_WAIT,
+				   required=False)
+
 
 @interface.implementer(IAnalyticsQueueFactory)
 class _TestImmediateQueueFactory(object):
@@ -59,8 +79,19 @@ class _AbstractProcessingQueueFactory(object):
 
 	queue_interface = None
 
+	def _base_queue_name( self, name ):
+		base_name = get_base_queue_name( name )
+		return base_name if base_name != name else None
+
 	def get_queue( self, name ):
 		queue = async_queue(name, self.queue_interface)
+		base_name = self._base_queue_name( name )
+		if queue is None and base_name is not None:
+			# A partition that has not been installed; the base queue
+			# keeps per-user ordering as well.
+			logger.warn( "No queue for analytics partition (%s), using (%s)",
+						 name, base_name )
+			queue = async_queue(base_name, self.queue_interface)
 		if queue is None:
 			raise ValueError("No queue exists for analytics processing queue (%s). "
 							 "Evolve error?" % name )
@@ -80,6 +111,26 @@ class _AnalyticsRedisProcessingQueueFactory(_AbstractProcessingQueueFactory):
 	def _redis(self):
 		return component.getUtility(IRedisClient)
 
+class _AnalyticsBatchingRedisProcessingQueueFactory(_AnalyticsRedisProcessingQueueFactory):
+	"""
+	Redis queues whose jobs are drained in micro-batches, one transaction
+	per batch.
+	"""
+
+	def __init__(self, _context, batch_size=DEFAULT_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+		super(_AnalyticsBatchingRedisProcessingQueueFactory, self).__init__(_context)
+		self.batch_size = batch_size
+		self.max_wait = max_wait
+
+	def get_batch_runner(self, name, **kwargs):
+		"""
+		Return a runner for the named queue, with our batch settings
+		unless given.
+		"""
+		kwargs.setdefault('batch_size', self.batch_size)
+		kwargs.setdefault('max_wait', self.max_wait)
+		return AnalyticsBatchJobRunner(self.get_queue(name), **kwargs)
+
 def registerImmediateProcessingQueue(_context):
 	logger.info( "Registering immediate analytics processing queue" )
 	factory = _ImmediateQueueFactory()
@@ -99,3 +150,12 @@ def registerRedisProcessingQueue(_context):
 	logger.info( "Registering analytics redis processing queue" )
 	factory = _AnalyticsRedisProcessingQueueFactory(_context)
 	utility(_context, provides=IAnalyticsQueueFactory, component=factory)
+
+def registerBatchingRedisProcessingQueue(_context, batch_size=DEFAULT_BATCH_SIZE,
+										 max_wait=DEFAULT_MAX_WAIT):
+	logger.info( "Registering analytics batching redis processing queue "
+				 "(batch_size=%s) (max_wait=%s)", batch_size, max_wait )
+	factory = _AnalyticsBatchingRedisProcessingQueueFactory(_context,
+															batch_size=batch_size,
+															max_wait=max_wait)
+	utility(_context, provides=IAnalyticsQueueFactory, component=factory)